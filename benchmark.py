@@ -0,0 +1,445 @@
+#!/usr/bin/python3
+
+# Benchmark for pparser.py. Builds synthetic captures in rdpproxy's
+# text format, one per kind of traffic, and times parse_rdpproxy on
+# each of them with each output format, or with -d only the decoding of
+# their hexdumps.
+
+import getopt
+import sys
+import os
+import time
+import struct
+import random
+import tempfile
+import shutil
+
+import pparser
+
+def u8(v):
+    return bytearray([v & 0xff])
+
+def u16be(v):
+    return bytearray(struct.pack(">H", v))
+
+def u16le(v):
+    return bytearray(struct.pack("<H", v))
+
+def u32le(v):
+    return bytearray(struct.pack("<I", v))
+
+def u32be(v):
+    return bytearray(struct.pack(">I", v))
+
+def unicode16(s, chars):
+    """s as UTF-16LE, padded with NULs to chars characters."""
+    data = bytearray(s.encode("utf-16le"))
+    return data+bytearray(2*chars-len(data))
+
+def berlength(n):
+    if n < 0x80:
+        return u8(n)
+    return u8(0x82)+u16be(n)
+
+def berinteger(v):
+    return u8(2)+u8(1)+u8(v)
+
+def domainparams(values):
+    data = bytearray().join(map(berinteger, values))
+    return u8(0x30)+berlength(len(data))+data
+
+def tpkt(body):
+    return u8(3)+u8(0)+u16be(len(body)+4)+body
+
+def iso_data(mcs):
+    return tpkt(bytearray([0x02, 0xf0, 0x80])+mcs)
+
+def tagged(tag, data):
+    return u16le(tag)+u16le(len(data)+4)+data
+
+def client_info():
+    data = u16le(1)+u16le(8)+u16le(1024)+u16le(768)+u16le(0xca01)+ \
+           u16le(0xaa03)+u32le(0x41d)+u32le(2600)+unicode16("BENCHHOST", 16)+ \
+           u32le(4)+u32le(0)+u32le(12)+bytearray(range(64))+ \
+           u16le(0xca03)+u16le(0)
+    return tagged(0xc001, data)
+
+def client_channels(names):
+    data = u32le(len(names))
+    for i in range(len(names)):
+        data+=bytearray(names[i].encode())+bytearray(8-len(names[i]))+ \
+               u32le(0x80000000 | (0xc0000000 >> i % 3))
+    return tagged(0xc003, data)
+
+def channel_ids(count):
+    """The ids of count virtual channels, in the order of the channel
+    table. They are handed out backwards, so that naming the channels
+    takes the ids in the connect response."""
+    return [1003+count-i for i in range(count)]
+
+def server_channels(count):
+    """The ids of the I/O channel and count virtual channels."""
+    data = u16le(1003)+u16le(count)
+    for channelid in channel_ids(count):
+        data+=u16le(channelid)
+    if count % 2:
+        data+=u16le(0)
+    return data
+
+def connect_initial(channelnames):
+    clientdata = client_info()+tagged(0xc002, u32le(3)+u32le(0))+ \
+                 client_channels(channelnames)
+    inner = u16be(8)+u16be(0x0f)+u8(0)+u16be(0xc001)+u8(0)+ \
+            bytearray(b"Duca")+u16be(0x8000 | len(clientdata))+clientdata
+    userdata = u16be(5)+u16be(0x14)+u8(0x7c)+u16be(1)+ \
+               u16be(0x8000 | len(inner))+inner
+    userdata = u8(4)+berlength(len(userdata))+userdata
+    body = bytearray([4, 1, 1, 4, 1, 1, 1, 1, 0xff])+ \
+           domainparams([34, 2, 0, 1, 0, 1, 0xff, 2])+ \
+           domainparams([1, 1, 1, 1, 0, 1, 0x20, 2])+ \
+           domainparams([0xff, 0xfc, 0xff, 1, 0, 1, 0xff, 2])+userdata
+    return iso_data(u16be(0x7f65)+berlength(len(body))+body)
+
+def connect_response(cacert, cert, channelcount):
+    rest = bytearray(range(32))+bytearray([2, 0, 0, 0x80, 2, 0, 0, 0])+ \
+           u32le(len(cacert))+cacert+u32le(len(cert))+cert+bytearray(7)
+    crypt = u32le(1)+u32le(2)+u32le(32)+u32le(len(rest)-32)+rest
+    taggeddata = tagged(0x0c01, u16le(4)+u16le(8))+tagged(0x0c02, crypt)+ \
+                 tagged(0x0c03, server_channels(channelcount))
+    userdata = bytearray(range(21))+u16be(0x8000 | len(taggeddata))+ \
+               taggeddata
+    body = u8(0x0a)+u8(1)+u8(0)+berinteger(0)+ \
+           domainparams([34, 3, 0, 1, 0, 1, 0xff, 2])+ \
+           u8(4)+berlength(len(userdata))+userdata
+    return iso_data(u16be(0x7f66)+berlength(len(body))+body)
+
+def senddata(mcstype, channel, flags, payload):
+    body = u32le(flags)
+    if flags & 0x8:
+        body+=bytearray([0xa5]*8) # Signature
+    body+=payload
+    if len(body) < 0x80:
+        length = u8(len(body))
+    else:
+        length = u16be(0x8000 | len(body))
+    return iso_data(u8(mcstype)+u16be(1001)+u16be(channel)+u8(0x70)+
+                    length+body)
+
+def sdrq(channel, flags, payload):
+    return senddata(0x64, channel, flags, payload)
+
+def sdin(channel, flags, payload):
+    return senddata(0x68, channel, flags, payload)
+
+def rdp_pdu(pdutype, data):
+    return u16le(len(data)+6)+u16le(0x10 | pdutype)+u16le(1002)+data
+
+def data_pdu(datatype, data):
+    return rdp_pdu(7, u32le(0x103ea)+u8(0)+u8(1)+u16le(len(data)+4)+
+                   u8(datatype)+u8(0)+u16be(0)+data)
+
+def general_capset():
+    return u16le(1)+u16le(24)+u16le(1)+u16le(3)+u16be(0x200)+bytearray(14)
+
+def order_capset():
+    data = bytearray(20)+u16le(1)+u16le(20)+u16le(0)+u16le(1)+ \
+           u16le(0x147)+u16le(0x2a)+ \
+           bytearray([1, 1, 1, 1, 0, 0, 0, 0, 1, 1, 1, 0, 1, 1, 1, 0,
+                      0, 0, 0, 0, 0, 0, 1, 1])+bytearray(8)+ \
+           u16le(0x6a1)+bytearray(6)+u32le(0x38400)+u32le(0)+u32le(0x4e4)
+    return u16le(3)+u16le(len(data)+4)+data
+
+def opaque_capset(capsettype, length):
+    return u16le(capsettype)+u16le(length+4)+bytearray([capsettype]*length)
+
+def capsets(count):
+    kinds = [general_capset(), opaque_capset(2, 24), order_capset(),
+             opaque_capset(4, 36), opaque_capset(5, 8), opaque_capset(8, 4),
+             opaque_capset(10, 4), opaque_capset(13, 4),
+             opaque_capset(99, 6)]
+    return [kinds[i % len(kinds)] for i in range(count)]
+
+def demand_active(count):
+    sets = capsets(count)
+    data = bytearray().join(sets)
+    source = bytearray(b"RDP\0")
+    return sdin(1003, 0x8, rdp_pdu(1, u32le(0x103ea)+u16le(len(source))+
+                                   u16le(len(data)+4)+source+
+                                   u16le(len(sets))+bytearray(6)+
+                                   u16le(1002)+u16le(0)+data+bytearray(4)))
+
+def confirm_active(count):
+    sets = capsets(count)
+    data = bytearray().join(sets)
+    source = bytearray(b"MSTSC\0")
+    return sdrq(1003, 0x8, rdp_pdu(3, u32le(0x103ea)+u16le(1002)+
+                                   u16le(len(source))+u16le(len(data)+4)+
+                                   source+u16le(len(sets))+u16le(0)+data))
+
+def input_pdu(events, rand):
+    data = u16le(events)+u16be(0)
+    for i in range(events):
+        data+=u32le(1000000000+i)+ \
+               u16le(rand.choice([0, 4, 4, 0x8001]))+ \
+               u16le(rand.choice([0, 0x8000, 0xc000]))+ \
+               u16le(rand.choice([0x1e, 0x1f, 0x02, 0x1a, 0x55]))+ \
+               u16le(rand.randint(0, 65535))
+    return sdrq(1003, 0x8, data_pdu(28, data))
+
+def rdp5(updates):
+    body = bytearray()
+    for (updatetype, data) in updates:
+        body+=u8(updatetype)+u16le(len(data))+data
+    return u8(0)+u16be(0x8000 | len(body)+3)+body
+
+def bitmap_update(rectangles, rand):
+    data = u16le(rectangles)
+    for i in range(rectangles):
+        height = rand.choice([8, 16, 32])
+        size = rand.randint(500, 1500)
+        data+=u16le(0)+u16le(i*64)+u16le(0)+u16le(i*64+63)+ \
+               u16le(height-1)+u16le(64)+u16le(height)+u16le(8)+ \
+               u16le(0x401)+u16le(size)+ \
+               bytearray(rand.randint(0, 255) for j in range(size))
+    return data
+
+def clipboard_pdus(channel, size, rand):
+    """A format list, a data request and a data response of size bytes
+    of text, cut in chunks of 1600 bytes the way the client does."""
+    formats = bytearray()
+    for (code, name) in [(1, "CF_TEXT"), (13, "CF_UNICODETEXT"),
+                         (0xc004, "Native"), (7, "CF_OEMTEXT")]:
+        formats+=u32le(code)+unicode16(name, 16)
+    announce = u16le(2)+u16le(0)+u32le(len(formats))+formats+u32le(0)
+    request = u16le(4)+u16le(0)+u32le(4)+u32le(13)+u32le(0)
+    text = bytearray(rand.randint(0x20, 0x7e) for i in range(size))
+    response = u16le(5)+u16le(0)+u32le(len(text))+text+u32le(0)
+    pdus = [sdrq(channel, 0x8, u32le(len(announce))+u32le(3)+announce),
+            sdin(channel, 0x8, u32le(len(request))+u32le(3)+request)]
+    for pos in range(0, len(response), 1600):
+        flags = 0
+        if 0 == pos:
+            flags|=1
+        if len(response) <= pos+1600:
+            flags|=2
+        pdus.append(sdrq(channel, 0x8, u32le(len(response))+u32le(flags)+
+                         response[pos:pos+1600]))
+    return pdus
+
+class Capture:
+    """Builds a capture the way rdpproxy prints it."""
+
+    def __init__(self):
+        self.lines = []
+        self.packets = 0
+        self.partpackets = {"Client":0, "Server":0}
+
+    def add(self, origin, pdu):
+        self.packets+=1
+        self.partpackets[origin]+=1
+        if 3 == pdu[0]:
+            pkttype = "TPKT"
+        else:
+            pkttype = "RDP5"
+        self.lines.append("#%d, #%d from %s, type %s, l: %d, read %d bytes\n" %
+                          (self.packets, self.partpackets[origin], origin,
+                           pkttype, len(pdu), len(pdu)))
+        for offset in range(0, len(pdu), 16):
+            line = pdu[offset:offset+16]
+            printable = ""
+            for c in line:
+                if 0x20 <= c < 0x7f:
+                    printable+=chr(c)
+                else:
+                    printable+="."
+            self.lines.append("%04x %s%s%s\n" % (offset,
+                                                 "".join(["%02x " % c
+                                                          for c in line]),
+                                                 "   "*(16-len(line)),
+                                                 printable))
+
+    def text(self):
+        return "".join(self.lines)
+
+def connect(capture):
+    """Add an MCS connect initial and response to capture."""
+    cacert = bytearray(open(os.path.join(sourcedir, "cacert.der"), 'rb').read())
+    cert = bytearray(open(os.path.join(sourcedir, "cert.der"), 'rb').read())
+    capture.add("Client", connect_initial(channelnames))
+    capture.add("Server", connect_response(cacert, cert, len(channelnames)))
+
+def connect_capture(scale, rand):
+    """MCS connect initial and response."""
+    capture = Capture()
+    for i in range(20*scale):
+        connect(capture)
+    return capture
+
+def capability_capture(scale, rand):
+    """Demand and confirm active, with many CapsetParts each."""
+    capture = Capture()
+    for i in range(10*scale):
+        capture.add("Server", demand_active(90))
+        capture.add("Client", confirm_active(90))
+    return capture
+
+def input_capture(scale, rand):
+    """Bursts of DataPDUInput events."""
+    capture = Capture()
+    for i in range(200*scale):
+        capture.add("Client", input_pdu(1+i % 20, rand))
+    return capture
+
+def bitmap_capture(scale, rand):
+    """Large BitmapUpdateParts in RDP5 packets."""
+    capture = Capture()
+    for i in range(20*scale):
+        capture.add("Server", rdp5([(1, bitmap_update(12, rand))]))
+    return capture
+
+def clipboard_capture(scale, rand):
+    """Clipboard transfers cut in many chunks, after a connect that
+    names the channels."""
+    capture = Capture()
+    connect(capture)
+    channel = channel_ids(len(channelnames))[channelnames.index("cliprdr")]
+    for i in range(5*scale):
+        for pdu in clipboard_pdus(channel, 40000, rand):
+            capture.add(("Server", "Client")[0x64 == pdu[7]], pdu)
+    return capture
+
+sourcedir = os.path.dirname(os.path.abspath(__file__))
+
+# The virtual channels of the connect, see channel_ids for their ids.
+channelnames = ["rdpdr", "cliprdr", "rdpsnd"]
+
+scenarios = [("connect", connect_capture),
+             ("capabilities", capability_capture),
+             ("input", input_capture),
+             ("bitmap", bitmap_capture),
+             ("clipboard", clipboard_capture)]
+
+def run(filename, outputformat):
+    """Parse filename once with outputformat, and return the time it
+    took. LATEX writes files of its own, they go to a scratch
+    directory."""
+    location = None
+    if "LATEX" == outputformat:
+        location = tempfile.mkdtemp()
+    infile = open(filename, 'rb')
+    outfile = open(os.devnull, 'w', encoding='latin-1')
+    start = time.time()
+    pparser.parse_rdpproxy(infile, outfile, outputformat, location, None,
+                           os.path.basename(filename), [], 0)
+    elapsed = time.time()-start
+    infile.close()
+    outfile.close()
+    if None != location:
+        shutil.rmtree(location)
+    return elapsed
+
+def decode_bytewise(columns):
+    """Decode hex columns the way it was done before decode_hexdump:
+    joined, split and converted byte by byte."""
+    return bytearray(map(lambda x: int(x, 16),
+                         "".join(columns).strip().split(' ')))
+
+decoders = [("fromhex", pparser.decode_hexdump),
+            ("bytewise", decode_bytewise)]
+
+def hexdump_columns(filename):
+    """The hex columns of each packet in filename."""
+    infile = open(filename, 'rb')
+    packets = [list(record[5]) for record in pparser.read_capture(infile)
+               if 1 < len(record)]
+    infile.close()
+    return packets
+
+def run_decode(packets, decode):
+    """Decode the hex columns of packets with decode, and return the
+    time it took."""
+    start = time.perf_counter()
+    for columns in packets:
+        decode(columns)
+    return time.perf_counter()-start
+
+def benchmark(names, outputformats, scale, repeat, keepdir=None, decode=0):
+    """Time each output format on the captures of names, or with
+    decode, each of decoders. MB/s are of the capture either way."""
+    print("%-14s %-8s %8s %10s %9s %11s %8s" % ("traffic", "format",
+                                                 "packets", "bytes",
+                                                 "seconds", "packets/s",
+                                                 "MB/s"))
+    for (name, generator) in scenarios:
+        if name not in names:
+            continue
+        capture = generator(scale, random.Random(name))
+        if None != keepdir:
+            filename = os.path.join(keepdir, name+".txt")
+            capfile = open(filename, 'w')
+        else:
+            (fd, filename) = tempfile.mkstemp(".txt", name)
+            capfile = os.fdopen(fd, 'w')
+        capfile.write(capture.text())
+        capfile.close()
+        size = os.path.getsize(filename)
+
+        if decode:
+            packets = hexdump_columns(filename)
+            runs = [(decodername, lambda decoder=decoder:
+                     run_decode(packets, decoder))
+                    for (decodername, decoder) in decoders]
+        else:
+            runs = [(outputformat, lambda outputformat=outputformat:
+                     run(filename, outputformat))
+                    for outputformat in outputformats]
+        for (label, timed) in runs:
+            best = min([timed() for i in range(repeat)])
+            print("%-14s %-8s %8d %10d %9.3f %11.0f %8.2f" % \
+                  (name, label, capture.packets, size, best,
+                   capture.packets/best, size/best/1e6))
+        if None == keepdir:
+            os.unlink(filename)
+
+def print_usage(progname):
+    print("%s [OPTIONS] [traffic...]" % progname)
+    print("Time pparser.py on synthetic captures of each kind of traffic:")
+    print(" ", " ".join([name for (name, generator) in scenarios]))
+    print()
+    print("-f <formats>  Output formats to time, default TXT,TBL,LATEX")
+    print("-s <scale>    Make the captures this many times larger, default 1")
+    print("-r <repeat>   Take the best of this many runs, default 3")
+    print("-k <dir>      Keep the captures in <dir>")
+    print("-d            Only time decoding the hexdumps, with decode_hexdump")
+    print("              and byte by byte as before it")
+
+if '__main__' == __name__:
+    optlist, args = getopt.getopt(sys.argv[1:], 'f:s:r:k:dh')
+    outputformats = ["TXT", "TBL", "LATEX"]
+    scale = 1
+    repeat = 3
+    keepdir = None
+    decode = 0
+    for opt, arg in optlist:
+        if '-f' == opt:
+            outputformats = arg.split(',')
+        if '-s' == opt:
+            scale = int(arg)
+        if '-r' == opt:
+            repeat = int(arg)
+        if '-k' == opt:
+            keepdir = arg
+        if '-d' == opt:
+            decode = 1
+        if '-h' == opt:
+            print_usage(sys.argv[0])
+            sys.exit(0)
+
+    names = args or [name for (name, generator) in scenarios]
+    for name in names:
+        if name not in [n for (n, generator) in scenarios]:
+            print("Unknown traffic %s" % name)
+            print_usage(sys.argv[0])
+            sys.exit(1)
+
+    benchmark(names, outputformats, scale, repeat, keepdir, decode)
@@ -1,7 +1,6 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 
 import os
-import string
 import re
 
 class keymap:
@@ -9,8 +8,8 @@ class keymap:
     
     def read_keymap(self, path, name):
         keys = {}
-        km = open(os.path.join(path, name), 'r')
-        for line in km.xreadlines():
+        km = open(os.path.join(path, name), 'r', encoding='latin-1')
+        for line in km:
             if '#' == line[0] or '\n' == line[0]:
                 continue
 
@@ -20,7 +19,7 @@ class keymap:
                 keys.update(self.read_keymap(path, line[8:].strip()))
                 continue
             elif "map " == line[:4]:
-                self.map = string.atol(line[4:], 16)
+                self.map = int(line[4:], 16)
                 continue
 
             elif "enable_compose" == line[:15]:
@@ -30,7 +29,7 @@ class keymap:
                 mo = self.mapfind.search(line)
                 (key, code, rest) = mo.groups()
 
-                keys[string.atoi(code, 16)] = "%s / %s" % (key, rest)
+                keys[int(code, 16)] = "%s / %s" % (key, rest)
 
         return keys
             
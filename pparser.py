@@ -1,21 +1,24 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 # -*-mode: python; coding: iso-8859-1 -*-
 
-import string
 import getopt
 import sys
 import time
 import re
-import POW
 import struct
 import os
+import multiprocessing
+import io
+import mmap
+import array
+import select
+import stat
+import collections
+import threading
 
 from keymap import keymap
 
-keys = keymap("keymaps", 'sv')
-currentchannel = 0
-
-rdp_channel_flags = [(0x80000000L, "OPTION_INITIALIZED"),
+rdp_channel_flags = [(0x80000000, "OPTION_INITIALIZED"),
                      (1073741824, "OPTION_ENCRYPT_RDP"),
                      (536870912, "OPTION_ENCRYPT_SC"),
                      (268435456, "OPTION_ENCRYPT_CS"),
@@ -26,14 +29,298 @@ rdp_channel_flags = [(0x80000000L, "OPTION_INITIALIZED"),
                      (4194304, "OPTION_COMPRESS"),
                      (2097152, "OPTION_SHOW_PROTOCOL")]
 
-rdp_channels = {}
+class LazyKeymap:
+    """A keymap that is not read until the first key is looked up in
+    it."""
+
+    def __init__(self, path="keymaps", name='sv'):
+        self.path = path
+        self.name = name
+        self.keymap = None
+
+    def __getitem__(self, key):
+        if None == self.keymap:
+            self.keymap = keymap(self.path, self.name)
+        return self.keymap[key]
+
+class ParserContext:
+    """What parsing remembers from one packet of a session to the
+    next: the channel the last MCS header was about (currentchannel),
+    the channel table sent by the client (rdp_channels), which of its
+    channels each MCS channel id is (channelids), the chunks of
+    virtual channel PDUs collected so far (channelchunks) and how
+    many parts of each class have been written as TBL/LATEX files
+    (clsrefs). It also has the keymap scancodes are named from (keys),
+    whether parts are decoded only when looked at (lazy) and whether
+    Unicode strings are printed in full (fullunicode)."""
+
+    def __init__(self, keys=None, lazy=0, fullunicode=0):
+        self.currentchannel = 0
+        self.rdp_channels = {}
+        self.clsrefs = {}
+        self.channelids = {}
+        self.channelchunks = {}
+        if None == keys:
+            keys = LazyKeymap()
+        self.keys = keys
+        self.lazy = lazy
+        self.fullunicode = fullunicode
+
+class ActiveContext(threading.local):
+    """The ParserContext parsers work in, one for each thread."""
+
+    def __init__(self):
+        self.context = ParserContext()
+
+active = ActiveContext()
+
+def use_context(newcontext):
+    """Make newcontext the context parsers in this thread work in."""
+    active.context = newcontext
+
+def output_encoding(fullunicode):
+    """Return the encoding of the output. Packet contents are written
+    as the Latin-1 characters of their bytes; with fullunicode (-u),
+    Unicode strings may hold more, and it is UTF-8."""
+    if fullunicode:
+        return 'utf-8'
+    return 'latin-1'
 
 def LaTeX_escape(s):
     s = s.replace("#", "\\#")
     s = s.replace("_", "\\_")
     return s
 
-class PacketPart:
+class PacketData(object):
+    """A window (start, end) into the bytes of one packet, which may be
+    bytes, a bytearray or a memoryview.
+
+    Indexing gives the byte value as an int, just like the list of
+    ints the parsers used to work on, but slicing gives a new window on
+    the same buffer instead of a copy. This way, a parser can keep
+    returning data[n:] without the cost of each field growing with the
+    size of the packet."""
+
+    __slots__ = ('buf', 'start', 'end')
+
+    def __init__(self, buf, start=0, end=None):
+        if not isinstance(buf, (bytes, bytearray, memoryview)):
+            buf = bytes(buf)
+        if None == end:
+            end = len(buf)
+        self.buf = buf
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            (start, stop, step) = index.indices(self.end - self.start)
+            if 1 != step:
+                raise ValueError("PacketData does not support extended slices")
+            if stop < start:
+                stop = start
+            return PacketData(self.buf, self.start+start, self.start+stop)
+
+        if index < 0:
+            index+=self.end - self.start
+        if index < 0 or self.start+index >= self.end:
+            raise IndexError("PacketData index out of range")
+        return self.buf[self.start+index]
+
+    def __iter__(self):
+        return iter(self.buf[self.start:self.end])
+
+    def __add__(self, other):
+        if isinstance(other, PacketData) and other.buf is self.buf \
+               and other.start == self.end:
+            return PacketData(self.buf, self.start, other.end)
+        return PacketData(self.tostring() + bytes(other))
+
+    def __radd__(self, other):
+        return PacketData(bytes(other) + self.tostring())
+
+    def __repr__(self):
+        return "PacketData(%r)" % self.tolist()
+
+    def tolist(self):
+        return list(self.buf[self.start:self.end])
+
+    def tostring(self):
+        return bytes(self.buf[self.start:self.end])
+
+    __bytes__ = tostring
+
+be_decoders = {1:struct.Struct(">B"),
+               2:struct.Struct(">H"),
+               4:struct.Struct(">I"),
+               8:struct.Struct(">Q")}
+
+def decode_uint(decoder, data):
+    """Decode the unsigned integer described by decoder, a precompiled
+    struct.Struct for a single field, from the start of data. If the
+    packet ends inside the field, the bytes that are there are used,
+    just like the old string based decoders did."""
+    if len(data) >= decoder.size:
+        if not isinstance(data, PacketData):
+            data = PacketData(data[:decoder.size])
+        return decoder.unpack_from(data.buf, data.start)[0]
+
+    if 0 == len(data):
+        raise ValueError("No data left for %d byte integer" % decoder.size)
+    raw = list(data)
+    if '<' == decoder.format[0]:
+        raw.reverse()
+    value = 0
+    for byte in raw:
+        value = (value << 8) | byte
+    return value
+
+def decode_be(data, length):
+    """Decode a big endian unsigned integer of any length."""
+    if length in be_decoders:
+        return decode_uint(be_decoders[length], data)
+
+    raw = data[0:length]
+    if 0 == len(raw):
+        raise ValueError("No data left for %d byte integer" % length)
+    value = 0
+    for byte in raw:
+        value = (value << 8) | byte
+    return value
+
+fixed_runs = {}
+
+def compile_fixed_run(formats):
+    decoders = []
+    for format in formats:
+        if decoders and decoders[-1][0] == format[0]:
+            decoders[-1] = decoders[-1]+format[1:]
+        else:
+            decoders.append(format)
+    decoders = list(map(struct.Struct, decoders))
+    return (sum([decoder.size for decoder in decoders]), decoders)
+
+def parse_fixed_run(parts, data):
+    """Parse parts, a list of plain fixed-width integer parts
+    (Integer8Part, Integer16Part, Integer32Part, their little endian
+    variants and subclasses that only change how the value is shown)
+    which follow each other in the packet. Each run of fields with the
+    same byte order is decoded with a single struct call, with the
+    struct.Struct compiled only the first time a layout is seen.
+    Returns the remaining data, like PacketPart.parse."""
+    formats = tuple([part.decoder.format for part in parts])
+    if formats not in fixed_runs:
+        fixed_runs[formats] = compile_fixed_run(formats)
+    (size, decoders) = fixed_runs[formats]
+    return unpack_fixed_run(parts, size, decoders, data)
+
+def unpack_fixed_run(parts, size, decoders, data):
+    if len(data) < size or not isinstance(data, PacketData):
+        # Short packet, let each part deal with it.
+        for part in parts:
+            data = part.parse(data)
+        return data
+
+    offset = data.start
+    i = 0
+    for decoder in decoders:
+        for value in decoder.unpack_from(data.buf, offset):
+            parts[i].value = value
+            i+=1
+        offset+=decoder.size
+    return data[size:]
+
+slotcache = {}
+
+def slotnames(cls):
+    """Return the names of all the __slots__ of cls and its bases."""
+    names = slotcache.get(cls)
+    if None == names:
+        names = []
+        for c in cls.__mro__:
+            names.extend(c.__dict__.get('__slots__', ()))
+        slotcache[cls] = names
+    return names
+
+class Layout:
+    """Declarative description of a fixed sequence of fields.
+
+    fields is a list of (description, part class, expected value)
+    tuples, optionally followed by a dictionary of extra constructor
+    arguments, in the order the fields appear in the packet. indent is
+    added to the indentation of the part owning the fields.
+
+    The first time a layout is used at some indentation, it is compiled
+    into a list of steps: struct decoders for runs of plain fixed-width
+    integers, and plain parse calls for everything else. Parsing a
+    packet is then one pass over that table."""
+
+    def __init__(self, fields, indent=1):
+        self.fields = fields
+        self.indent = indent
+        self.steps = {}
+
+    def isfixed(self, parttype):
+        return parttype.parse in (Integer8Part.parse, Integer16Part.parse,
+                                  Integer32Part.parse)
+
+    def compile(self, indent):
+        steps = []
+        for field in self.fields:
+            (description, parttype, knvalue) = field[:3]
+            kw = {'knvalue':knvalue, 'indent':indent}
+            if 3 < len(field):
+                kw.update(field[3])
+
+            if self.isfixed(parttype):
+                if steps and 'run' == steps[-1][0]:
+                    steps[-1][1].append((parttype, description, kw))
+                else:
+                    steps.append(('run', [(parttype, description, kw)]))
+            else:
+                steps.append(('part', parttype, description, kw))
+
+        for i in range(len(steps)):
+            if 'run' == steps[i][0]:
+                fields = steps[i][1]
+                formats = [x[0].decoder.format for x in fields]
+                (size, decoders) = compile_fixed_run(formats)
+                steps[i] = ('run', fields, size, decoders)
+
+        return steps
+
+    def parse(self, owner, data):
+        """Append the parts of the layout to owner.value, parse them
+        and return the remaining data."""
+        indent = owner.indent+self.indent
+        if indent not in self.steps:
+            self.steps[indent] = self.compile(indent)
+
+        runs = []
+        for step in self.steps[indent]:
+            if 'run' == step[0]:
+                parts = [t(d, **kw) for (t, d, kw) in step[1]]
+            else:
+                parts = [step[1](step[2], **step[3])]
+            owner.value.extend(parts)
+            runs.append((step, parts))
+
+        for (step, parts) in runs:
+            if 'run' == step[0]:
+                data = unpack_fixed_run(parts, step[2], step[3], data)
+            else:
+                data = parts[0].parse(data)
+
+        return data
+
+class PacketPart(object):
+    __slots__ = ('description', 'owntbl', 'knvalue', 'indent', 'datatype',
+                 'value', 'raw', 'maxlength', 'rawlength', 'packetno',
+                 'pending')
+
     BER_TAGS = {'BOOLEAN':1,
                 'INTEGER':2,
                 'OCTET_STRING':4,
@@ -54,11 +341,51 @@ class PacketPart:
         self.raw = 0
         self.maxlength = 0
 
-        if kw.has_key('maxlength'):
+        if 'maxlength' in kw:
             self.maxlength = kw['maxlength']
         else:
             self.maxlength = None
 
+    def __getstate__(self):
+        state = {}
+        for name in slotnames(self.__class__):
+            try:
+                state[name] = object.__getattribute__(self, name)
+            except AttributeError:
+                pass
+        return state
+
+    def __setstate__(self, state):
+        for (name, value) in state.items():
+            setattr(self, name, value)
+
+    def __getattr__(self, name):
+        # Only called for attributes the instance lacks, which for a
+        # part with a pending deferparse is every one of them.
+        try:
+            pending = object.__getattribute__(self, 'pending')
+        except AttributeError:
+            raise AttributeError(name)
+        if '__' == name[:2]:
+            raise AttributeError(name)
+        (state, parser, data) = pending
+        del self.pending
+        self.__setstate__(state)
+        parser(data)
+        return getattr(self, name)
+
+    def deferparse(self, parser, data):
+        """Run parser(data), where data is everything the part owns.
+        In lazy mode this is postponed until the part is first looked
+        at, so parts that are never printed are never decoded."""
+        if not active.context.lazy:
+            parser(data)
+            return
+        state = self.__getstate__()
+        for name in state.keys():
+            delattr(self, name)
+        self.pending = (state, parser, data)
+
     def __len__(self):
         ret = 0
         for p in self.value:
@@ -70,34 +397,50 @@ class PacketPart:
             return "[no value]"
         else:
             ret = "\n"+" "*self.indent
-            ret+=string.join(map(lambda x: str(x),
-                                 self.value),
-                             "\n"+" "*self.indent)
+            ret+=("\n"+" "*self.indent).join([str(x) for x in self.value])
         return ret
 
-    def tblvalue(self, **kw):
-        s =  "%s\t%s\t" % (self.datatype,
-                           self.description)
+    def tbl(self, write, offset=0):
+        """Write the row of the part in a tbl table, from the datatype
+        on, a fragment at a time with write. offset is where the part
+        starts in the part the table is for."""
+        write("%s\t%s\t" % (self.datatype, self.description))
         if None != self.knvalue:
-            s+=str(self.knvalue)
-        s+="\t%s\t" % self.strvalue()
-        return s
-
-    def latexvalue(self, **kw):
-        s = "%s & %s &" % (self.datatype, self.description)
+            write(str(self.knvalue))
+        write("\t")
+        write_strvalue(write, self)
+        write("\t")
+
+    def latex(self, write, offset=0):
+        """Write the row of the part in a LaTeX table, like tbl."""
+        write("%s & %s &" % (self.datatype, self.description))
         if None != self.knvalue:
-            s+=str(self.knvalue)
-        s+="& %s \\\\ \n" % self.strvalue()
-        return s
-
-    def __str__(self):
+            write(str(self.knvalue))
+        write("& ")
+        write_strvalue(write, self)
+        write(" \\\\ \n")
+
+    def tblvalue(self, offset=0, **kw):
+        out = []
+        self.tbl(out.append, offset)
+        return "".join(out)
+
+    def latexvalue(self, offset=0, **kw):
+        out = []
+        self.latex(out.append, offset)
+        return "".join(out)
+
+    def strhead(self):
         ret = " "*self.indent+self.datatype+" "+self.description+" "
         if None != self.knvalue:
             ret+="(expected: "+str(self.knvalue)+") "
         if self.raw:
             ret+=" RAW DATA (length 0x%.2x (%d))" % (self.rawlength,
                                                    self.rawlength)
-        return ret+self.strvalue()
+        return ret
+
+    def __str__(self):
+        return self.strhead()+self.strvalue()
 
     def hextostr(self, data, fill=1):
         ret = ""
@@ -111,17 +454,14 @@ class PacketPart:
         return ret
 
     def packtobytestring(self, data):
-        ret = ""
-        for byte in data:
-            ret+=struct.pack('B', byte)
-        return ret
+        return data.tostring()
 
     def parse(self, data):
         """Parse the packet value into a human readable form.
         In PacketPart (top-level class), we just eat the bytes and
         present it as a hexdump, as a last resort"""
 
-        returndata = []
+        returndata = data[len(data):]
         if None != self.maxlength:
             returndata = data[self.maxlength:]
             data = data[:self.maxlength]
@@ -129,10 +469,8 @@ class PacketPart:
         self.raw = 1
         self.rawlength = len(data)
 
-        while 0 < len(data):
-            hl = HexLine("")
-            data = hl.parse(data)
-            self.value.append(hl)
+        if 0 < len(data):
+            self.value.append(RawData("", data, indent=self.indent))
 
         return returndata
 
@@ -146,50 +484,78 @@ class PacketPart:
         return self.postparse(self.parse(self.preparse(data)))
 
 class CryptoSignature(PacketPart):
+    __slots__ = ()
+
     def __init__(self, description, **kw):
         PacketPart.__init__(self, description, **kw)
         self.owntbl = 0
 
-    def latexvalue(self, **kw):
-        return "RAW & Crypto signature & & 8 bytes of data\\\\"
+    def latex(self, write, offset=0):
+        write("RAW & Crypto signature & & 8 bytes of data\\\\")
 
-class HexLine(PacketPart):
+class RawData(PacketPart):
+    """The bytes of a part we know nothing more about. value is the
+    PacketData slice of the packet holding them; they are only turned
+    into hexdump lines, 16 bytes each, when output is produced."""
 
-    classname = "HexLine"
+    classname = "RawData"
+    __slots__ = ()
 
-    def __init__(self, description, **kw):
+    def __init__(self, description, data, **kw):
         PacketPart.__init__(self, description, **kw)
         self.datatype="RAW"
         self.owntbl = 0
+        self.value = data
+
+    def lines(self):
+        for i in range(0, len(self.value), 16):
+            yield self.value[i:i+16]
+
+    def strline(self, line):
+        return bytes(line).hex(' ')+" "+self.hextostr(line)
+
+    def tblline(self, line):
+        return "RAW & %s& & %s & %s \\\n" % (self.description,
+                                             bytes(line).hex(' '),
+                                             self.hextostr(line, fill=0))
+
+    def latexline(self, line):
+        return "%s & %s && %s \\\\ \n" % (self.datatype, self.description,
+                                       self.strline(line))
+
+    def tbl(self, write, offset=0):
+        # The offset of the first line is written by the caller.
+        sep = ""
+        for line in self.lines():
+            write(sep+self.tblline(line))
+            offset+=len(line)
+            sep = "\n%d\t" % offset
+
+    def latex(self, write, offset=0):
+        sep = ""
+        for line in self.lines():
+            write(sep+self.latexline(line))
+            offset+=len(line)
+            sep = "\n%d & " % offset
+
+    def strlines(self):
+        prefix = "%s %s " % (self.datatype, self.description)
+        for line in self.lines():
+            yield prefix+self.strline(line)
 
-    def parse(self, data):
-        self.value = data[:16]
-        return data[16:]
-
-    def strvalue(self):
-        datap = map(lambda x: "%.2x" % x, self.value)
-        return string.join(datap, ' ')+" "+self.hextostr(self.value)
-
-    def tblvalue(self, **kw):
-        return "RAW\t%s\t\t%s\t%s" % (self.description, string.join(
-            map(lambda x: "%.2x" % x, self.value), " "),
-                                         self.hextostr(self.value, fill=0))
-
-    def tblvalue(self, **kw):
-        return "RAW & %s& & %s & %s \\\n" % (self.description, string.join(
-            map(lambda x: "%.2x" % x, self.value), " "),
-                                         self.hextostr(self.value, fill=0))
-    
-
-    
+    def __str__(self):
+        # The first line is indented by the owner.
+        return ("\n"+" "*self.indent).join(self.strlines())
 
     def __len__(self):
         return len(self.value)
-        
-        
+
+
 class Integer8Part(PacketPart):
 
     classname = "Integer8Part"
+    __slots__ = ()
+    decoder = be_decoders[1]
 
     def __init__(self, description, **kw):
         PacketPart.__init__(self, description, **kw)
@@ -210,6 +576,8 @@ class Integer8Part(PacketPart):
 class Integer16Part(Integer8Part):
 
     classname = "Integer16Part"    
+    __slots__ = ()
+    decoder = be_decoders[2]
 
     def __init__(self, description, **kw):
         Integer8Part.__init__(self, description, **kw)
@@ -223,16 +591,16 @@ class Integer16Part(Integer8Part):
 
     def parse(self, data):
         try:
-            self.value = string.atoi(string.join(map(lambda x: "%.2x" % x,
-                                                     data[0:2]), ''), 16)
+            self.value = decode_uint(self.decoder, data)
         except ValueError:
-            print "Exception while parsing %s:" % self.description
+            print("Exception while parsing %s:" % self.description)
             raise
         return data[2:]
 
 class Integer16or8000Part(Integer16Part):
 
     classname = "Integer16or8000Part"
+    __slots__ = ()
 
     def parse(self, data):
         data = Integer16Part.parse(self, data)
@@ -243,20 +611,18 @@ class Integer16or8000Part(Integer16Part):
 class Integer16lePart(Integer16Part):
 
     classname = "Integer16lePart"
+    __slots__ = ()
+    decoder = struct.Struct("<H")
 
     def __init__(self, description, **kw):
         Integer8Part.__init__(self, description, **kw)
         self.datatype="Int16 (le)"
 
-    def parse(self, data):
-        mydata = data[0:2]
-        mydata.reverse()
-        Integer16Part.parse(self, mydata)
-        return data[2:]
-
 class Integer32Part(Integer8Part):
 
     classname = "Integer32Part"
+    __slots__ = ()
+    decoder = be_decoders[4]
 
     def __init__(self, description, **kw):
         Integer8Part.__init__(self, description, **kw)
@@ -269,30 +635,23 @@ class Integer32Part(Integer8Part):
         return "0x%.8x (%d)" % (self.value, self.value)
 
     def parse(self, data):
-        valstr = string.join(map(lambda x: "%.2x" % x, data[:4]), '')
-        try:
-            self.value = string.atoi(valstr, 16)
-        except ValueError:
-            self.value = string.atol(valstr, 16)
+        self.value = decode_uint(self.decoder, data)
         return data[4:]
 
 class Integer32lePart(Integer32Part):
 
     classname = "Integer32lePart"
+    __slots__ = ()
+    decoder = struct.Struct("<I")
 
     def __init__(self, description, **kw):
         Integer32Part.__init__(self, description, **kw)
         self.datatype="Int32 (le)"
 
-    def parse(self, data):
-        mydata = data[0:4]
-        mydata.reverse()
-        Integer32Part.parse(self, mydata)
-        return data[4:]
-
 class Time32le(Integer32lePart):
 
     classname = "Time32le"
+    __slots__ = ()
 
     def __init__(self, description, **kw):
         Integer32lePart.__init__(self, description, **kw)
@@ -306,6 +665,7 @@ class Time32le(Integer32lePart):
 class VariableInt(PacketPart):
 
     classname = "VariableInt"
+    __slots__ = ('lengthbytes',)
 
     def __init__(self, description, **kw):
         PacketPart.__init__(self, description, **kw)
@@ -319,9 +679,7 @@ class VariableInt(PacketPart):
         if self.value & 0x80:
             self.lengthbytes = self.value & ~0x80
             self.datatype = "VariableInt(%d)" % self.lengthbytes
-            self.value = string.atoi(string.join(map(lambda x: "%.2x" % x,
-                                                     data[0:self.lengthbytes]),
-                                                 ''), 16)
+            self.value = decode_be(data, self.lengthbytes)
             data = data[self.lengthbytes:]
             
         return data
@@ -335,6 +693,7 @@ class VariableInt(PacketPart):
 class MSVariableInt(VariableInt):
 
     classname = "MSVariableInt"
+    __slots__ = ()
 
     def parse(self, data):
         self.value = data[0]
@@ -355,6 +714,7 @@ class MSVariableInt(VariableInt):
 class KnownLengthInt(PacketPart):
 
     classname = "KnownLengthInt"
+    __slots__ = ('length',)
 
     def __init__(self, description, length, **kw):
         PacketPart.__init__(self, description, **kw)
@@ -366,9 +726,7 @@ class KnownLengthInt(PacketPart):
         return "0x%.2x (%d)" % (self.value, self.value)
 
     def parse(self, data):
-        self.value = string.atoi(string.join(map(lambda x: "%.2x" % x,
-                                                 data[0:self.length]),
-                                             ''), 16)
+        self.value = decode_be(data, self.length)
         return data[self.length:]
 
     def __len__(self):
@@ -378,30 +736,38 @@ class KnownLengthInt(PacketPart):
 class MultiTableValue(PacketPart):
 
     classname = "MultiTableValue"
+    __slots__ = ()
 
-    def tblvalue(self, offset=0):
-        s = "%s\n" % self.value[0].tblvalue(offset=offset)
+    def tbl(self, write, offset=0):
+        self.value[0].tbl(write, offset)
+        write("\n")
         offset+=len(self.value[0])
         for part in self.value[1:-1]:
-            s+="%d\t%s\n" % (offset, part.tblvalue(offset=offset))
+            write("%d\t" % offset)
+            part.tbl(write, offset)
+            write("\n")
             offset+=len(part)
-        s+="%d\t%s" % (offset, self.value[-1:][0].tblvalue(offset=offset))
-        return s
+        write("%d\t" % offset)
+        self.value[-1].tbl(write, offset)
 
-    def latexvalue(self, offset=0):
-        s = "%s\n" % self.value[0].latexvalue(offset=offset)
+    def latex(self, write, offset=0):
+        self.value[0].latex(write, offset)
+        write("\n")
         offset+=len(self.value[0])
         for part in self.value[1:-1]:
-            s+="%d & %s\n" % (offset, part.latexvalue(offset=offset))
+            write("%d & " % offset)
+            part.latex(write, offset)
+            write("\n")
             offset+=len(part)
-        s+="%d & %s\\\\" % (offset,
-                            self.value[-1:][0].latexvalue(offset=offset))
-        return s
+        write("%d & " % offset)
+        self.value[-1].latex(write, offset)
+        write("\\\\")
 
 
 class BERHeader(PacketPart):
 
     classname = "BERHeader"
+    __slots__ = ('realtag', 'tag', 'taglen')
 
     def __init__(self, description, tag, **kw):
         PacketPart.__init__(self, description, **kw)
@@ -412,15 +778,14 @@ class BERHeader(PacketPart):
     def parse(self, data):
         if self.tag > 0xff:
             self.taglen = 2
-            self.realtag = string.atoi(string.join(map(lambda x: "%.2x" % x,
-                                                  data[0:2]), ''), 16)
+            self.realtag = decode_be(data, 2)
 
             self.datatype = "BER tag %d" % (self.realtag)
 
             if self.realtag != self.tag:
-                raise "Unexpected BER tag, "\
-                      "got %s expected %s" % (str(self.value),
-                      str(self.tag))
+                raise ValueError("Unexpected BER tag, "\
+                                 "got %s expected %s" % (str(self.value),
+                                                         str(self.tag)))
 
             data = data[2:]
 
@@ -430,8 +795,9 @@ class BERHeader(PacketPart):
             self.datatype = "BER tag %d" % (self.realtag)
 
             if self.realtag != self.tag:
-                raise "Unexpected BER tag, "\
-                      "got %s expected %s" % (str(self.value), str(self.tag))
+                raise ValueError("Unexpected BER tag, "\
+                                 "got %s expected %s" % (str(self.value),
+                                                         str(self.tag)))
 
             data = data[1:]
 
@@ -442,17 +808,17 @@ class BERHeader(PacketPart):
     def __len__(self):
         return self.taglen + len(self.value[0])
 
-    def tblvalue(self, offset=0):
-        s = "%s\t%s\t%s\t%s\n" % (self.datatype, self.description,
-                                  self.tag, self.realtag)
-        return s+"%d\t%s" % (offset+self.taglen,
-                             self.value[0].tblvalue(offset=offset+self.taglen))
-
-    def latexvalue(self, offset=0):
-        s = "%s & %s & %s & %s \\\\" % (self.datatype, self.description,
-                                  self.tag, self.realtag)
-        return s+"%d & %s" % (offset+self.taglen,
-                              self.value[0].latexvalue(offset=offset+self.taglen))
+    def tbl(self, write, offset=0):
+        write("%s\t%s\t%s\t%s\n" % (self.datatype, self.description,
+                                    self.tag, self.realtag))
+        write("%d\t" % (offset+self.taglen))
+        self.value[0].tbl(write, offset+self.taglen)
+
+    def latex(self, write, offset=0):
+        write("%s & %s & %s & %s \\\\" % (self.datatype, self.description,
+                                        self.tag, self.realtag))
+        write("%d & " % (offset+self.taglen))
+        self.value[0].latex(write, offset+self.taglen)
         
         
 
@@ -460,6 +826,7 @@ class BERHeader(PacketPart):
 class BERValue(MultiTableValue):
 
     classname = "BERValue"
+    __slots__ = ('bertype',)
 
     def __init__(self, description, bertype, **kw):
         PacketPart.__init__(self, description, **kw)
@@ -486,6 +853,7 @@ class BERValue(MultiTableValue):
 class DomainParametersPacket(PacketPart):
 
     classname = "DomainParametersPacket"
+    __slots__ = ()
 
     def __init__(self, description, **kw):
         PacketPart.__init__(self, description, **kw)
@@ -519,11 +887,12 @@ class DomainParametersPacket(PacketPart):
 
 class Latin1String(PacketPart):
     classname = "Latin1String"
+    __slots__ = ('havenullchar', 'length')
 
     def __init__(self, description, length, **kw):
         PacketPart.__init__(self, description, **kw)
         self.havenullchar=1
-        if kw.has_key("nonullchar"):
+        if "nonullchar" in kw:
             self.havenullchar=0
         self.datatype = "Latin1 String(%d" % length
         if self.havenullchar:
@@ -542,17 +911,18 @@ class Latin1String(PacketPart):
         return self.value
 
     def parse(self, data):
-        self.value = ""
-        mydata = data[0:self.length]
-        for char in mydata:
-            if char != 0:
-                self.value+=(chr(char))
-
+        self.value = latin1_string(data[0:self.length])
         return data[self.length+self.havenullchar:]
 
+def latin1_string(data):
+    """Decode the bytes of data as Latin-1, leaving out the NULs that
+    pad names such as those in the channel table."""
+    return bytes(data).translate(None, b"\0").decode('latin-1')
+
 class UnicodeString(PacketPart):
 
     classname = "UnicodeString"
+    __slots__ = ('length',)
 
     def __init__(self, description, length, **kw):
         PacketPart.__init__(self, description, **kw)
@@ -566,27 +936,45 @@ class UnicodeString(PacketPart):
     def strvalue(self):
         return self.value
 
+    # Characters that are not printed as themselves: NUL is printed
+    # as "." and, unless the context wants full Unicode, everything
+    # outside Latin-1 as "". Lone surrogates are always "".
+    latin1re = re.compile("[^\x01-\xff]")
+    unicodere = re.compile("[\0\ud800-\udfff]")
+
     def parse(self, data):
-        self.value = ""
-        mydata = data[0:2*self.length]
-        while 0 < len(mydata):
-            thischr = mydata[0:2]
-            thischr.reverse()
-            val = string.atoi(string.join(map(lambda x: "%.2x" % x,
-                                              thischr), ''), 16)
-            if val in range(1, 256):
-                self.value+=unichr(val).encode('latin-1')
-            elif 0 == val:
-                self.value+="."
+        mydata = bytes(data[0:2*self.length])
+        low = mydata[0::2]
+        high = mydata[1::2]
+        if high.count(0) == len(high):
+            # Plain Latin-1, as nearly all strings are. A trailing odd
+            # byte counts as a character with a zero high byte.
+            self.value = low.replace(b"\0", b".").decode('latin-1')
+        else:
+            even = len(high)*2
+            value = mydata[:even].decode('utf-16-le', 'surrogatepass') + \
+                    mydata[even:].decode('latin-1')
+            if active.context.fullunicode:
+                self.value = self.unicodere.sub(placeholder, value)
             else:
-                self.value+=""
-            mydata = mydata[2:]
+                self.value = self.latin1re.sub(placeholder, value)
 
         return data[2*self.length:]
 
+def placeholder(mo):
+    """What UnicodeString prints instead of the character matched by
+    mo: "." for NUL and "" for each UTF-16 unit of anything else."""
+    c = mo.group()
+    if "\0" == c:
+        return "."
+    if 0xffff < ord(c):
+        return ""
+    return ""
+
 class ColorDepthInfo(Integer16lePart):
 
     classname = "ColorDepthInfo"
+    __slots__ = ()
 
     depths = {0xca01:'8',
               0xca02:'15',
@@ -604,6 +992,26 @@ class ColorDepthInfo(Integer16lePart):
 class UserdataClientinfoPacket(PacketPart):
 
     classname = "UserdataClientinfoPacket"
+    __slots__ = ()
+
+    layout = Layout([("RDP version", Integer16lePart,
+                      "0x0001 for RDP4, 0x0004 for RDP5"),
+                     ("", Integer16lePart, 0x0008),
+                     ("Width", Integer16lePart, None),
+                     ("Height", Integer16lePart, None),
+                     ("", Integer16lePart, 0xca01),
+                     ("", Integer16lePart, 0xaa03),
+                     ("Keylayout", Integer32lePart, None),
+                     ("Client build", Integer32lePart, None),
+                     ("Hostname", UnicodeString, None, {'length':16}),
+                     ("", Integer32lePart, 0x00000004),
+                     ("", Integer32lePart, 0x00000000),
+                     ("", Integer32lePart, 0x0000000c),
+                     ("Reserved data", PacketPart, None, {'maxlength':64}),
+                     ("(client)", ColorDepthInfo, None),
+                     ("", Integer16lePart, 0x0000),
+                     ("Remaining client data", PacketPart, None)],
+                    indent=0)
 
     def __init__(self, description, **kw):
         PacketPart.__init__(self, description, **kw)
@@ -616,7 +1024,7 @@ class UserdataClientinfoPacket(PacketPart):
         data = clinfotag.parse(data)
 
         if clinfotag.value != 0xc001:
-            raise "Expected Client info (tagged by 0xc001), got %d" % clinfotag.value
+            raise ValueError("Expected Client info (tagged by 0xc001), got %d" % clinfotag.value)
 
         clinfolen = Integer16lePart("Client info length",
                                     knvalue="136 in rdesktop, "\
@@ -625,70 +1033,26 @@ class UserdataClientinfoPacket(PacketPart):
         self.value.append(clinfolen)
         data = clinfolen.parse(data)
 
-        clinfodata = data[:clinfolen.value-4]
-        
-        self.value.append(Integer16lePart("RDP version",
-                                          knvalue="0x0001 for RDP4, "\
-                                          "0x0004 for RDP5",
-                                          indent=self.indent))
-        self.value.append(Integer16lePart("", knvalue=0x0008,
-                                          indent=self.indent))
-        self.value.append(Integer16lePart("Width",
-                                          indent=self.indent))
-        self.value.append(Integer16lePart("Height",
-                                          indent=self.indent))
-        self.value.append(Integer16lePart("", knvalue=0xca01,
-                                          indent=self.indent))
-        self.value.append(Integer16lePart("", knvalue=0xaa03,
-                                          indent=self.indent))
-        self.value.append(Integer32lePart("Keylayout", 
-                                          indent=self.indent))
-        self.value.append(Integer32lePart("Client build", 
-                                          indent=self.indent))
-        self.value.append(UnicodeString("Hostname", 16,
-                                        indent=self.indent))
-        self.value.append(Integer32lePart("", knvalue=0x00000004,
-                                          indent=self.indent))
-        self.value.append(Integer32lePart("", knvalue=0x00000000,
-                                          indent=self.indent))
-        self.value.append(Integer32lePart("", knvalue=0x0000000c,
-                                          indent=self.indent))
-
-        valuelen = len(self.value)
-        
-        for dp in self.value[2:]:
-            clinfodata = dp.parse(clinfodata)
-
-        reserved_data = PacketPart("Reserved data", indent=self.indent)
-        self.value.append(reserved_data)
-        reserved_data.parse(clinfodata[:64])
-        valuelen+=1
-
-        clinfodata = clinfodata[64:]
-
-        self.value.append(ColorDepthInfo("(client)", indent=self.indent))
-
-        self.value.append(Integer16lePart("", knvalue=0x0000,
-                                          indent=self.indent))        
-
-        self.value.append(PacketPart("Remaining client data",
-                                     indent=self.indent))
-
-        for dp in self.value[valuelen:]:
-            clinfodata = dp.parse(clinfodata)
+        self.layout.parse(self, data[:clinfolen.value-4])
 
         return data[clinfolen.value-4:]
 
 class CertificatePart(PacketPart):
 
     classname = "CertificatePart"
+    __slots__ = ()
 
     def __init__(self, description, **kw):
         PacketPart.__init__(self, description, **kw)
         self.datatype = "Certificate"
 
     def parse(self, data):
-        returndata = []
+        try:
+            import POW # Slow to load, and only needed here.
+        except ImportError: # Without it, certificates are shown raw.
+            return PacketPart.parse(self, data)
+
+        returndata = data[len(data):]
         if None != self.maxlength:
             returndata = data[self.maxlength:]
             data = data[:self.maxlength]
@@ -699,12 +1063,13 @@ class CertificatePart(PacketPart):
 
         return returndata
 
-    def latexvalue(self, **kw):
-        return "\\begin{verbatim}\n%s\n\\end{verbatim}" % self.value
+    def latex(self, write, offset=0):
+        write("\\begin{verbatim}\n%s\n\\end{verbatim}" % self.value)
 
 class MCSResponseCryptinfoPacket(PacketPart):
 
     classname = "MCSResponseCryptinfoPacket"
+    __slots__ = ()
 
     def __init__(self, description, **kw):
         PacketPart.__init__(self, description, **kw)
@@ -721,8 +1086,7 @@ class MCSResponseCryptinfoPacket(PacketPart):
                                       knvalue=0x20)
         self.value.append(randsaltlen)
 
-        for dp in self.value:
-            data = dp.parse(data)
+        data = parse_fixed_run(self.value, data)
 
         valuelen = len(self.value)        
 
@@ -767,50 +1131,85 @@ class MCSResponseCryptinfoPacket(PacketPart):
 class SrvInfoPart(PacketPart):
 
     classname = "Srvinfopart"
+    __slots__ = ()
+
+    layout = Layout([("RDP version", Integer16lePart, None),
+                     ("Unknown", Integer16lePart, 8)])
 
     def __init__(self, description, **kw):
         PacketPart.__init__(self, description, **kw)
         self.datatype = "TAG_SRV_INFO"
 
     def parse(self, data):
-        self.value.append(Integer16lePart("RDP version",
-                                          indent=self.indent+1))
-        self.value.append(Integer16lePart("Unknown",
-                                          indent=self.indent+1,
-                                          knvalue=8))
+        return self.layout.parse(self, data)
+        
+class SrvChannelsPart(PacketPart):
+    """The MCS channel ids the server gives the I/O channel and the
+    virtual channels, in the order of the channel table sent by the
+    client."""
 
-        for dp in self.value:
-            data = dp.parse(data)
+    classname = "SrvChannelsPart"
+    __slots__ = ()
 
+    layout = Layout([("I/O channel id", Integer16lePart, None),
+                     ("Number of channels", Integer16lePart, None)])
+
+    def __init__(self, description, **kw):
+        PacketPart.__init__(self, description, **kw)
+        self.datatype = "TAG_SRV_CHANNELS"
+
+    def parse(self, data):
+        data = self.layout.parse(self, data)
+        channelids = active.context.channelids
+        for i in range(self.value[1].value):
+            if len(data) < 2:
+                break
+            channelid = Integer16lePart("Channel #%d id" % i,
+                                        indent=self.indent+1)
+            self.value.append(channelid)
+            data = channelid.parse(data)
+            channelids[channelid.value] = i
+
+        if 0 < len(data):
+            pad = PacketPart("Pad", indent=self.indent+1)
+            self.value.append(pad)
+            data = pad.parse(data)
         return data
-        
+
 class TaggedData(PacketPart):
 
     classname = "TaggedData"
+    __slots__ = ()
 
     class HexLines(PacketPart):
         classname = "HexLines"
-        def tblvalue(self, offset=0):
-            s = self.value[0].tblvalue()+"\n"
-            offset+=len(self.value[0])
-            for hexline in self.value[1:]:
-                s+="%d\t%s\n" % (offset, hexline.tblvalue())
-                offset+=len(hexline)
-            return s
-
-        def latexvalue(self, offset=0):
-            s = self.value[0].latexvalue()+"\n"
-            offset+=len(self.value[0])
-            for hexline in self.value[1:]:
-                s+="%d & %s\\\\\n" % (offset, hexline.latexvalue())
-                offset+=len(hexline)
-            return s
+        __slots__ = ()
+        def tbl(self, write, offset=0):
+            raw = self.value[0]
+            sep = ""
+            for line in raw.lines():
+                write(sep+raw.tblline(line)+"\n")
+                offset+=len(line)
+                sep = "%d\t" % offset
+
+        def latex(self, write, offset=0):
+            raw = self.value[0]
+            first = 1
+            for line in raw.lines():
+                if first:
+                    write(raw.latexline(line)+"\n")
+                    first = 0
+                else:
+                    write("%d & %s\\\\\n" % (offset, raw.latexline(line)))
+                offset+=len(line)
 
     class CliChannelsPart(PacketPart):
         classname = "CliChannelsPart"
+        __slots__ = ()
         class ChannelFlags(Integer32lePart):
 
             classname = "ChannelFlags"
+            __slots__ = ()
 
             def __init__(self, description, **kw):
                 PacketPart.__init__(self, description, **kw)
@@ -843,7 +1242,8 @@ class TaggedData(PacketPart):
                 data = channelname.parse(data)
                 data = channelflags.parse(data)
 
-                rdp_channels[i] = (channelname.value, channelflags.value)
+                active.context.rdp_channels[i] = (channelname.value,
+                                           channelflags.value)
 
             return data
             
@@ -855,7 +1255,7 @@ class TaggedData(PacketPart):
             0xc003:('TAG_CLI_CHANNELS', CliChannelsPart),
             0x0c01:('TAG_SRV_INFO', SrvInfoPart),
             0x0c02:('TAG_SRV_CRYPT', MCSResponseCryptinfoPacket),
-            0x0c03:('TAG_SRV_SRV3', HexLines)}
+            0x0c03:('TAG_SRV_CHANNELS', SrvChannelsPart)}
 
     def __init__(self, description, **kw):
         PacketPart.__init__(self, description, **kw)
@@ -892,73 +1292,53 @@ class TaggedData(PacketPart):
 
         return data # Should return empty list.
 
-    def tblvalue(self, offset=0):
-        tag = self.value[0].value[0]
-        length = self.value[0].value[1]
-        dp = self.value[0].value[2]
-        (tagtype, packetclass) = self.tags.get(tag.value,
-                                               ("Unknown", PacketPart))
-        
-        s = "%s\tTag\t\t%s (%s)\n" % (tag.datatype,
-                                      tag.value, tagtype)
-        offset+=len(tag)
-        s+= "%d\t%s\n" % (offset, length.tblvalue(offset=offset))
-        offset+=len(length)
-        s+= "%d\t%s\n" % (offset, dp.tblvalue(offset=offset))
-        offset+=len(dp)
-        for cont in self.value[1:]:
-            tag = cont.value[0]
-            length = cont.value[1]
-            dp = cont.value[2]
+    def tbl(self, write, offset=0):
+        for cont in self.value:
+            (tag, length, dp) = cont.value[:3]
             (tagtype, packetclass) = self.tags.get(tag.value,
                                                    ("Unknown", PacketPart))
-        
-            s+= "%d\t%s\tTag\t\t%s (%s)\n" % (offset, tag.datatype,
-                                              tag.value, tagtype)
+            if cont is not self.value[0]:
+                write("%d\t" % offset)
+            write("%s\tTag\t\t%s (%s)\n" % (tag.datatype, tag.value, tagtype))
             offset+=len(tag)
-            s+= "%d\t%s\n" % (offset, length.tblvalue(offset=offset))
+            write("%d\t" % offset)
+            length.tbl(write, offset)
+            write("\n")
             offset+=len(length)
-            s+= "%d\t%s\n" % (offset, dp.tblvalue(offset=offset))
+            write("%d\t" % offset)
+            dp.tbl(write, offset)
+            write("\n")
             offset+=len(dp)
-                               
-        return s
-
-    def latexvalue(self, offset=0):
-        tag = self.value[0].value[0]
-        length = self.value[0].value[1]
-        dp = self.value[0].value[2]
-        (tagtype, packetclass) = self.tags.get(tag.value,
-                                               ("Unknown", PacketPart))
-        
-        s = "%s & Tag & & %s (%s)\\\\\n" % (tag.datatype,
-                                      tag.value, tagtype)
-        offset+=len(tag)
-        s+= "%d & %s \\\\\n" % (offset, length.latexvalue(offset=offset))
-        offset+=len(length)
-        s+= "%d & %s \\\\\n" % (offset, dp.latexvalue(offset=offset))
-        offset+=len(dp)
-        for cont in self.value[1:]:
-            tag = cont.value[0]
-            length = cont.value[1]
-            dp = cont.value[2]
+
+    def latex(self, write, offset=0):
+        for cont in self.value:
+            (tag, length, dp) = cont.value[:3]
             (tagtype, packetclass) = self.tags.get(tag.value,
                                                    ("Unknown", PacketPart))
-        
-            s+= "%d & %s & Tag & & %s (%s)\\\\\n" % (offset, tag.datatype,
-                                              tag.value, tagtype)
+            first = cont is self.value[0]
+            if not first:
+                write("%d & " % offset)
+            write("%s & Tag & & %s (%s)\\\\\n" % (tag.datatype, tag.value,
+                                                tagtype))
             offset+=len(tag)
-            s+= "%d & %s \\\\ " % (offset, length.latexvalue(offset=offset))
+            write("%d & " % offset)
+            length.latex(write, offset)
+            if first:
+                write(" \\\\\n")
+            else:
+                write(" \\\\ ")
             offset+=len(length)
-            s+= "%d & %s \\\\\n" % (offset, dp.latexvalue(offset=offset))
+            write("%d & " % offset)
+            dp.latex(write, offset)
+            write(" \\\\\n")
             offset+=len(dp)
-                               
-        return s            
 
             
 
 class MCSResponseUserdataPacket(PacketPart):
 
     classname = "MCSResponseUserdataPacket"
+    __slots__ = ()
 
     def __init__(self, description, **kw):
         PacketPart.__init__(self, description, **kw)
@@ -1001,6 +1381,7 @@ class MCSResponseUserdataPacket(PacketPart):
 class McsInitialUserdataPacket(PacketPart):
 
     classname = "McsInitialUserdataPacket"
+    __slots__ = ()
 
     def __init__(self, description, **kw):
         PacketPart.__init__(self, description, **kw)
@@ -1066,6 +1447,7 @@ class McsInitialUserdataPacket(PacketPart):
 class MCSConnInitialPacket(PacketPart):
 
     classname = "MCSConnInitialPacket"
+    __slots__ = ()
     
     def __init__(self, description, **kw):
         PacketPart.__init__(self, description, **kw)
@@ -1105,6 +1487,7 @@ class MCSConnInitialPacket(PacketPart):
 class MCSConnResponsePacket(PacketPart):
 
     classname = "MCSConnResponsePacket"
+    __slots__ = ()
 
     def __init__(self, description, **kw):
         PacketPart.__init__(self, description, **kw)
@@ -1131,23 +1514,23 @@ class MCSConnResponsePacket(PacketPart):
 class EDRQPart(PacketPart):
 
     classname = "EDRQPart"
+    __slots__ = ()
+
+    layout = Layout([("SubHeight", Integer16lePart, None),
+                     ("SubInterval", Integer16lePart, None)],
+                    indent=0)
     
     def __init__(self, description, **kw):
         PacketPart.__init__(self, description, **kw)
         self.datatype = "EDRQ data"
 
     def parse(self, data):
-        self.value.append(Integer16lePart("SubHeight", indent=self.indent))
-        self.value.append(Integer16lePart("SubInterval", indent=self.indent))
-
-        for dp in self.value:
-            data = dp.parse(data)
-
-        return data
+        return self.layout.parse(self, data)
 
 class Enumerated(PacketPart):
 
     classname = "Enumerated"
+    __slots__ = ('dataparser', 'parser')
 
     def __init__(self, description, dataparser=Integer8Part, **kw):
         PacketPart.__init__(self, description, **kw)
@@ -1172,6 +1555,7 @@ class Enumerated(PacketPart):
 class MCSResultPart(Enumerated):
 
     classname = "MCSResultPart"
+    __slots__ = ()
 
     results = {0:"RT-SUCCESSFUL",
                1:"RT-DOMAIN-MERGING",
@@ -1198,6 +1582,7 @@ class MCSResultPart(Enumerated):
 class DataPriorityPart(Enumerated):
 
     classname = "DataPriorityPart"
+    __slots__ = ()
 
     results = {0:"top",
                1:"high",
@@ -1211,68 +1596,64 @@ class DataPriorityPart(Enumerated):
 class AUCFPart(PacketPart):
 
     classname = "AUCFPart"
+    __slots__ = ()
+
+    layout = Layout([("", MCSResultPart, None),
+                     ("User id", Integer16Part, None)])
 
     def __init__(self, description, **kw):
         PacketPart.__init__(self, description, **kw)
         self.datatype = "AUCF data"
     
     def parse(self, data):
-        self.value.append(MCSResultPart("", indent=self.indent+1))
-        self.value.append(Integer16Part("User id", indent=self.indent+1))
-
-        for dp in self.value:
-            data = dp.parse(data)
-
-        return data
+        return self.layout.parse(self, data)
 
 class CJRQPart(PacketPart):
 
     classname = "CJRQPart"
+    __slots__ = ('channelid',)
+
+    layout = Layout([("User id", Integer16Part, None),
+                     ("Channel id", Integer16Part, None)])
     
     def __init__(self, description, **kw):
         PacketPart.__init__(self, description, **kw)
         self.datatype = "CJRQ data"
     
     def parse(self, data):
-        self.value.append(Integer16Part("User id", indent=self.indent+1))
-        self.channelid = Integer16Part("Channel id", indent=self.indent+1)
-        self.value.append(self.channelid)
+        data = self.layout.parse(self, data)
+        self.channelid = self.value[1]
 
-        for dp in self.value:
-            data = dp.parse(data)
-
-        global currentchannel
-        currentchannel = self.channelid.value
+        active.context.currentchannel = self.channelid.value
 
         return data
 
 class CJCFPart(PacketPart):
 
     classname = "CJCFPart"
+    __slots__ = ('channelid',)
+
+    layout = Layout([("", MCSResultPart, None),
+                     ("Initiator (user id)", Integer16Part, None),
+                     ("Requested", Integer16Part, None),
+                     ("Channel id", Integer16Part, None)])
     
     def __init__(self, description, **kw):
         PacketPart.__init__(self, description, **kw)
         self.datatype = "CJCF data"    
 
     def parse(self, data):
-        self.value.append(MCSResultPart("", indent=self.indent+1))
-        self.value.append(Integer16Part("Initiator (user id)",
-                                        indent=self.indent+1))
-        self.value.append(Integer16Part("Requested", indent=self.indent+1))
-        self.channelid = Integer16Part("Channel id", indent=self.indent+1)        
-        self.value.append(self.channelid)
-
-        for dp in self.value:
-            data = dp.parse(data)
+        data = self.layout.parse(self, data)
+        self.channelid = self.value[3]
 
-        global currentchannel
-        currentchannel = self.channelid.value            
+        active.context.currentchannel = self.channelid.value            
 
         return data
 
 class LicensePart(PacketPart):
 
     classname = "LicensePart"
+    __slots__ = ()
     
     def __init__(self, description, **kw):
         PacketPart.__init__(self, description, **kw)
@@ -1296,191 +1677,102 @@ class LicensePart(PacketPart):
 class GeneralCapability(PacketPart):
 
     classname = "GeneralCapability"
+    __slots__ = ()
+
+    layout = Layout([("OS major type", Integer16lePart, None),
+                     ("OS minor type", Integer16lePart, None),
+                     ("Protocol version", Integer16Part, None),
+                     ("Pad", Integer16Part, None),
+                     ("Compression types", Integer16Part, None),
+                     ("Pad", Integer16Part, None),
+                     ("Update capability", Integer16Part, None),
+                     ("Remote unshare capability", Integer16Part, None),
+                     ("Compression level", Integer16Part, None),
+                     ("Pad", Integer16Part, None)])
     
     def __init__(self, description, **kw):
         PacketPart.__init__(self, description, **kw)
         self.datatype = "General Capability set"
 
     def parse(self, data):
-        self.value.append(Integer16lePart("OS major type",
-                                          indent=self.indent+1))
-        self.value.append(Integer16lePart("OS minor type",
-                                          indent=self.indent+1))
-        self.value.append(Integer16Part("Protocol version",
-                                          indent=self.indent+1))
-        self.value.append(Integer16Part("Pad",
-                                          indent=self.indent+1))
-        self.value.append(Integer16Part("Compression types",
-                                          indent=self.indent+1))
-        self.value.append(Integer16Part("Pad",
-                                          indent=self.indent+1))
-        self.value.append(Integer16Part("Update capability",
-                                          indent=self.indent+1))
-        self.value.append(Integer16Part("Remote unshare capability",
-                                          indent=self.indent+1))
-        self.value.append(Integer16Part("Compression level",
-                                          indent=self.indent+1))
-        self.value.append(Integer16Part("Pad",
-                                          indent=self.indent+1))
-
-        for dp in self.value:
-            data = dp.parse(data)
-
-        return data
+        return self.layout.parse(self, data)
 
 class OrderCapability(PacketPart):
 
     classname = "OrderCapability"
+    __slots__ = ()
     
     class OrderCaps(PacketPart):
 
         classname = "OrderCaps"
+        __slots__ = ()
+
+        layout = Layout([("Dest blt", Integer8Part, 1),
+                         ("Pat blt", Integer8Part, 1),
+                         ("Screen blt", Integer8Part, 1),
+                         ("Req for memblt?", Integer8Part, 1),
+                         ("Unknown", Integer8Part, 0),
+                         ("Unknown", Integer8Part, 0),
+                         ("Unknown", Integer8Part, 0),
+                         ("Unknown", Integer8Part, 0),
+                         ("Line", Integer8Part, 1),
+                         ("Line", Integer8Part, 1),
+                         ("Rect", Integer8Part, 1),
+                         ("Unknown", Integer8Part, 0),
+                         ("Memblt", Integer8Part, 1),
+                         ("Triblt", Integer8Part, 1),
+                         ("Triblt", Integer8Part, 1),
+                         ("Unknown", Integer8Part, 0),
+                         ("Unknown", Integer8Part, 0),
+                         ("Unknown", Integer8Part, 0),
+                         ("Unknown", Integer8Part, 0),
+                         ("Unknown", Integer8Part, 0),
+                         ("Unknown", Integer8Part, 0),
+                         ("Unknown", Integer8Part, 0),
+                         ("Polyline", Integer8Part, 1),
+                         ("Text2", Integer8Part, 1),
+                         ("Rem. order support data", PacketPart, None,
+                          {'maxlength':8})])
         
         def __init__(self, description, **kw):
             PacketPart.__init__(self, description, **kw)
             self.datatype = "Orders supported"
 
         def parse(self, data):
-            self.value.append(Integer8Part("Dest blt",
-                                           indent=self.indent+1,
-                                           knvalue=1))
-            self.value.append(Integer8Part("Pat blt",
-                                           indent=self.indent+1,
-                                           knvalue=1))
-            self.value.append(Integer8Part("Screen blt",
-                                           indent=self.indent+1,
-                                           knvalue=1))            
-            self.value.append(Integer8Part("Req for memblt?",
-                                           indent=self.indent+1,
-                                           knvalue=1))
-            self.value.append(Integer8Part("Unknown",
-                                           indent=self.indent+1,
-                                           knvalue=0))
-            self.value.append(Integer8Part("Unknown",
-                                           indent=self.indent+1,
-                                           knvalue=0))
-            self.value.append(Integer8Part("Unknown",
-                                           indent=self.indent+1,
-                                           knvalue=0))
-            self.value.append(Integer8Part("Unknown",
-                                           indent=self.indent+1,
-                                           knvalue=0))                        
-            self.value.append(Integer8Part("Line",
-                                           indent=self.indent+1,
-                                           knvalue=1))
-            self.value.append(Integer8Part("Line",
-                                           indent=self.indent+1,
-                                           knvalue=1))            
-            self.value.append(Integer8Part("Rect",
-                                           indent=self.indent+1,
-                                           knvalue=1))
-            self.value.append(Integer8Part("Unknown",
-                                           indent=self.indent+1,
-                                           knvalue=0))
-            self.value.append(Integer8Part("Memblt",
-                                           indent=self.indent+1,
-                                           knvalue=1))
-            self.value.append(Integer8Part("Triblt",
-                                           indent=self.indent+1,
-                                           knvalue=1))
-            self.value.append(Integer8Part("Triblt",
-                                           indent=self.indent+1,
-                                           knvalue=1))                        
-            self.value.append(Integer8Part("Unknown",
-                                           indent=self.indent+1,
-                                           knvalue=0))
-            self.value.append(Integer8Part("Unknown",
-                                           indent=self.indent+1,
-                                           knvalue=0))
-            self.value.append(Integer8Part("Unknown",
-                                           indent=self.indent+1,
-                                           knvalue=0))
-            self.value.append(Integer8Part("Unknown",
-                                           indent=self.indent+1,
-                                           knvalue=0))
-            self.value.append(Integer8Part("Unknown",
-                                           indent=self.indent+1,
-                                           knvalue=0))
-            self.value.append(Integer8Part("Unknown",
-                                           indent=self.indent+1,
-                                           knvalue=0))
-            self.value.append(Integer8Part("Unknown",
-                                           indent=self.indent+1,
-                                           knvalue=0))
-            self.value.append(Integer8Part("Polyline",
-                                           indent=self.indent+1,
-                                           knvalue=1))
-            self.value.append(Integer8Part("Text2",
-                                           indent=self.indent+1,
-                                           knvalue=1))
-            self.value.append(PacketPart("Rem. order support data",
-                                         indent=self.indent+1,
-                                         maxlength=8))
-
-            for dp in self.value:
-                data = dp.parse(data)
-
-            return data
+            return self.layout.parse(self, data)
+
+    layout = Layout([("Terminal desc, pad", PacketPart, None,
+                      {'maxlength':20}),
+                     ("Cache X granularity", Integer16lePart, 1),
+                     ("Cache Y granularity", Integer16lePart, 20),
+                     ("Pad", Integer16lePart, 0),
+                     ("Max order level", Integer16lePart, 1),
+                     ("Number of fonts", Integer16lePart, 0x147),
+                     ("Capability flags", Integer16lePart, 0x2a),
+                     ("Orders supported", OrderCaps, None, {'maxlength':32}),
+                     ("Text capability flags", Integer16lePart, 0x6a1),
+                     ("Pad", PacketPart, None, {'maxlength':6}),
+                     ("Desktop cache size", Integer32lePart, 0x38400),
+                     ("Unknown", Integer32lePart, 0),
+                     ("Unknown", Integer32lePart, 0x4e4)])
 
     def __init__(self, description, **kw):
         PacketPart.__init__(self, description, **kw)
         self.datatype = "Order Capability set"
 
     def parse(self, data):
-        self.value.append(PacketPart("Terminal desc, pad",
-                                     indent=self.indent+1,
-                                     maxlength=20))
-        self.value.append(Integer16lePart("Cache X granularity",
-                                          knvalue=1,
-                                          indent=self.indent+1))
-        self.value.append(Integer16lePart("Cache Y granularity",
-                                          knvalue=20,
-                                          indent=self.indent+1))
-        self.value.append(Integer16lePart("Pad",
-                                          knvalue=0,
-                                          indent=self.indent+1))
-        self.value.append(Integer16lePart("Max order level",
-                                          knvalue=1,
-                                          indent=self.indent+1))
-        self.value.append(Integer16lePart("Number of fonts",
-                                          knvalue=0x147,
-                                          indent=self.indent+1))
-        self.value.append(Integer16lePart("Capability flags",
-                                          knvalue=0x2a,
-                                          indent=self.indent+1))
-        self.value.append(self.OrderCaps("Orders supported",
-                                         indent=self.indent+1,
-                                         maxlength=32))
-        self.value.append(Integer16lePart("Text capability flags",
-                                          knvalue=0x6a1,
-                                          indent=self.indent+1))
-        self.value.append(PacketPart("Pad",
-                                     indent=self.indent+1,
-                                     maxlength=6))
-        self.value.append(Integer32lePart("Desktop cache size",
-                                          knvalue=0x38400,
-                                          indent=self.indent+1))
-        self.value.append(Integer32lePart("Unknown",
-                                          knvalue=0,
-                                          indent=self.indent+1))
-        self.value.append(Integer32lePart("Unknown",
-                                          knvalue=0x4e4,
-                                          indent=self.indent+1))
+        return self.layout.parse(self, data)
 
-        for dp in self.value:
-            data = dp.parse(data)
-
-        return data
-        
-        
 
 class CapsetPart(PacketPart):
 
     classname = "CapsetPart"
+    __slots__ = ()
 
     class CapabilityType(Integer16lePart):
 
         classname = "CapabilityType"
+        __slots__ = ('parser', 'pkttype')
         
         types = {1:('GENERAL', GeneralCapability),
                  2:('BITMAP', PacketPart),
@@ -1527,6 +1819,7 @@ class CapsetPart(PacketPart):
 class DemandActivePart(PacketPart):
 
     classname = "DemandActivePart"
+    __slots__ = ()
 
     def __init__(self, description, **kw):
         PacketPart.__init__(self, description, **kw)
@@ -1540,8 +1833,7 @@ class DemandActivePart(PacketPart):
         self.value.append(Integer16lePart("Capabilities length",
                                           indent=self.indent+1))
 
-        for dp in self.value:
-            data = dp.parse(data)
+        data = parse_fixed_run(self.value, data)
 
         valuelen = len(self.value)
 
@@ -1582,6 +1874,7 @@ class DemandActivePart(PacketPart):
 class ConfirmActivePart(PacketPart):
 
     classname = "ConfirmActivePart"
+    __slots__ = ()
     
     def __init__(self, description, **kw):
         PacketPart.__init__(self, description, **kw)
@@ -1596,8 +1889,7 @@ class ConfirmActivePart(PacketPart):
         self.value.append(Integer16lePart("Capabilities length",
                                           indent=self.indent+1))
 
-        for dp in self.value:
-            data = dp.parse(data)
+        data = parse_fixed_run(self.value, data)
 
         valuelen = len(self.value)
 
@@ -1629,27 +1921,27 @@ class ConfirmActivePart(PacketPart):
 class DataPDUSynchronize(PacketPart):
 
     classname = "DataPDUSynchronize"
+    __slots__ = ()
+
+    layout = Layout([("Type", Integer16lePart, None),
+                     ("Userid(?)", Integer16lePart, None)])
     
     def __init__(self, description, **kw):
         PacketPart.__init__(self, description, **kw)
         self.datatype = "RDP Data PDU Synchronize"
 
     def parse(self, data):
-        self.value.append(Integer16lePart("Type", indent=self.indent+1))
-        self.value.append(Integer16lePart("Userid(?)", indent=self.indent+1))
-
-        for dp in self.value:
-            data = dp.parse(data)
-
-        return data
+        return self.layout.parse(self, data)
 
 class DataPDUControl(PacketPart):
 
     classname = "DataPDUControl"
+    __slots__ = ()
 
     class DataPDUControlType(Enumerated):
 
         classname = "DataPDUControlType"
+        __slots__ = ()
         
         results = {1:'Request control',
                    2:'Grant control',
@@ -1660,60 +1952,50 @@ class DataPDUControl(PacketPart):
             Enumerated.__init__(self, description,
                                 dataparser=Integer16lePart, **kw)
             self.datatype = "RDP Control"
-        
+
+    # FIXME - Control id is Integer32 (not le) in rdesktop
+    layout = Layout([("Action", DataPDUControlType, None),
+                     ("Userid(?)", Integer16Part, None),
+                     ("Control id", Integer32lePart, None)])
     
     def __init__(self, description, **kw):
         PacketPart.__init__(self, description, **kw)
         self.datatype = "RDP Data PDU Control"
 
     def parse(self, data):
-        self.value.append(self.DataPDUControlType("Action",
-                                                  indent=self.indent+1))
-        self.value.append(Integer16Part("Userid(?)", indent=self.indent+1))
-        # FIXME - Integer32 (not le) in rdesktop
-        self.value.append(Integer32lePart("Control id", 
-                                        indent=self.indent+1))        
-
-        for dp in self.value:
-            data = dp.parse(data)
-
-        return data
+        return self.layout.parse(self, data)
 
 class DataPDUFont(PacketPart):
 
     classname = "DataPDUFont"
+    __slots__ = ()
+
+    layout = Layout([("Number of fonts", Integer16Part, None),
+                     ("Unknown", Integer16lePart, 0x3e),
+                     ("Unknown (Sequence?)", Integer16lePart, None),
+                     ("Entry size", Integer16lePart, 0x32)])
     
     def __init__(self, description, **kw):
         PacketPart.__init__(self, description, **kw)
         self.datatype = "RDP Data PDU Font"
 
     def parse(self, data):
-        self.value.append(Integer16Part("Number of fonts",
-                                        indent=self.indent+1))
-        self.value.append(Integer16lePart("Unknown",
-                                          indent=self.indent+1,
-                                          knvalue=0x3e))
-        self.value.append(Integer16lePart("Unknown (Sequence?)",
-                                          indent=self.indent+1))
-        self.value.append(Integer16lePart("Entry size", indent=self.indent+1,
-                                          knvalue=0x32))
-
-        for dp in self.value:
-            data = dp.parse(data)
-
-        return data
+        return self.layout.parse(self, data)
 
 class DataPDUInput(PacketPart):
 
     classname = "DataPDUInput"
+    __slots__ = ()
 
     class InputEvent(PacketPart):
 
         classname = "InputEvent"
+        __slots__ = ()
 
         class MessageType(Enumerated):
 
             classname = "MessageType"
+            __slots__ = ()
             
             results = {0:'Synchronize',
                        1:'Codepoint',
@@ -1727,44 +2009,34 @@ class DataPDUInput(PacketPart):
 
         class ScanCodePart(Integer16lePart):
             classname = "ScanCodePart"
+            __slots__ = ()
             
             def strvalue(self):
-                return Integer16lePart.strvalue(self) + " (%s)" % keys[self.value]
+                return Integer16lePart.strvalue(self) + " (%s)" % active.context.keys[self.value]
+
+        # Fixme: We should have an enumerated for the device flags.
+        layout = Layout([("Event timestamp", Time32le, None),
+                         ("Event type", MessageType, None),
+                         ("Device flags", Integer16lePart, None)])
+        key_layout = Layout([("Key number", ScanCodePart, None),
+                             ("Param #2", Integer16lePart, None)])
+        param_layout = Layout([("Param #1", Integer16lePart, None),
+                               ("Param #2", Integer16lePart, None)])
 
         def __init__(self, description, **kw):
             PacketPart.__init__(self, description, **kw)
             self.datatype = "Input event"
 
         def parse(self, data):
-            self.value.append(Time32le("Event timestamp",
-                                       indent=self.indent+1))
-            mt = self.MessageType("Event type",
-                                  indent=self.indent+1)
-            
-            self.value.append(mt)
+            data = self.layout.parse(self, data)
+            mt = self.value[1]
 
             # Stoppa in parsning av keycode hr p ntt stt. *bonk*
 
-            # Fixme: We should have an enumerated here.
-            self.value.append(Integer16lePart("Device flags",
-                                              indent=self.indent+1))
-            for dp in self.value:
-                data = dp.parse(data)
-            valuelen = len(self.value)
-            
             if 4 == mt.value:
-                self.value.append(self.ScanCodePart("Key number",
-                                                    indent=self.indent+1))
+                return self.key_layout.parse(self, data)
             else:
-                self.value.append(Integer16lePart("Param #1",
-                                                  indent=self.indent+1))
-            self.value.append(Integer16lePart("Param #2",
-                                              indent=self.indent+1))
-
-            for dp in self.value[valuelen:]:
-                data = dp.parse(data)
-
-            return data
+                return self.param_layout.parse(self, data)
     
 
     def __init__(self, description, **kw):
@@ -1792,6 +2064,7 @@ class DataPDUInput(PacketPart):
 class RDP_DATA_PDUType(Enumerated):
 
     classname = "RDP_DATA_PDUType"
+    __slots__ = ()
     
     results = {2:'Update',
                20:('Control', DataPDUControl),
@@ -1811,6 +2084,7 @@ class RDP_DATA_PDUType(Enumerated):
 class RDP_PDU_DataPart(PacketPart):
 
     classname = "RDP_PDU_DataPart"
+    __slots__ = ()
     
     def __init__(self, description, **kw):
         PacketPart.__init__(self, description, **kw)
@@ -1843,6 +2117,7 @@ class RDP_PDU_DataPart(PacketPart):
 class RDP_PDUtype(Integer16lePart):
 
     classname = "RDP_PDUtype"
+    __slots__ = ('parser', 'typestr')
     
     types = {1:('DEMAND_ACTIVE', DemandActivePart),
              3:('CONFIRM_ACTIVE', ConfirmActivePart),
@@ -1866,6 +2141,7 @@ class RDP_PDUtype(Integer16lePart):
 class SDIN_RDPData(PacketPart):
 
     classname = "SDIN_RDPData"
+    __slots__ = ()
     
     def __init__(self, description, **kw):
         PacketPart.__init__(self, description, **kw)
@@ -1893,10 +2169,12 @@ class SDIN_RDPData(PacketPart):
 class RDPLogonPart(PacketPart):
 
     classname = "RDPLogonPart"
+    __slots__ = ()
     
     class LogonFlags(Integer32lePart):
 
         classname = "LogonFlags"
+        __slots__ = ()
         
         flags = [(0x33, "LOGON_NORMAL"),
                  (0x8, "LOGON_AUTO"),
@@ -1962,16 +2240,16 @@ class RDPLogonPart(PacketPart):
 #            self.value.append(Integer16lePart("Instead of directory length", indent=self.indent+1))
 
         if 0 < len_domain.value:
-            self.value.append(UnicodeString("Domain", len_domain.value/2+1,
+            self.value.append(UnicodeString("Domain", len_domain.value//2+1,
                                             indent=self.indent+1))
         else:
             self.value.append(Integer16lePart("Instead of domain", indent=self.indent+1))
 
         if 0 < len_user.value:
-            self.value.append(UnicodeString("User", len_user.value/2+1,
+            self.value.append(UnicodeString("User", len_user.value//2+1,
                                             indent=self.indent+1))
         if logonflags.value & 0x8:
-            self.value.append(UnicodeString("Password", len_password.value/2+1,
+            self.value.append(UnicodeString("Password", len_password.value//2+1,
                                             indent=self.indent+1))
 #        self.value.append(Integer16lePart("Unknown1", indent=self.indent+1,
 #                                          knvalue=0xd806))
@@ -1992,7 +2270,7 @@ class RDPLogonPart(PacketPart):
 
 
         if 0 < len_program.value:
-            self.value.append(UnicodeString("Program", len_program.value/2+1,
+            self.value.append(UnicodeString("Program", len_program.value//2+1,
                                             indent=self.indent+1))
         else:
             self.value.append(Integer16lePart("Instead of Program, #0", indent=self.indent+1))
@@ -2001,7 +2279,7 @@ class RDPLogonPart(PacketPart):
 
         if 0 < len_directory.value:
             self.value.append(UnicodeString("Directory",
-                                            len_directory.value/2+1,
+                                            len_directory.value//2+1,
                                             indent=self.indent+1))
 
         elif 0 < len_program.value:
@@ -2021,7 +2299,7 @@ class RDPLogonPart(PacketPart):
 
         
 
-        self.value.append(UnicodeString("Client ip", iplen.value/2, indent=self.indent+1))
+        self.value.append(UnicodeString("Client ip", iplen.value//2, indent=self.indent+1))
 
         for dp in self.value[valuelen:]:
             data = dp.parse(data)
@@ -2036,7 +2314,7 @@ class RDPLogonPart(PacketPart):
             data = dllstrlen.parse(data)
             valuelen+=1
 
-            self.value.append(UnicodeString("DLL/executable used", dllstrlen.value/2, indent=self.indent+1))
+            self.value.append(UnicodeString("DLL/executable used", dllstrlen.value//2, indent=self.indent+1))
 
             self.value.append(Integer16lePart("Unknown3", knvalue=0xffc4, indent=self.indent+1))
             self.value.append(Integer16lePart("Unknown3", knvalue=0xffff,
@@ -2058,12 +2336,76 @@ class RDPLogonPart(PacketPart):
 
         return data
 
-class ClipboardData(PacketPart):
+# Flags in the header of each chunk of a virtual channel PDU. A PDU too
+# long for one chunk is sent as a first chunk, any number of middle
+# chunks (neither flag) and a last chunk.
+CHANNEL_FLAG_FIRST = 1
+CHANNEL_FLAG_LAST = 2
+
+class ChannelAssembly:
+    """The chunks of one virtual channel PDU of length bytes collected
+    so far. The bytearray is not allocated at length up front, but
+    grows as they come in, so a first chunk claiming a long PDU costs
+    nothing until the rest is sent."""
+
+    # PDUs longer than maxlength are not collected, nor chunks that
+    # would take the PDUs collected at once in a session over
+    # maxtotal, so that memory stays bounded however much is pasted.
+    # Their chunks are shown as they are.
+    maxlength = 1 << 22
+    maxtotal = 1 << 24
+
+    def __init__(self, length):
+        self.length = length
+        self.buf = bytearray()
+        self.filled = 0
+
+    def add(self, data):
+        """Append the chunk data. Returns 0 if it does not fit."""
+        end = self.filled+len(data)
+        if self.length < end:
+            return 0
+        if isinstance(data, PacketData):
+            # Its window, without copying it to bytes first.
+            data = memoryview(data.buf)[data.start:data.end]
+        self.buf+=data
+        self.filled = end
+        return 1
+
+class ChannelChunk(PacketPart):
+    """A chunk of a virtual channel PDU sent in several. Its bytes are
+    printed with the whole PDU, after the last chunk."""
+
+    classname = "ChannelChunk"
+    __slots__ = ('offset', 'total')
 
-    classname = "ClipboardData"
+    def __init__(self, description, offset, total, **kw):
+        PacketPart.__init__(self, description, **kw)
+        self.datatype = "Chunk"
+        self.owntbl = 0
+        self.offset = offset
+        self.total = total
+
+    def __len__(self):
+        return self.value
+
+    def strvalue(self):
+        return "(bytes %d-%d of %d)" % (self.offset, self.offset+self.value-1,
+                                        self.total)
+
+    def parse(self, data):
+        self.value = len(data)
+        return data[len(data):]
+
+class ClipboardPDU(PacketPart):
+    """A PDU of the cliprdr channel."""
+
+    classname = "ClipboardPDU"
+    __slots__ = ()
 
     class FormatDescription(PacketPart):
         classname = "FormatDescription"
+        __slots__ = ()
 
         def __init__(self, description, **kw):
             PacketPart.__init__(self, description, **kw)
@@ -2080,9 +2422,218 @@ class ClipboardData(PacketPart):
 
             return data
 
+    def __init__(self, description, **kw):
+        PacketPart.__init__(self, description, **kw)
+        self.datatype = "Clipboard PDU"
+
+    def parse(self, data):
+        ptype0 = Integer16lePart("Ptype0", indent=self.indent+1)
+        ptype1 = Integer16lePart("Ptype1", indent=self.indent+1)
+        self.value.append(ptype0)
+        self.value.append(ptype1)
+
+        for dp in self.value:
+            data = dp.parse(data)
+
+        valuelen = len(self.value)
+
+        if 2 == ptype0.value: # Format announce
+            remlen = Integer32lePart("Remaining length", indent=self.indent+1)
+            self.value.append(remlen)
+            valuelen+=1
+            data = remlen.parse(data)
+
+            for i in range(remlen.value//36):
+                self.value.append(self.FormatDescription("#%d" % i,
+                                                         indent=self.indent+1))
+            self.value.append(Integer32lePart("Unknown (Pad?)", indent=self.indent+1))
+
+        elif 1 == ptype0.value or 3 == ptype0.value: # First pkt from server / answer to format announce
+            remlen = Integer32lePart("Remaining length", indent=self.indent+1)
+            self.value.append(remlen)
+            valuelen+=1
+            data = remlen.parse(data)
+
+            self.value.append(Integer32lePart("Unknown (Pad?)", indent=self.indent+1))
+
+        elif 4 == ptype0.value: # Request data
+            remlen = Integer32lePart("Remaining length", indent=self.indent+1)
+            self.value.append(remlen)
+            valuelen+=1
+            data = remlen.parse(data)
+
+            self.value.append(Integer32lePart("Requested format code", indent=self.indent+1))
+            self.value.append(Integer32lePart("Unknown (Pad?)", indent=self.indent+1))
+
+        elif 5 == ptype0.value: # Send data
+            remlen = Integer32lePart("Remaining length", indent=self.indent+1)
+            self.value.append(remlen)
+            valuelen+=1
+            data = remlen.parse(data)
+
+            self.value.append(PacketPart("Clipboard data", indent=self.indent+1,
+                                         maxlength=remlen.value))
+            if len(data) > remlen.value:
+                self.value.append(Integer32lePart("Unknown (Pad?)", indent=self.indent+1))
+
+        for dp in self.value[valuelen:]:
+            data = dp.parse(data)
+
+        return data
+
+class RdpdrPDU(PacketPart):
+    """A PDU of the rdpdr (device redirection) channel. Only the
+    header is decoded."""
+
+    classname = "RdpdrPDU"
+    __slots__ = ()
+
+    class Component(Integer16lePart):
+
+        classname = "RdpdrComponent"
+        __slots__ = ()
+
+        types = {0x4472:'CORE',
+                 0x5052:'PRINTER'}
+
+        def strvalue(self):
+            return Integer16lePart.strvalue(self)+" "+\
+                   self.types.get(self.value, "Unknown")
+
+    class PacketId(Integer16lePart):
+
+        classname = "RdpdrPacketId"
+        __slots__ = ()
+
+        types = {0x496e:'SERVER_ANNOUNCE',
+                 0x4343:'CLIENTID_CONFIRM',
+                 0x434e:'CLIENT_NAME',
+                 0x4441:'DEVICELIST_ANNOUNCE',
+                 0x6472:'DEVICE_REPLY',
+                 0x4952:'DEVICE_IOREQUEST',
+                 0x4943:'DEVICE_IOCOMPLETION',
+                 0x5350:'SERVER_CAPABILITY',
+                 0x4350:'CLIENT_CAPABILITY',
+                 0x444d:'DEVICELIST_REMOVE',
+                 0x554c:'USER_LOGGEDON',
+                 0x5043:'PRN_CACHE_DATA',
+                 0x5543:'PRN_USING_XPS'}
+
+        def strvalue(self):
+            return Integer16lePart.strvalue(self)+" "+\
+                   self.types.get(self.value, "Unknown")
+
+    layout = Layout([("Component", Component, None),
+                     ("Packet id", PacketId, None)])
+
+    def __init__(self, description, **kw):
+        PacketPart.__init__(self, description, **kw)
+        self.datatype = "Device redirection PDU"
+
+    def parse(self, data):
+        data = self.layout.parse(self, data)
+        if 0 < len(data):
+            body = PacketPart("Device redirection data",
+                              indent=self.indent+1)
+            self.value.append(body)
+            data = body.parse(data)
+        return data
+
+class RdpsndPDU(PacketPart):
+    """A PDU of the rdpsnd (sound) channel. Only the header is
+    decoded. The wave data following a WAVE PDU has no header of its
+    own, its first four bytes are padding."""
+
+    classname = "RdpsndPDU"
+    __slots__ = ()
+
+    class MessageType(Integer8Part):
+
+        classname = "RdpsndMessageType"
+        __slots__ = ()
+
+        types = {0x01:'CLOSE',
+                 0x02:'WAVE',
+                 0x03:'SETVOLUME',
+                 0x04:'SETPITCH',
+                 0x05:'WAVECONFIRM',
+                 0x06:'TRAINING',
+                 0x07:'FORMATS',
+                 0x08:'CRYPTKEY',
+                 0x09:'WAVEENCRYPT',
+                 0x0a:'UDPWAVE',
+                 0x0b:'UDPWAVELAST',
+                 0x0c:'QUALITYMODE',
+                 0x0d:'WAVE2'}
+
+        def strvalue(self):
+            return "0x%.2x (%d) %s" % (self.value, self.value,
+                                       self.types.get(self.value, "Unknown"))
+
+    layout = Layout([("Message type", MessageType, None),
+                     ("Pad", Integer8Part, None),
+                     ("Body size", Integer16lePart, None)])
+
+    def __init__(self, description, **kw):
+        PacketPart.__init__(self, description, **kw)
+        self.datatype = "Sound PDU"
+
+    def parse(self, data):
+        data = self.layout.parse(self, data)
+        if 0 < len(data):
+            body = PacketPart("Sound data", indent=self.indent+1)
+            self.value.append(body)
+            data = body.parse(data)
+        return data
+
+# The decoders of the PDUs of virtual channels, by the channel name
+# the client gave in TAG_CLI_CHANNELS. Each is a PacketPart class,
+# made with a description and indent, that is handed the whole PDU
+# however many chunks it was sent in. PDUs of other channels are
+# shown as raw data.
+channeldecoders = {'cliprdr':ClipboardPDU,
+                   'rdpdr':RdpdrPDU,
+                   'rdpsnd':RdpsndPDU}
+
+def register_channel_decoder(name, decoder):
+    """Decode the PDUs of the virtual channel called name with
+    decoder, a PacketPart class (see channeldecoders)."""
+    channeldecoders[name] = decoder
+
+def channel_name(channelid):
+    """Return the name of the virtual channel channelid in the channel
+    table of the active context, or None if it is not in it. Without
+    the channel ids sent by the server, they are taken to be handed
+    out in table order from 1004, as servers do."""
+    context = active.context
+    index = context.channelids.get(channelid)
+    if None == index and 0 == len(context.channelids):
+        index = channelid-1004
+    return context.rdp_channels.get(index, (None, 0))[0]
+
+def is_virtual_channel(channelid):
+    """Whether channelid is a virtual channel in the active context:
+    one of the channel ids sent by the server, or without them, any id
+    after the I/O channel (1003)."""
+    channelids = active.context.channelids
+    if 0 < len(channelids):
+        return channelid in channelids
+    return 1003 < channelid
+
+class VirtualChannelData(PacketPart):
+    """The data sent on a virtual channel: a chunk of a PDU, with its
+    header. A PDU in a single chunk is decoded right away by the
+    decoder registered for the channel name in channeldecoders. The
+    chunks of longer PDUs are collected per channel and direction,
+    and the PDU is decoded once the last chunk is in."""
+
+    classname = "VirtualChannelData"
+    __slots__ = ('channelkey', 'name')
+
     class ChannelDataFlags(Integer32lePart):
 
         classname = "ChannelDataFlags"
+        __slots__ = ()
 
         flags =  [(1, "FLAG_FIRST"),
                   (2, "FLAG_LAST"),
@@ -2101,95 +2652,116 @@ class ClipboardData(PacketPart):
 
             return ret        
 
-    def __init__(self, description, **kw):
-        PacketPart.__init__(self, description, **kw)
-        self.datatype = "Clipboard data"
+    def __init__(self, channelid, origin, **kw):
+        self.name = channel_name(channelid)
+        PacketPart.__init__(self, self.name or "", **kw)
+        self.datatype = "Virtual channel data"
+        # What the chunks of this channel and direction are collected
+        # under in the context.
+        self.channelkey = (channelid, origin)
 
     def parse(self, data):
-        CHANNEL_FLAG_FIRST = 1
-        CHANNEL_FLAG_LAST = 2
-        cdlength = Integer32lePart("Clpbrd data length",
-                                   indent=self.indent+1)
+        length = Integer32lePart("Length", indent=self.indent+1)
         flags = self.ChannelDataFlags("Flags", 
                                  indent=self.indent+1)
 
-        self.value = [cdlength, flags]
+        self.value = [length, flags]
 
         for dp in self.value:
             data = dp.parse(data)
 
-        valuelen = len(self.value)
-
-        if flags.value == 2: # Last packet:
-            self.value.append(PacketPart("Clipboard data, last packet of several", indent=self.indent+1))            
-        elif flags.value & 0x0f ==  0x3: # Single write op.
-            ptype0 = Integer16lePart("Ptype0", indent=self.indent+1)
-            ptype1 = Integer16lePart("Ptype1", indent=self.indent+1)
-            self.value.append(ptype0)
-            self.value.append(ptype1)
-
-            for dp in self.value[valuelen:]:
-                data = dp.parse(data)
-
-            valuelen = len(self.value)
-
-            if 2 == ptype0.value: # Format announce
-                remlen = Integer32lePart("Remaining length", indent=self.indent+1)
-                self.value.append(remlen)
-                valuelen+=1
-                data = remlen.parse(data)
-
-                for i in range(remlen.value/36):
-                    self.value.append(self.FormatDescription("#%d" % i,
-                                                             indent=self.indent+1))
-                self.value.append(Integer32lePart("Unknown (Pad?)", indent=self.indent+1))
-
-            elif 1 == ptype0.value or 3 == ptype0.value: # First pkt from server / answer to format announce
-                remlen = Integer32lePart("Remaining length", indent=self.indent+1)
-                self.value.append(remlen)
-                valuelen+=1
-                data = remlen.parse(data)
-
-                self.value.append(Integer32lePart("Unknown (Pad?)", indent=self.indent+1))
+        if CHANNEL_FLAG_FIRST|CHANNEL_FLAG_LAST == flags.value & 0x3:
+            # Single write op.
+            return self.parsepdu("", data)
 
-            elif 4 == ptype0.value: # Request data
-                remlen = Integer32lePart("Remaining length", indent=self.indent+1)
-                self.value.append(remlen)
-                valuelen+=1
-                data = remlen.parse(data)
+        return self.parsechunk(length.value, flags.value, data)
 
-                self.value.append(Integer32lePart("Requested format code", indent=self.indent+1))
-                self.value.append(Integer32lePart("Unknown (Pad?)", indent=self.indent+1))
-
-            elif 5 == ptype0.value: # Send data
-                remlen = Integer32lePart("Remaining length", indent=self.indent+1)
-                self.value.append(remlen)
-                valuelen+=1
-                data = remlen.parse(data)
-
-                if remlen.value > 1600:
-                    datalen = 1592
-                else:
-                    datalen = remlen.value
-
-                self.value.append(PacketPart("Clipboard data", indent=self.indent+1,
-                                             maxlength=datalen))
-                if remlen.value < 1600:
-                    self.value.append(Integer32lePart("Unknown (Pad?)", indent=self.indent+1))
-                
-                
-        elif (not (flags.value & CHANNEL_FLAG_FIRST) and not (flags.value & CHANNEL_FLAG_LAST)) or (flags.value & CHANNEL_FLAG_LAST):
-            self.value.append(PacketPart("Clipboard data", indent=self.indent+1))
-
-        for dp in self.value[valuelen:]:
-            data = dp.parse(data)
+    def parsepdu(self, description, data):
+        """Decode a whole PDU of the channel and return the data left
+        over."""
+        decoder = channeldecoders.get(self.name)
+        if None == decoder:
+            pdu = PacketPart("%s data %s" % (self.name or "Channel",
+                                             description),
+                             indent=self.indent+1)
+        else:
+            pdu = decoder(description, indent=self.indent+1)
+        self.value.append(pdu)
+        return pdu.parse(data)
+
+    def parsechunk(self, length, flags, data):
+        """Collect a chunk of a PDU sent in several, and decode the PDU
+        when the last chunk is in. Chunks that do not add up to a PDU
+        are shown as they are."""
+        chunks = active.context.channelchunks
+        assembly = chunks.pop(self.channelkey, None)
+        if flags & CHANNEL_FLAG_FIRST:
+            if None != assembly:
+                self.dropassembly(assembly)
+            assembly = None
+            if length <= ChannelAssembly.maxlength:
+                assembly = ChannelAssembly(length)
+
+        if None != assembly:
+            # A last chunk must complete the PDU, and what is collected
+            # of the PDUs of the session must stay within maxtotal.
+            end = assembly.filled+len(data)
+            if assembly.length != length or \
+               flags & CHANNEL_FLAG_LAST and end != length or \
+               ChannelAssembly.maxtotal < \
+               end+sum([other.filled for other in chunks.values()]) or \
+               not assembly.add(data):
+                self.dropassembly(assembly)
+                assembly = None
+
+        if flags & CHANNEL_FLAG_FIRST:
+            which = "first"
+        elif flags & CHANNEL_FLAG_LAST:
+            which = "last"
+        else:
+            which = "middle"
+        name = self.name or "Channel"
+        if None == assembly:
+            chunk = PacketPart("%s data, %s chunk of several" % (name, which),
+                               indent=self.indent+1)
+            self.value.append(chunk)
+            return chunk.parse(data)
+
+        chunk = ChannelChunk("%s data, %s of several" % (name, which),
+                             assembly.filled-len(data), length,
+                             indent=self.indent+1)
+        self.value.append(chunk)
+        data = chunk.parse(data)
+
+        if not flags & CHANNEL_FLAG_LAST:
+            chunks[self.channelkey] = assembly
+        else:
+            rest = self.parsepdu("(reassembled)", PacketData(assembly.buf))
+            if 0 < len(rest):
+                remaining = PacketPart("Remaining %s data" % name,
+                                       indent=self.indent+1)
+                self.value.append(remaining)
+                remaining.parse(rest)
 
         return data
+
+    def dropassembly(self, assembly):
+        """Show what was collected of a PDU that will not be complete,
+        as its chunks were only summarized."""
+        if 0 == assembly.filled:
+            return
+        part = PacketPart("%s data, incomplete (%d of %d bytes)" % \
+                          (self.name or "Channel", assembly.filled,
+                           assembly.length),
+                          indent=self.indent+1)
+        self.value.append(part)
+        part.parse(PacketData(assembly.buf))
         
         
 class SDINPart(PacketPart):
 
     classname = "SDINPart"
+    __slots__ = ('channelid', 'flags')
 
     def __init__(self, description, **kw):
         PacketPart.__init__(self, description, **kw)
@@ -2209,9 +2781,16 @@ class SDINPart(PacketPart):
         for dp in self.value:
             data = dp.parse(data)
 
-        global currentchannel
-        currentchannel = self.channelid.value            
+        active.context.currentchannel = self.channelid.value            
 
+        # The body always eats the rest of the packet, so the header is
+        # all that is needed to go on (or to filter on the channel).
+        self.flags = flags
+        self.deferparse(self.parsebody, data)
+        return data[len(data):]
+
+    def parsebody(self, data):
+        flags = self.flags
         valuelen = len(self.value)
 
         if flags.value & 0x0008: # Encrypted == have signature
@@ -2220,8 +2799,10 @@ class SDINPart(PacketPart):
 
         if flags.value & 0x0080: # License packet.
             self.value.append(LicensePart("", indent=self.indent+1))
-        elif 1003 < self.channelid.value:
-            self.value.append(ClipboardData("", indent=self.indent+1))
+        elif is_virtual_channel(self.channelid.value):
+            self.value.append(VirtualChannelData(self.channelid.value,
+                                                 "Server",
+                                                 indent=self.indent+1))
         else:
             self.value.append(SDIN_RDPData("", indent=self.indent+1))
 
@@ -2241,12 +2822,10 @@ class SDINPart(PacketPart):
             data = rem_data.parse(data)
             self.value.append(rem_data)
 
-
-        return data
-
 class SDRQPart(PacketPart):
 
     classname = "SDRQPart"
+    __slots__ = ('channelid',)
 
     def __init__(self, description, **kw):
         PacketPart.__init__(self, description, **kw)
@@ -2266,8 +2845,7 @@ class SDRQPart(PacketPart):
         for dp in self.value:
             data = dp.parse(data)
 
-        global currentchannel
-        currentchannel = self.channelid.value            
+        active.context.currentchannel = self.channelid.value            
 
         valuelen = len(self.value)
 
@@ -2284,8 +2862,10 @@ class SDRQPart(PacketPart):
 
             elif flags.value & 0x0080: # License neg.
                 self.value.append(LicensePart("", indent=self.indent+1))
-            elif 1003 < self.channelid.value:
-                self.value.append(ClipboardData("", indent=self.indent+1))
+            elif is_virtual_channel(self.channelid.value):
+                self.value.append(VirtualChannelData(self.channelid.value,
+                                                     "Client",
+                                                     indent=self.indent+1))
             else:
                 self.value.append(SDIN_RDPData("", indent=self.indent+1))
 
@@ -2314,10 +2894,12 @@ class SDRQPart(PacketPart):
 class MCSPacket(PacketPart):
 
     classname = "MCSPacket"
+    __slots__ = ()
 
     class MCStype8(Integer8Part):
 
         classname = "MCStype8"
+        __slots__ = ('parser', 'typestr')
         
         types = {1:('EDRQ', EDRQPart), 
                  8:('DPUM', PacketPart), 
@@ -2342,6 +2924,7 @@ class MCSPacket(PacketPart):
     class MCStype16(Integer16Part):
 
         classname = "MCStype16"
+        __slots__ = ()
         
         types = {0x7f65:'Connect Initial',
                  0x7f66:'Connect Response'}
@@ -2388,10 +2971,12 @@ class MCSPacket(PacketPart):
 class ISOPacket(PacketPart):
 
     classname = "TPDU"
+    __slots__ = ()
 
     class ISOPacketType(Integer8Part):
 
         classname = "TPDU"
+        __slots__ = ()
         
         types = {0xe0:'Connection request',
                  0xd0:'Connection confirm',
@@ -2444,6 +3029,7 @@ class ISOPacket(PacketPart):
 class TPKT(PacketPart):
 
     classname = "TPKT"
+    __slots__ = ()
     
     def __init__(self, description, **kw):
         PacketPart.__init__(self, description, **kw)
@@ -2482,6 +3068,7 @@ class TPKT(PacketPart):
 class OrdersPart(PacketPart):
 
     classname = "OrdersPart"
+    __slots__ = ()
     
     def __init__(self, description, **kw):
         PacketPart.__init__(self, description, **kw)
@@ -2507,35 +3094,35 @@ class OrdersPart(PacketPart):
 class BitmapUpdatePart(PacketPart):
 
     classname = "BitmapUpdatePart"
+    __slots__ = ()
     
     class UpdateSubPart(PacketPart):
 
         classname = "UpdateSubPart"
+        __slots__ = ()
+
+        layout = Layout([("Pad?", Integer16lePart, None),
+                         ("Left", Integer16lePart, None),
+                         ("Top", Integer16lePart, None),
+                         ("Right", Integer16lePart, None),
+                         ("Bottom", Integer16lePart, None),
+                         ("Width", Integer16lePart, None),
+                         ("Height", Integer16lePart, None),
+                         ("bpp", Integer16lePart, None),
+                         ("Compress", Integer16lePart, None),
+                         ("Bufsize", Integer16lePart, None)])
         
         def __init__(self, description, **kw):
             PacketPart.__init__(self, description, **kw)
             self.datatype = "Bitmap update subpart"
 
         def parse(self, data):
-            pad = Integer16lePart("Pad?", indent=self.indent+1)
-            left = Integer16lePart("Left", indent=self.indent+1)
-            top = Integer16lePart("Top", indent=self.indent+1)
-            right = Integer16lePart("Right", indent=self.indent+1)
-            bottom = Integer16lePart("Bottom", indent=self.indent+1)
-            width = Integer16lePart("Width", indent=self.indent+1)
-            height = Integer16lePart("Height", indent=self.indent+1)
-            bpp = Integer16lePart("bpp", indent=self.indent+1)
-            compress = Integer16lePart("Compress", indent=self.indent+1)
-            bufsize = Integer16lePart("Bufsize", indent=self.indent+1)
-
-            self.value = [pad, left, top, right, bottom, width,
-                          height, bpp, compress, bufsize]
-
-            for dp in self.value:
-                data = dp.parse(data)
+            data = self.layout.parse(self, data)
+            (pad, left, top, right, bottom, width,
+             height, bpp, compress, bufsize) = self.value
 
             bmpdata = None
-            Bpp = (bpp.value+7) / 8
+            Bpp = (bpp.value+7) // 8
 
             if not compress.value:
                 bmpdata = PacketPart("BMP data (not compressed)", indent=self.indent+1,
@@ -2592,10 +3179,12 @@ class BitmapUpdatePart(PacketPart):
 class RDP5Packet(PacketPart):
 
     classname = "RDP5Packet"
+    __slots__ = ('startbyte',)
 
     class RDP5StartByte(Integer8Part):
 
         classname = "RDP5StartByte"
+        __slots__ = ()
         
         def strvalue(self):
             ret = Integer8Part.strvalue(self)
@@ -2607,6 +3196,7 @@ class RDP5Packet(PacketPart):
     class RDP5PacketType(Enumerated):
 
         classname = "RDP5PacketType"
+        __slots__ = ()
         
         def __init__(self, description, **kw):
             Enumerated.__init__(self, description, **kw)
@@ -2663,9 +3253,11 @@ class RDP5Packet(PacketPart):
             self.value.append(partlen)
             data = partlen.parse(data)
 
+            # All part parsers eat exactly partlen bytes.
             partdata = pt.parser("Part data", indent=self.indent+3,
                                  maxlength=partlen.value)
-            data = partdata.parse(data)
+            partdata.deferparse(partdata.parse, data)
+            data = data[partlen.value:]
             self.value.append(partdata)
 
         remaining_data = PacketPart("Remaining data",
@@ -2710,68 +3302,168 @@ class LaTeXindex:
 
         
 
-clsrefs = {}
-
-
 def create_tbl(ofile, p, origin, totpacketno, packetno,
                location, classnames, infilename):
-    if "Server" == origin:
-        origin = "S"
+    TblWriter(ofile, location, classnames,
+              infilename).writepacket(p, None, origin, totpacketno, packetno)
+
+def create_latex(ofile, p, origin, totpacketno, packetno,
+                 location, classnames, infilename):
+    LatexWriter(ofile, location, classnames,
+                infilename).writepacket(p, None, origin, totpacketno,
+                                        packetno)
+
+def is_composite(part):
+    """Whether str(part) is the head of part followed by each of its
+    subparts, so that it can be written a subpart at a time."""
+    return isinstance(part, PacketPart) and \
+           type([]) == type(part.value) and 0 < len(part.value) and \
+           PacketPart.strvalue == part.__class__.strvalue
+
+def write_str(write, part):
+    """Write str(part) with write, a fragment at a time, instead of
+    first building the string for the whole subtree."""
+    if isinstance(part, RawData):
+        sep = ""
+        for line in part.strlines():
+            write(sep+line)
+            sep = "\n"+" "*part.indent
+    elif is_composite(part):
+        write(part.strhead())
+        write_strvalue(write, part)
     else:
-        origin = "C"
+        write(str(part))
+
+def write_strvalue(write, part):
+    """Write part.strvalue() with write, like write_str."""
+    if is_composite(part):
+        for subpart in part.value:
+            write("\n"+" "*part.indent)
+            write_str(write, subpart)
+    else:
+        write(part.strvalue())
 
-    class PlaceHolder(PacketPart):
-        def strvalue(self):
-            return self.value
+class TxtWriter:
+    """Writes packets as text. Parts are written to the file one at a
+    time as the tree is walked, instead of first building str(p) for
+    the whole packet."""
 
-    def rec(part, res, packetno):
-        if type([]) == type(part.value):
-            newvalue = []
-            partno = 0
-            for subpart in part.value:
-                if isinstance(subpart, PacketPart) and subpart.owntbl:
-                    subpart.packetno = "%s%d" % (packetno, partno)
-                    res.append(subpart)
-                    rec(subpart, res, "%s%d-" % (packetno, partno))
+    def __init__(self, outfile, quiet=0):
+        self.outfile = outfile
+        self.quiet = quiet
 
-                    placeholder = PlaceHolder(subpart.description)
-                    placeholder.datatype = subpart.datatype
-                    placeholder.value = "See %s%s%d" % (origin, packetno, partno)
-                    newvalue.append(placeholder)
+    def stream(self, part):
+        """Write str(part)."""
+        write_str(self.outfile.write, part)
 
-                    partno+=1
-                else:
-                    newvalue.append(subpart)
-            part.value = newvalue
+    def write(self, part):
+        self.stream(part)
+        self.outfile.write("\n")
 
-    
-    if 0 == totpacketno:
-        return
+    def writepacket(self, p, headerline, origin, totpacketno, packetno):
+        if not self.quiet:
+            self.outfile.write(headerline)
+        self.write(p)
 
-    res = [p]
-    p.packetno = packetno
-    rec(p, res, "%d-" % packetno)
-
-    outfile = None
-
-    for ppart in res:
-        if location:
-            if outfile:
-                outfile.close()
-            if classnames:
-                num = 0
-                if clsrefs.has_key(ppart.classname):
-                    num = clsrefs[ppart.classname]
-                    clsrefs[ppart.classname]+=1
-                else:
-                    clsrefs[ppart.classname]=1
-                path = os.path.join(location, "%s-%d-%s%d-%s-%d.tbl" % (infilename.replace(".", "-"), totpacketno, origin, packetno, ppart.classname, num))
+    def writeunknown(self, line):
+        if not self.quiet:
+            self.outfile.write("Unknown data: %s" % line)
+
+class TableReference(PacketPart):
+    """Stands in for a part with a table of its own in the table of
+    the part it belongs to."""
+
+    classname = "TableReference"
+    __slots__ = ()
+
+    def strvalue(self):
+        return self.value
+
+class TblWriter(TxtWriter):
+    """Writes packets as tbl tables: one for the packet and one for
+    each part of it with a table of its own (owntbl), which is
+    referred to where it would have been. The tables are written to
+    outfile, or with a location to a file each there. Each row is
+    written a fragment at a time by the part it is for, see
+    PacketPart.tbl."""
+
+    suffix = "tbl"
+    # What a part with a table of its own is replaced by, from the
+    # origin and the packet number of the part.
+    reference = "See %s%s%d"
+
+    def __init__(self, outfile, location, classnames, infilename,
+                 encoding='latin-1'):
+        TxtWriter.__init__(self, outfile)
+        self.location = location
+        self.classnames = classnames
+        self.infilename = infilename
+        # Of the files written in location.
+        self.encoding = encoding
+
+    def tables(self, p, origin, packetno):
+        """Return p and the parts under it with a table of their own,
+        in the order their tables are written, numbered in packetno."""
+        res = [p]
+        p.packetno = packetno
+        self.splittables(p, res, origin, "%d-" % packetno)
+        return res
+
+    def splittables(self, part, res, origin, packetno):
+        if type([]) != type(part.value):
+            return
+        newvalue = []
+        partno = 0
+        for subpart in part.value:
+            if isinstance(subpart, PacketPart) and subpart.owntbl:
+                subpart.packetno = "%s%d" % (packetno, partno)
+                res.append(subpart)
+                self.splittables(subpart, res, origin,
+                                 "%s%d-" % (packetno, partno))
+
+                reference = TableReference(subpart.description)
+                reference.datatype = subpart.datatype
+                reference.value = self.reference % (origin, packetno, partno)
+                newvalue.append(reference)
+
+                partno+=1
             else:
-                path = os.path.join(location, "%s%s.tbl" % (origin, ppart.packetno))
-            outfile = open(path, 'w')
+                newvalue.append(subpart)
+        part.value = newvalue
+
+    def tablename(self, part, origin, totpacketno, packetno):
+        """Return the name of the file in location the table of part
+        is written to."""
+        if not self.classnames:
+            return "%s%s.%s" % (origin, part.packetno, self.suffix)
+        clsrefs = active.context.clsrefs
+        num = clsrefs.get(part.classname, 0)
+        clsrefs[part.classname] = num+1
+        return "%s-%d-%s%d-%s-%d.%s" % (self.infilename.replace(".", "-"),
+                                        totpacketno, origin, packetno,
+                                        part.classname, num, self.suffix)
+
+    def writepacket(self, p, headerline, origin, totpacketno, packetno):
+        if 0 == totpacketno:
+            return
+        if "Server" == origin:
+            origin = "S"
         else:
-            outfile = ofile
-        print >> outfile, """
+            origin = "C"
+        for part in self.tables(p, origin, packetno):
+            if not self.location:
+                self.writetable(self.outfile.write, part, origin)
+                continue
+            table = open(os.path.join(self.location,
+                                      self.tablename(part, origin,
+                                                     totpacketno, packetno)),
+                         'w', encoding=self.encoding)
+            self.writetable(table.write, part, origin)
+            table.close()
+
+    def writetable(self, write, part, origin):
+        """Write the table of part with write."""
+        write("""
 .TS
 box;
 lB| cB s s s s
@@ -2780,210 +3472,1520 @@ r l l l l l.
 %s%s (%s)\t%s %s\t
 _
 Offset\tDatatype\tDescription\tExpected value\tValue\t
-_""" % (origin, ppart.packetno, ppart.classname, ppart.datatype, ppart.description)
+_
+""" % (origin, part.packetno, part.classname, part.datatype, part.description))
 
-        s = ""
-        offset = 0
-        if type([]) == type(ppart.value):
-            for subpart in ppart.value:
+        if type([]) == type(part.value):
+            offset = 0
+            for subpart in part.value:
                 if type("") == type(subpart):
-                    print >> outfile, "(str)\t\t\t%s\t" % (subpart)
+                    write("(str)\t\t\t%s\t\n" % subpart)
+                elif isinstance(subpart, RawData):
+                    for line in subpart.lines():
+                        write("%d\t%s\n" % (offset, subpart.tblline(line)))
+                        offset+=len(line)
                 else:
-                    print >> outfile, "%d\t%s" % (offset,
-                                                  subpart.tblvalue(offset=offset))
+                    write("%d\t" % offset)
+                    subpart.tbl(write, offset)
+                    write("\n")
                     offset+=len(subpart)
-                    
         else:
-            s =  "off\t%s\t%s\t" % (ppart.datatype,
-                                    ppart.description)
-            if None != ppart.knvalue:
-                s+=str(ppart.knvalue)
-            s+="\t%s\t" % ppart.value
-            print >> outfile, s
-        print >> outfile, ".TE\n"
-
+            write("off\t%s\t%s\t" % (part.datatype, part.description))
+            if None != part.knvalue:
+                write(str(part.knvalue))
+            write("\t%s\t\n" % part.value)
+        write(".TE\n\n")
+
+    def writeunknown(self, line):
+        pass
+
+class LatexWriter(TblWriter):
+    """Writes packets as LaTeX tables, each to a file of its own in
+    location, like TblWriter does with a location. The tables of each
+    packet are put together in a summary of it there."""
+
+    suffix = "tex"
+    reference = "\\pktref{%s%s%d}"
+
+    def writepacket(self, p, headerline, origin, totpacketno, packetno):
+        if 0 == totpacketno:
+            return
+        if "Server" == origin:
+            origin = "S"
+        else:
+            origin = "C"
+        summaryfile = open(os.path.join(self.location, "%s-%d-summary.tex" % \
+                                        (self.infilename.replace(".", "-"),
+                                         totpacketno)),
+                           'w', encoding=self.encoding)
+        summaryfile.write("\n\\begin{tabular}{l}\n")
+
+        res = self.tables(p, origin, packetno)
+        for part in res:
+            fname = self.tablename(part, origin, totpacketno, packetno)
+            table = open(os.path.join(self.location, fname), 'w',
+                         encoding=self.encoding)
+            self.writetable(lambda s: table.write(LaTeX_escape(s)), part,
+                            origin)
+            table.close()
+            if part is not res[-1]:
+                summaryfile.write("\\input{%s}\\\\[\\betweenpktheight]\n" % \
+                                  os.path.join("figures", "pktfigs", fname))
+            else:
+                summaryfile.write("\\input{%s}\\\\\n" % \
+                                  os.path.join("figures", "pktfigs", fname))
 
-def create_latex(ofile, p, origin, totpacketno, packetno,
-                 location, classnames, infilename):
-    if "Server" == origin:
-        origin = "S"
-    else:
-        origin = "C"
+        summaryfile.write("\n\\end{tabular}\n")
+        summaryfile.close()
 
-    class PlaceHolder(PacketPart):
-        def strvalue(self):
-            return self.value
+    def writetable(self, write, part, origin):
+        write("\\pkttab{%s%s}{%s %s}{\n\n" % (origin, part.packetno,
+                                             part.datatype,
+                                             part.description))
 
-    def rec(part, res, packetno):
         if type([]) == type(part.value):
-            newvalue = []
-            partno = 0
+            offset = 0
             for subpart in part.value:
-                if isinstance(subpart, PacketPart) and subpart.owntbl:
-                    subpart.packetno = "%s%d" % (packetno, partno)
-                    res.append(subpart)
-                    rec(subpart, res, "%s%d-" % (packetno, partno))
-
-                    placeholder = PlaceHolder(subpart.description)
-                    placeholder.datatype = subpart.datatype
-                    placeholder.value = "\pktref{%s%s%d}" % (origin,
-                                                             packetno,
-                                                             partno)
-                    newvalue.append(placeholder)
-
-                    partno+=1
+                if type("") == type(subpart):
+                    write("(str)&&&&%s\\\\\n" % subpart)
+                elif isinstance(subpart, RawData):
+                    for line in subpart.lines():
+                        write("%d & %s\n" % (offset, subpart.latexline(line)))
+                        offset+=len(line)
                 else:
-                    newvalue.append(subpart)
-            part.value = newvalue
-
-    
-    if 0 == totpacketno:
-        return
+                    write("%d & " % offset)
+                    subpart.latex(write, offset)
+                    write("\n")
+                    offset+=len(subpart)
+        else:
+            write("off & %s & %s & " % (part.datatype, part.description))
+            if None != part.knvalue:
+                write(str(part.knvalue))
+            write("& %s \\\\\n" % part.value)
+        write("}\n\n")
+
+def decode_hexdump(columns):
+    """Decode the hex columns (line[5:53]) of the lines of an rdpproxy
+    hexdump into the bytes they describe, in one pass over the whole
+    packet."""
+    return bytes.fromhex("".join(columns))
+
+hexdumpchars = bytes([(ord("."), i)[0x20 <= i < 0x7f] for i in range(256)])
+
+def format_hexdump(data):
+    """Return data as rdpproxy's hexdump() prints it."""
+    data = bytes(data)
+    lines = []
+    for offset in range(0, len(data), 16):
+        line = data[offset:offset+16]
+        lines.append("%04x %-48s%s\n" % (offset, line.hex(' ')+" ",
+                                         line.translate(hexdumpchars).decode('latin-1')))
+    return "".join(lines)
+
+def packet_bytes(columns, lines=None):
+    """Return the bytes of a packet record, or of the first lines (of
+    16 bytes) of it. Records from binary captures carry the bytes
+    themselves instead of hex columns."""
+    if isinstance(columns, (bytes, bytearray)):
+        if None == lines:
+            return columns
+        return columns[:16*lines]
+    if None != lines:
+        columns = columns[:lines]
+    return decode_hexdump(columns)
+
+def header_channel(pkttype, head, current):
+    """Return the channel parsing a packet would leave in currentchannel,
+    judging from its first bytes (head) only, or None when that takes a
+    full parse. current is returned for packets carrying no channel id.
+    MCS connect packets always get the full parse, since the channel
+    table is built from them."""
+    if "TPKT" != pkttype:
+        return current
+    if len(head) < 5:
+        return None
+    if 2 != head[4]: # Not an X.224 data TPDU, no MCS in it.
+        return current
+    if len(head) < 8:
+        return None
+    mcstype = head[7] >> 2
+    if 0x1f == mcstype:
+        return None
+    # Offset of the channel id in CJRQ, CJCF, SDRQ and SDIN.
+    offset = {14:10, 15:13, 25:10, 26:10}.get(mcstype)
+    if None == offset:
+        return current
+    if len(head) < offset+2:
+        return None
+    return head[offset] << 8 | head[offset+1]
+
+pktre = re.compile("#([0-9]*?), #([0-9]*?) from (Server|Client), type (TPKT|RDP5), l: ([0-9]*), (?:(?:read [0-9]* bytes|faked), session ([0-9]+))?")
+databeginre = re.compile("^0000 [0-9]{2} ")
+
+def read_packet(infile, headerline, mo):
+    """Read the hexdump following headerline, which matched pktre as
+    mo, and return the record for the packet (see read_rdpproxy)."""
+    totpacketno = int(mo.group(1))
+    partpacketno = int(mo.group(2))
+    part = mo.group(3)
+    pkttype = mo.group(4)
+    pktlength = int(mo.group(5))
+    line = infile.readline()
+    while None ==  databeginre.search(line): # Unknown data, skip.
+        line = infile.readline()
+    # We are now expecting pktlength bytes of data
+    columns = [line[5:53]]
+    lines = pktlength // 16
+    if pktlength % 16:
+        lines+=1
+    lines-=1
+    for i in range(lines):
+        columns.append(infile.readline()[5:53])
+    return (headerline, part, totpacketno, partpacketno, pkttype, columns,
+            None, header_session(mo))
+
+def header_session(mo):
+    """The session a header line that matched pktre as mo is tagged
+    with, or None for an untagged one."""
+    if None != mo.group(6):
+        return int(mo.group(6))
+    return None
+
+def read_rdpproxy(infile):
+    """Read an rdpproxy capture. For each packet, yield (headerline,
+    origin, totpacketno, partpacketno, pkttype, columns, timestamp,
+    session), where columns are the hex columns of its hexdump lines.
+    Text captures have no timestamps, they are None. session is the
+    session the header line is tagged with (", session N" at its end,
+    written by rdprelay.py), or None. Any other line is yielded as a
+    tuple of its own."""
+    line = infile.readline()
+    while line:
+        mo = pktre.search(line)
+        if None != mo:
+            yield read_packet(infile, line, mo)
+        else: # Unknown data line.
+            yield (line,)
 
-    res = [p]
-    p.packetno = packetno
-    rec(p, res, "%d-" % packetno)
+        line = infile.readline()
 
-    outfile = None
+class HexdumpFramer:
+    """read_rdpproxy turned inside out: feed it the capture in pieces
+    of any size, and it returns the records completed by each piece."""
 
-    summaryfile = open(os.path.join(location, "%s-%d-summary.tex" % (infilename.replace(".", "-"), totpacketno)), 'w')
+    def __init__(self):
+        self.partial = ""
+        self.header = None
+        self.columns = None
+        self.remaining = 0
+
+    def feed(self, data):
+        records = []
+        lines = (self.partial+data).split("\n")
+        self.partial = lines.pop()
+        for line in lines:
+            self.line(line+"\n", records)
+        return records
+
+    def close(self):
+        """Return the records completed by the end of the input. A
+        packet still missing lines is dropped."""
+        records = []
+        if self.partial:
+            self.line(self.partial, records)
+            self.partial = ""
+        return records
+
+    def line(self, line, records):
+        if None == self.header:
+            mo = pktre.search(line)
+            if None != mo:
+                self.header = (line, mo)
+            else: # Unknown data line.
+                records.append((line,))
+            return
+        if None == self.columns:
+            if None == databeginre.search(line): # Unknown data, skip.
+                return
+            self.columns = []
+            self.remaining = max(1, (int(self.header[1].group(5))+15)//16)
+        self.columns.append(line[5:53])
+        self.remaining-=1
+        if 0 == self.remaining:
+            (headerline, mo) = self.header
+            records.append((headerline, mo.group(3), int(mo.group(1)),
+                            int(mo.group(2)), mo.group(4), self.columns,
+                            None, header_session(mo)))
+            self.header = None
+            self.columns = None
+
+def follow_rdpproxy(infile, idle=None, interval=0.2):
+    """Read an rdpproxy capture while it is being written, yielding
+    records like read_rdpproxy as soon as their last line is in. The
+    input is read whenever there is any, also between records, so
+    rdpproxy does not have to wait for a full pipe to drain. idle is
+    called before waiting for more input. A pipe is read until it is
+    closed, a file is followed past its end (every interval seconds)
+    until interrupted."""
+    fd = infile.fileno()
+    isfile = stat.S_ISREG(os.fstat(fd).st_mode)
+    framer = HexdumpFramer()
+    pending = collections.deque()
+    while 1:
+        if 0 < len(pending):
+            timeout = 0
+        else:
+            if None != idle:
+                idle()
+            timeout = None
+        if select.select([fd], [], [], timeout)[0]:
+            data = os.read(fd, 65536)
+            if data:
+                pending.extend(framer.feed(data.decode('latin-1')))
+            elif not isfile:
+                pending.extend(framer.close())
+                break
+            elif 0 == len(pending):
+                time.sleep(interval)
+        if 0 < len(pending):
+            yield pending.popleft()
+    while 0 < len(pending):
+        yield pending.popleft()
+
+class HexBlock(object):
+    """The hex columns (line[5:53]) of the hexdump lines of one packet
+    in a mapped capture. Lines are sliced out of the map only when
+    asked for, so a packet that is skipped after a look at its first
+    line costs nothing more. Holds rdpproxy's lines of 70 bytes. The
+    columns are handed out as str, like those of a text capture."""
+
+    __slots__ = ('buf', 'start', 'count')
+
+    def __init__(self, buf, start, count):
+        self.buf = buf
+        self.start = start
+        self.count = count
 
-    print >> summaryfile, """
-\\begin{tabular}{l}"""
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(map(self.__getitem__, range(*i.indices(self.count))))
+        if i < 0:
+            i+=self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        offset = self.start+70*i
+        return self.buf[offset+5:offset+53].decode('latin-1')
+
+    def __reduce__(self):
+        # The map does not travel to other processes, the columns do.
+        return (list, (list(self),))
+
+def map_capture(infile):
+    """Return a read-only memory map of infile, or None when it cannot
+    be mapped (a pipe, an empty file)."""
+    try:
+        return mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+    except (mmap.error, ValueError, EnvironmentError):
+        return None
+
+# pktre and databeginre, for searching a mapped capture.
+mappktre = re.compile(pktre.pattern.encode())
+mapdatabeginre = re.compile(b"^0000 [0-9]{2} ", re.M)
+
+def scan_mapped(buf):
+    """Like read_rdpproxy, but over the mapped capture buf, yielding
+    (offset, record) pairs. Packet headers are found with one regex
+    search each, and the hexdump lines of a packet are counted rather
+    than read."""
+    end = len(buf)
+    pos = 0
+    while pos < end:
+        mo = mappktre.search(buf, pos)
+        if None == mo:
+            linestart = end
+        else:
+            linestart = max(pos, buf.rfind(b"\n", pos, mo.start())+1)
+        while pos < linestart: # Unknown data lines.
+            eol = buf.find(b"\n", pos, linestart)
+            if -1 == eol:
+                eol = linestart-1
+            yield (pos, (buf[pos:eol+1].decode('latin-1'),))
+            pos = eol+1
+        if None == mo:
+            break
+
+        (record, nextpos) = mapped_packet(buf, linestart, mo)
+        if None == record:
+            break
+        yield (linestart, record)
+        pos = nextpos
+
+def mapped_packet(buf, linestart, mo):
+    """Return the record of the packet in the mapped capture buf whose
+    header line starts at linestart and matched mappktre as mo, and the
+    offset following it. The record is None when the hexdump is
+    missing."""
+    eol = buf.find(b"\n", mo.end())
+    if -1 == eol:
+        eol = len(buf)-1
+    headerline = buf[linestart:eol+1].decode('latin-1')
+    dmo = mapdatabeginre.search(buf, eol+1)
+    if None == dmo:
+        return (None, len(buf))
+    pktlength = int(mo.group(5))
+    count = max(1, (pktlength+15)//16)
+    (columns, nextpos) = map_columns(buf, dmo.start(), count, pktlength)
+    return ((headerline, mo.group(3).decode(), int(mo.group(1)),
+             int(mo.group(2)), mo.group(4).decode(), columns, None,
+             header_session(mo)), nextpos)
+
+def map_columns(buf, start, count, pktlength):
+    """Return the columns of the count hexdump lines starting at start
+    and the offset following them."""
+    last = start+70*(count-1)
+    tail = pktlength%16 or 16
+    nextpos = last+54+tail
+    if nextpos <= len(buf) and b"\n" == buf[nextpos-1:nextpos] and \
+       b"%04x " % (16*(count-1)) == buf[last:last+5]:
+        return (HexBlock(buf, start, count), nextpos)
+
+    # Not laid out the way rdpproxy writes them, go line by line.
+    columns = []
+    pos = start
+    for i in range(count):
+        eol = buf.find(b"\n", pos)
+        if -1 == eol:
+            eol = len(buf)-1
+        columns.append(buf[pos:eol+1][5:53].decode('latin-1'))
+        pos = eol+1
+    return (columns, pos)
+
+capturemagic = b"RDPCAP\x00\x01"
+recordheader = struct.Struct(">7I")
+
+def pdu_record(totpacketno, partpacketno, part, pkttype, data, timestamp,
+               session=None):
+    """Return the record (see read_rdpproxy) for a PDU that was not
+    read from a hexdump. part is 0 for the client and 1 for the server,
+    pkttype 0 for TPKT and 1 for RDP5. The header line is made up the
+    way rdpproxy prints it, tagged with the session if there is one."""
+    origin = ("Client", "Server")[part]
+    pkttype = ("TPKT", "RDP5")[pkttype]
+    if 0 == totpacketno:
+        headerline = "#0, #0 from Server, type TPKT, l: %d, faked" % \
+                     len(data)
+    else:
+        headerline = "#%d, #%d from %s, type %s, l: %d, read %d bytes" % \
+                     (totpacketno, partpacketno, origin, pkttype, len(data),
+                      len(data))
+    if None != session:
+        headerline+=", session %d" % session
+    return (headerline+"\n", origin, totpacketno, partpacketno, pkttype,
+            data, timestamp, session)
+
+def binary_record(header, data):
+    """Return the record for a record header of a binary capture and
+    the PDU bytes following it."""
+    (length, sec, usec, totpacketno, partpacketno, part, pkttype) = header
+    return pdu_record(totpacketno, partpacketno, part, pkttype, data,
+                      sec+usec/1e6)
+
+def scan_binary(buf):
+    """Like scan_mapped, over the binary capture written by rdpproxy
+    -w. Each record is a header of seven 32-bit big endian words
+    (record length, seconds, microseconds, total packet number, packet
+    number in its direction, direction 0 client/1 server, type 0
+    TPKT/1 RDP5) followed by the decrypted PDU. A truncated record
+    at the end is left alone, rdpproxy may still be writing it."""
+    end = len(buf)
+    pos = len(capturemagic)
+    while pos+recordheader.size <= end:
+        header = recordheader.unpack_from(buf, pos)
+        length = header[0]
+        if length < recordheader.size or end < pos+length:
+            break
+        data = buf[pos+recordheader.size:pos+length]
+        yield (pos, binary_record(header, data))
+        pos+=length
+
+def scan_capture(buf):
+    """scan_binary or scan_mapped, whichever fits the mapped capture."""
+    if capturemagic == buf[:len(capturemagic)]:
+        return scan_binary(buf)
+    return scan_mapped(buf)
+
+def read_mapped(buf):
+    for (offset, record) in scan_capture(buf):
+        yield record
+
+rdpport = 3389
+
+pcapmagics = {b"\xd4\xc3\xb2\xa1": ("<", 1e-6), b"\xa1\xb2\xc3\xd4": (">", 1e-6),
+              b"\x4d\x3c\xb2\xa1": ("<", 1e-9), b"\xa1\xb2\x3c\x4d": (">", 1e-9)}
+pcapngmagic = b"\x0a\x0d\x0d\x0a"
+
+def is_pcap(head):
+    return head[:4] in pcapmagics or pcapngmagic == head[:4]
+
+def read_pcap_frames(infile):
+    """Yield (timestamp, linktype, frame) for each frame of a pcap or
+    pcapng file, reading them one at a time."""
+    magic = infile.read(4)
+    if pcapngmagic == magic:
+        for frame in read_pcapng_frames(infile, magic):
+            yield frame
+        return
+    (order, resolution) = pcapmagics[magic]
+    linktype = struct.unpack(order+"HHiIII", infile.read(20))[5] & 0xffff
+    frameheader = struct.Struct(order+"IIII")
+    while 1:
+        header = infile.read(frameheader.size)
+        if len(header) < frameheader.size:
+            break
+        (sec, frac, caplen, length) = frameheader.unpack(header)
+        frame = infile.read(caplen)
+        if len(frame) < caplen:
+            break
+        yield (sec+frac*resolution, linktype, frame)
+
+def read_pcapng_frames(infile, head):
+    """Like read_pcap_frames, for pcapng. head is what has been read
+    of the first block."""
+    order = "<"
+    interfaces = []
+    head+=infile.read(8-len(head))
+    while 8 == len(head):
+        if pcapngmagic == head[:4]: # Section header, sets the byte order.
+            bom = infile.read(4)
+            order = ("<", ">")[b"\x1a\x2b\x3c\x4d" == bom]
+            length = struct.unpack(order+"I", head[4:])[0]
+            body = bom+infile.read(length-12)
+            blocktype = 0x0a0d0d0a
+            interfaces = []
+        else:
+            (blocktype, length) = struct.unpack(order+"II", head)
+            body = infile.read(length-8)
+        if len(body) < length-8:
+            break
+
+        if 1 == blocktype: # Interface description
+            linktype = struct.unpack(order+"H", body[:2])[0]
+            resolution = 1e-6
+            pos = 8
+            while pos+4 <= len(body)-4:
+                (code, optlen) = struct.unpack(order+"HH", body[pos:pos+4])
+                if 0 == code:
+                    break
+                if 9 == code: # if_tsresol
+                    value = body[pos+4]
+                    if value & 0x80:
+                        resolution = 2.0**-(value & 0x7f)
+                    else:
+                        resolution = 10.0**-value
+                pos+=4+(optlen+3)//4*4
+            interfaces.append((linktype, resolution))
+        elif 6 == blocktype: # Enhanced packet
+            (interface, high, low, caplen, framelength) = \
+                        struct.unpack(order+"IIIII", body[:20])
+            (linktype, resolution) = interfaces[interface]
+            yield ((high << 32 | low)*resolution, linktype,
+                   body[20:20+caplen])
+        elif 3 == blocktype: # Simple packet, no timestamp
+            framelength = struct.unpack(order+"I", body[:4])[0]
+            yield (0, interfaces[0][0], body[4:4+min(framelength,
+                                                     len(body)-8)])
+        head = infile.read(8)
+
+def tcp_segment(linktype, frame):
+    """Return (src, sport, dst, dport, seq, flags, payload) for a frame
+    carrying TCP over IPv4 or IPv6, or None for any other frame."""
+    offset = 0
+    if 1 == linktype: # Ethernet
+        offset = 14
+        while frame[offset-2:offset] in (b"\x81\x00", b"\x88\xa8"): # VLAN
+            offset+=4
+        if frame[offset-2:offset] not in (b"\x08\x00", b"\x86\xdd"):
+            return None
+    elif 113 == linktype: # Linux cooked
+        offset = 16
+    elif 276 == linktype: # Linux cooked v2
+        offset = 20
+    elif linktype in (0, 108): # BSD loopback
+        offset = 4
+    elif linktype not in (12, 14, 101, 228, 229): # Raw IP
+        return None
+    if len(frame) < offset+20:
+        return None
+
+    version = frame[offset] >> 4
+    if 4 == version:
+        if 6 != frame[offset+9]:
+            return None
+        if struct.unpack(">H", frame[offset+6:offset+8])[0] & 0x3fff:
+            return None # Fragment
+        end = offset+struct.unpack(">H", frame[offset+2:offset+4])[0]
+        src = frame[offset+12:offset+16]
+        dst = frame[offset+16:offset+20]
+        offset+=(frame[offset] & 0xf)*4
+    elif 6 == version:
+        if len(frame) < offset+40 or 6 != frame[offset+6]:
+            return None
+        end = offset+40+struct.unpack(">H", frame[offset+4:offset+6])[0]
+        src = frame[offset+8:offset+24]
+        dst = frame[offset+24:offset+40]
+        offset+=40
+    else:
+        return None
+    if len(frame) < offset+14:
+        return None
+    (sport, dport, seq, ack, dataflags) = \
+                  struct.unpack(">HHIIH", frame[offset:offset+14])
+    return (src, sport, dst, dport, seq, dataflags & 0x3f,
+            frame[offset+(dataflags >> 12)*4:end])
 
-    fname = ""
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_PSH = 0x08
+TCP_ACK = 0x10
 
-    i = 0
-    for ppart in res:
-        if location:
-            if outfile:
-                outfile.close()
-            if classnames:
-                num = 0
-                if clsrefs.has_key(ppart.classname):
-                    num = clsrefs[ppart.classname]
-                    clsrefs[ppart.classname]+=1
-                else:
-                    clsrefs[ppart.classname]=1
-                fname = "%s-%d-%s%d-%s-%d.tex" % (infilename.replace(".", "-"), totpacketno, origin, packetno, ppart.classname, num)
-            else:
-                fname = "%s%s.tex" % (origin, ppart.packetno)
-            outfile = open(os.path.join(location, fname), 'w')
-        else:
-            outfile = ofile
-        print >> outfile, LaTeX_escape("\pkttab{%s%s}{%s %s}{\n" % (origin, ppart.packetno, ppart.datatype, ppart.description))
+class PDUStream(object):
+    """A stream of RDP traffic in one direction, cut into PDUs the way
+    recv_pdu in rdpproxy.c reads them."""
 
+    __slots__ = ('data',)
 
-        s = ""
-        offset = 0
-        if type([]) == type(ppart.value):
-            for subpart in ppart.value:
-                if type("") == type(subpart):
-                    print >> outfile, LaTeX_escape("(str)&&&&%s\\\\" % (subpart))
+    def __init__(self):
+        self.data = bytearray()
+
+    def feed(self, data):
+        self.data+=data
+
+    def pdus(self):
+        """Yield the PDUs completed by the data fed so far."""
+        data = self.data
+        while 4 <= len(data):
+            if 3 == data[0]: # ISO over TCP
+                pdulen = data[2] << 8 | data[3]
+            else: # assume RDP5 style packet
+                pdulen = data[1]
+                if pdulen & 0x80:
+                    pdulen = (pdulen & 0x7f) << 8 | data[2]
+            if pdulen < 4: # Lost track of the PDUs in this stream.
+                self.losttrack()
+                return
+            if len(data) < pdulen:
+                return
+            pdu = data[:pdulen]
+            del data[:pdulen]
+            yield pdu
+
+    def losttrack(self):
+        del self.data[:]
+
+def pdu_header_length(data, pos):
+    """Return the length of the PDU the six bytes at pos in data look
+    like the header of, or None if they do not look like one: a TPKT
+    header with an X.224 TPDU after it, or a fast-path header."""
+    if 3 == data[pos]:
+        pdulen = data[pos+2] << 8 | data[pos+3]
+        if 0 != data[pos+1] or pdulen < data[pos+4]+5 or \
+           data[pos+5] & 0xf0 not in (0x80, 0xd0, 0xe0, 0xf0):
+            return None
+        return pdulen
+    if data[pos] & 0x3: # Not a fast-path action.
+        return None
+    pdulen = data[pos+1]
+    if pdulen & 0x80:
+        pdulen = (pdulen & 0x7f) << 8 | data[pos+2]
+    if pdulen < 4:
+        return None
+    return pdulen
+
+class TCPStream(PDUStream):
+    """One direction of a TCP connection, put back together from its
+    segments. Segments after one that is missing are held until it
+    turns up, but at most maxpending of them. After that, or at the
+    end of the capture, the missing data is given up on and the stream
+    goes on from the first segment held. The data up to the next PDU
+    header is skipped then, and whenever the stream stops making sense
+    as PDUs, or when the capture starts after the SYN. missing and
+    skipped count the bytes lost either way, until read_pcap reports
+    them."""
+
+    __slots__ = ('part', 'session', 'seq', 'pending', 'missing',
+                 'skipped', 'resyncing')
+
+    maxpending = 256
+    # A place in the data is taken for the start of a PDU when this
+    # many PDU headers follow each other from there, or, at the end of
+    # the capture, they run to the end of the data. Anything may pass
+    # for a fast-path header, so it takes a good few. A place is given
+    # up on when they have not turned up in maxresync bytes.
+    resyncpdus = 16
+    maxresync = 1 << 16
+
+    def __init__(self, part, session=None):
+        PDUStream.__init__(self)
+        self.part = part
+        self.session = session
+        self.seq = None
+        self.pending = {}
+        self.missing = 0
+        self.skipped = 0
+        self.resyncing = 0
+
+    def add(self, seq, flags, payload):
+        if flags & TCP_SYN:
+            seq = (seq+1) & 0xffffffff
+            self.seq = seq
+        elif None == self.seq:
+            # The capture starts in the middle of the stream, and so
+            # may this segment in the middle of a PDU.
+            self.seq = seq
+            self.resyncing = 1
+        behind = (self.seq-seq) & 0xffffffff
+        if behind < 0x80000000: # Starts at or before what we have.
+            if len(payload) <= behind:
+                return
+            self.data+=payload[behind:]
+            self.seq = (self.seq+len(payload)-behind) & 0xffffffff
+            self.addpending()
+        else:
+            self.pending[seq] = payload
+            if self.maxpending < len(self.pending):
+                self.skipgap()
+
+    def addpending(self):
+        """Add the segments held that follow on what the stream has."""
+        while self.seq in self.pending:
+            payload = self.pending.pop(self.seq)
+            self.data+=payload
+            self.seq = (self.seq+len(payload)) & 0xffffffff
+
+    def skipgap(self):
+        """Give up on the data missing before the first segment held,
+        and go on from that segment."""
+        seq = min(self.pending,
+                  key=lambda seq: (seq-self.seq) & 0xffffffff)
+        self.missing+=(seq-self.seq) & 0xffffffff
+        # What there is of the PDU the gap is in is no use.
+        self.skipped+=len(self.data)
+        del self.data[:]
+        self.seq = seq
+        self.resyncing = 1
+        self.addpending()
+
+    def finish(self):
+        """Give up on all data still missing, at the end of the
+        capture."""
+        while 0 < len(self.pending):
+            self.skipgap()
+
+    def losttrack(self):
+        self.resyncing = 1
+
+    def pdus(self, final=0):
+        """Yield the PDUs completed by the data added so far. With
+        final, no more data will be added."""
+        while not self.resyncing or self.resync(final):
+            for pdu in PDUStream.pdus(self):
+                yield pdu
+            if not self.resyncing:
+                return
+
+    def chain(self, pos, final):
+        """Whether a PDU starts at pos in the data: 1 if so, 0 if not,
+        None if that cannot be told until there is more data."""
+        data = self.data
+        start = pos
+        count = 0
+        while pos+6 <= len(data):
+            pdulen = pdu_header_length(data, pos)
+            if None == pdulen:
+                return 0
+            pos+=pdulen
+            count+=1
+            if self.resyncpdus <= count:
+                return 1
+        if len(data) == pos and final:
+            return 1
+        if final or self.maxresync < len(data)-start:
+            return 0
+        return None
+
+    def resync(self, final):
+        """Skip the data up to the first PDU, see chain. Returns 0 if
+        that cannot be told yet, keeping the data from the first place
+        that may still turn out to be one."""
+        data = self.data
+        pos = 0
+        while pos+6 <= len(data):
+            found = self.chain(pos, final)
+            if found:
+                self.resyncing = 0
+                break
+            if None == found:
+                break
+            pos+=1
+        else:
+            if final: # Nothing more to look for it in.
+                pos = len(data)
+        self.skipped+=pos
+        del data[:pos]
+        return not self.resyncing
+
+def read_pcap(infile):
+    """Read the decrypted RDP traffic in a pcap or pcapng file,
+    yielding records like read_rdpproxy. Each TCP connection is put
+    back together one frame at a time, and is a session of its own,
+    numbered from 1 in the order they show up. A SYN starting a new
+    connection on the ports of one seen before starts a new session.
+    The end on port rdpport is the server, or else the end that
+    answered the SYN.
+    Data missing from a connection, and data skipped since it is no
+    use without it, is reported as a line of unknown data before the
+    PDU it goes on with."""
+    streams = {}
+    packetnos = {}
+
+    def lost(stream):
+        line = "%d bytes missing from the %s stream of session %d, " \
+               "%d skipped\n" % (stream.missing,
+                                 ("Client", "Server")[stream.part],
+                                 stream.session, stream.skipped)
+        stream.missing = 0
+        stream.skipped = 0
+        return (line,)
+
+    def stream_records(stream, timestamp, final=0):
+        for pdu in stream.pdus(final):
+            if 0 < stream.missing or 0 < stream.skipped:
+                yield lost(stream)
+            numbers = packetnos[stream.session]
+            numbers[0]+=1
+            numbers[1+stream.part]+=1
+            yield pdu_record(numbers[0], numbers[1+stream.part],
+                             stream.part, 3 != pdu[0], pdu, timestamp,
+                             stream.session)
+
+    def close(stream, timestamp):
+        """Give up on what is still missing from stream, and yield the
+        records of what it has left."""
+        if 0 < len(stream.pending) or stream.resyncing:
+            stream.finish()
+            for record in stream_records(stream, timestamp, 1):
+                yield record
+        if 0 < stream.missing or 0 < stream.skipped:
+            yield lost(stream)
+
+    timestamp = None
+    for (timestamp, linktype, frame) in read_pcap_frames(infile):
+        segment = tcp_segment(linktype, frame)
+        if None == segment:
+            continue
+        (src, sport, dst, dport, seq, flags, payload) = segment
+        stream = streams.get((src, sport, dst, dport))
+        if None != stream and flags & TCP_SYN and \
+           (seq+1) & 0xffffffff != stream.seq:
+            # Not the SYN again, but a new connection on the same
+            # ports. The old one is over in both directions.
+            for key in ((src, sport, dst, dport), (dst, dport, src, sport)):
+                if key in streams:
+                    for record in close(streams.pop(key), timestamp):
+                        yield record
+            stream = None
+        if None == stream:
+            reverse = streams.get((dst, dport, src, sport))
+            if None != reverse:
+                part = 1-reverse.part
+                session = reverse.session
+            else:
+                if rdpport == sport or rdpport != dport and \
+                   flags & TCP_SYN and flags & TCP_ACK:
+                    part = 1
                 else:
-                    print >> outfile, LaTeX_escape("%d & %s" % (offset,
-                                                  subpart.latexvalue(offset=offset)))
-                    offset+=len(subpart)
-                    
+                    part = 0
+                session = len(packetnos)+1
+                # Total packet number and one for each direction.
+                packetnos[session] = [0, 0, 0]
+            stream = TCPStream(part, session)
+            streams[(src, sport, dst, dport)] = stream
+        stream.add(seq, flags, payload)
+        for record in stream_records(stream, timestamp):
+            yield record
+
+    for stream in streams.values():
+        for record in close(stream, timestamp):
+            yield record
+
+def inet_checksum(data):
+    """The Internet checksum of data, packed in host byte order."""
+    if len(data) % 2:
+        data+=b"\0"
+    s = sum(array.array("H", data))
+    s = (s >> 16) + (s & 0xffff)
+    s+=s >> 16
+    return struct.pack("H", ~s & 0xffff)
+
+class PcapWriter:
+    """Writes PDUs to a pcap file as the payload of made up TCP
+    connections over Ethernet, one for each session, at most mss bytes
+    per segment. The sessions are told apart by the client port."""
+
+    mss = 1460
+    hosts = {"Client":(b"\x02\x00\x00\x00\x00\x01", b"\x0a\x00\x00\x01"),
+             "Server":(b"\x02\x00\x00\x00\x00\x02", b"\x0a\x00\x00\x02")}
+
+    def __init__(self, outfile):
+        self.outfile = outfile
+        self.connections = {}
+        self.ident = 0
+        self.timestamp = None
+        outfile.write(struct.pack("<IHHiIII", 0xa1b2c3d4, 2, 4, 0, 0, 65535,
+                                  1))
+
+    def segment(self, connection, origin, flags, payload=b""):
+        (seq, clientport) = connection
+        if "Client" == origin:
+            peer = "Server"
+            (sport, dport) = (clientport, rdpport)
         else:
-            s =  "off & %s & %s & " % (ppart.datatype,
-                                    ppart.description)
-            if None != ppart.knvalue:
-                s+=str(ppart.knvalue)
-            s+="& %s \\\\" % ppart.value
-            print >> outfile, LaTeX_escape(s)
-        print >> outfile, "}\n"
-        if id(ppart) != id(res[-1:][0]):
-            print >> summaryfile, "\input{%s}\\\\[\\betweenpktheight]" % os.path.join("figures", "pktfigs", fname)
+            peer = "Client"
+            (sport, dport) = (rdpport, clientport)
+        (srcmac, src) = self.hosts[origin]
+        (dstmac, dst) = self.hosts[peer]
+        ack = 0
+        if flags & TCP_ACK:
+            ack = seq[peer]
+        tcp = struct.pack(">HHIIBBHHH", sport, dport, seq[origin], ack,
+                          5 << 4, flags, 65535, 0, 0)+payload
+        pseudo = struct.pack(">4s4sBBH", src, dst, 0, 6, len(tcp))
+        tcp = tcp[:16]+inet_checksum(pseudo+tcp)+tcp[18:]
+        self.ident = (self.ident+1) & 0xffff
+        ip = struct.pack(">BBHHHBBH4s4s", 0x45, 0, 20+len(tcp), self.ident,
+                         0x4000, 64, 6, 0, src, dst)
+        ip = ip[:10]+inet_checksum(ip)+ip[12:]
+        frame = dstmac+srcmac+b"\x08\x00"+ip+tcp
+        sec = int(self.timestamp)
+        self.outfile.write(struct.pack("<IIII", sec,
+                                       int(round((self.timestamp-sec)*1e6)),
+                                       len(frame), len(frame))+frame)
+        seq[origin] = (seq[origin]+len(payload)+
+                       (flags & (TCP_SYN | TCP_FIN) and 1)) & 0xffffffff
+
+    def writepdu(self, origin, data, timestamp=None, session=None):
+        """Write one PDU. Without a timestamp, it comes 1 ms after the
+        one before."""
+        if None != timestamp:
+            self.timestamp = timestamp
+        elif None != self.timestamp:
+            self.timestamp+=0.001
         else:
-            print >> summaryfile, "\input{%s}\\\\" % os.path.join("figures", "pktfigs", fname)
-
-    print >> summaryfile, """\n\\end{tabular}"""
+            self.timestamp = 0.0
+        connection = self.connections.get(session)
+        if None == connection: # Open the connection first.
+            connection = ({"Client":0x1000, "Server":0x80000},
+                          1024+len(self.connections))
+            self.connections[session] = connection
+            self.segment(connection, "Client", TCP_SYN)
+            self.segment(connection, "Server", TCP_SYN | TCP_ACK)
+            self.segment(connection, "Client", TCP_ACK)
+        data = bytes(data)
+        for pos in range(0, len(data), self.mss):
+            flags = TCP_ACK
+            if len(data) <= pos+self.mss:
+                flags = TCP_ACK | TCP_PSH
+            self.segment(connection, origin, flags, data[pos:pos+self.mss])
+
+def write_pcap(outfile, records):
+    """Write the packets among records to outfile as pcap. Faked
+    packets are left out, since the server packet they replace is
+    already in the stream."""
+    writer = PcapWriter(outfile)
+    for record in records:
+        if 1 == len(record) or 0 == record[2]:
+            continue
+        (headerline, origin, totpacketno, partpacketno, pkttype,
+         columns, timestamp, session) = record
+        writer.writepdu(origin, packet_bytes(columns), timestamp, session)
+
+NOCHANNEL = -1
+UNKNOWNCHANNEL = -2
+
+def build_index(infile):
+    """Scan an rdpproxy capture and return a list with an entry
+    (offset, totpacketno, partpacketno, origin, pkttype, length,
+    channel) for each packet in it. offset is where its header line
+    starts. channel is the channel id in the MCS header, NOCHANNEL if
+    there is none and UNKNOWNCHANNEL if it takes a full parse to
+    tell."""
+    entries = []
+    buf = map_capture(infile)
+    if None == buf:
+        return entries
+    for (offset, record) in scan_capture(buf):
+        if 1 == len(record):
+            continue
+        (headerline, origin, totpacketno, partpacketno, pkttype,
+         columns, timestamp, session) = record
+        channel = header_channel(pkttype, packet_bytes(columns, 1),
+                                 NOCHANNEL)
+        if None == channel:
+            channel = UNKNOWNCHANNEL
+        entries.append((offset, totpacketno, partpacketno, origin,
+                        pkttype, int(pktre.search(headerline).group(5)),
+                        channel))
+    return entries
+
+def index_filename(filename):
+    return filename+".idx"
+
+# The index of a capture, in <capture>.idx: a header (magic, size and
+# mtime of the capture it was made from, number of entries and of
+# connect entries), then an entry for each packet, sorted by total
+# packet number, then again the entries of the packets whose channel
+# takes a full parse to tell (the MCS connect), in capture order. The
+# entries are all the same size, so a packet number is found by a
+# binary search over the mapped file, reading only what it looks at.
+indexmagic = b"RDPIDX\x00\x02"
+indexheader = struct.Struct(">8sQQII")
+# offset, totpacketno, partpacketno, origin (0 client, 1 server),
+# pkttype (0 TPKT, 1 RDP5), length, channel.
+indexentry = struct.Struct(">QIIBBIi")
+
+def index_header(filename, count, connectcount):
+    st = os.stat(filename)
+    return indexheader.pack(indexmagic, st.st_size, int(st.st_mtime), count,
+                            connectcount)
+
+def pack_index_entry(entry):
+    (offset, totpacketno, partpacketno, origin, pkttype, length,
+     channel) = entry
+    return indexentry.pack(offset, totpacketno, partpacketno,
+                           ("Client", "Server").index(origin),
+                           ("TPKT", "RDP5").index(pkttype), length, channel)
+
+def save_index(filename, entries):
+    connectentries = [entry for entry in entries
+                      if UNKNOWNCHANNEL == entry[6]]
+    idxfile = open(index_filename(filename), 'wb')
+    idxfile.write(index_header(filename, len(entries), len(connectentries)))
+    # sorted keeps packets with the same number in capture order.
+    for entry in sorted(entries, key=lambda entry: entry[1]):
+        idxfile.write(pack_index_entry(entry))
+    for entry in connectentries:
+        idxfile.write(pack_index_entry(entry))
+    idxfile.close()
+
+class CaptureIndex:
+    """A saved index (see indexheader), mapped. Entries are unpacked
+    only when they are looked at."""
+
+    def __init__(self, buf, count, connectcount):
+        self.buf = buf
+        self.count = count
+        self.connectcount = connectcount
 
-        
-    
-    
-    
-
-def parse_rdpproxy(infile, outfile, outputformat, location,
-                   classnames, infilename, wantedchannels, quiet):
-    pktre = re.compile("#([0-9]*?), #([0-9]*?) from (Server|Client), type (TPKT|RDP5), l: ([0-9]*), ")
-    databeginre = re.compile("^0000 [0-9]{2} ")
-    line = infile.readline()
-    while line:
-        mo = pktre.search(line)
-        if None != mo:
-            headerline = line
-            totpacketno = int(mo.group(1))
-            partpacketno = int(mo.group(2))
-            part = mo.group(3)
-            pkttype = mo.group(4)
-            pktlength = int(mo.group(5))
-            line = infile.readline()
-            while None ==  databeginre.search(line): # Unknown data, print.
-                line = infile.readline()
-            # We are now expecting pktlength bytes of data
-            data = line[5:53]
-            lines = pktlength / 16
-            if pktlength % 16:
-                lines+=1
-            lines-=1
-            for i in range(lines):
-                thisdata = infile.readline()[5:53]
-                data+= thisdata
-            data = map(lambda x: string.atoi(x, 16), data.strip().split(' '))
-            remaining = []
-            if "TPKT" == pkttype:
-                p = TPKT("from %s" % part)
-                remaining = p.parse(data)
-            elif "RDP5" == pkttype:
-                p = RDP5Packet("from %s" % part)
-                remaining = p.parse(data)
-            global currentchannel
-            if 0 < len(wantedchannels) and currentchannel not in wantedchannels:
-                line = infile.readline()
-                continue
-            currentchannel = 0
-            if "TBL" == outputformat:
-                create_tbl(outfile, p, part, totpacketno, partpacketno, location, classnames, infilename)
-            elif "LATEX" == outputformat:
-                create_latex(outfile, p, part, totpacketno, partpacketno, location, classnames, infilename)
+    def __len__(self):
+        return self.count
+
+    def entry(self, i):
+        (offset, totpacketno, partpacketno, origin, pkttype, length,
+         channel) = indexentry.unpack_from(self.buf, indexheader.size+
+                                           i*indexentry.size)
+        return (offset, totpacketno, partpacketno,
+                ("Client", "Server")[origin], ("TPKT", "RDP5")[pkttype],
+                length, channel)
+
+    def totpacketno(self, i):
+        return struct.unpack_from(">I", self.buf, indexheader.size+
+                                  i*indexentry.size+8)[0]
+
+    def find(self, totpacketno):
+        """Return the position of the first entry with a total packet
+        number of at least totpacketno."""
+        (low, high) = (0, self.count)
+        while low < high:
+            middle = (low+high)//2
+            if self.totpacketno(middle) < totpacketno:
+                low = middle+1
             else:
-                if not quiet:
-                    outfile.write(headerline)
-                print >> outfile, p
-            if 0 < len(remaining):
-                rempkt = PacketPart("Remaining data")
-                rempkt.parse(remaining)
-                print >> outfile, rempkt
-            
-        else: # Unknown data line, just print it out.
-            if not quiet and "TXT" == outputformat:
-                outfile.write("Unknown data: %s" % line)
+                high = middle
+        return low
+
+    def entries(self, first=0, last=None):
+        """Yield the entries from position first up to last."""
+        if None == last:
+            last = self.count
+        for i in range(first, last):
+            yield self.entry(i)
+
+    def connectentries(self):
+        """Return the entries of the MCS connect packets, in capture
+        order."""
+        return [self.entry(i) for i in range(self.count,
+                                             self.count+self.connectcount)]
+
+def load_index(filename):
+    """Return the saved index of filename as a CaptureIndex, or None
+    if there is none or the capture has changed since it was made."""
+    try:
+        idxfile = open(index_filename(filename), 'rb')
+    except IOError:
+        return None
+    buf = map_capture(idxfile)
+    idxfile.close()
+    if None == buf or len(buf) < indexheader.size:
+        return None
+    (magic, size, mtime, count, connectcount) = \
+        indexheader.unpack_from(buf, 0)
+    if index_header(filename, count, connectcount) != \
+       buf[:indexheader.size] or \
+       len(buf) != indexheader.size+(count+connectcount)*indexentry.size:
+        return None
+    return CaptureIndex(buf, count, connectcount)
+
+def select_index(index, packets=None, direction=None, channels=[]):
+    """Return the index entries of the packets whose total packet
+    number is in one of the (first, last) ranges of packets, that are
+    from direction, and that may be on one of channels, in capture
+    order. Leaving out a criterion selects everything. Only the
+    entries in the ranges of packets are looked at."""
+    if None == packets:
+        ranges = [index.entries()]
+    else:
+        ranges = [index.entries(index.find(first), index.find(last+1))
+                  for (first, last) in packets]
+    selected = {}
+    for entries in ranges:
+        for entry in entries:
+            (offset, totpacketno, partpacketno, origin, pkttype, length,
+             channel) = entry
+            if None != direction and direction != origin:
+                continue
+            if 0 < len(channels) and UNKNOWNCHANNEL != channel and \
+               channel not in channels:
+                continue
+            # By offset, so that overlapping ranges give a packet once.
+            selected[offset] = entry
+    return [selected[offset] for offset in sorted(selected)]
+
+def read_indexed(infile, entries):
+    """Like read_rdpproxy, but only read the packets of the index
+    entries, going straight to each of them in the mapped capture."""
+    buf = map_capture(infile)
+    if None == buf:
+        return
+    binary = capturemagic == buf[:len(capturemagic)]
+    for entry in entries:
+        pos = entry[0]
+        if binary:
+            header = recordheader.unpack_from(buf, pos)
+            yield binary_record(header, buf[pos+recordheader.size:
+                                            pos+header[0]])
+            continue
+        yield mapped_packet(buf, pos, mappktre.search(buf, pos))[0]
+
+profilestats = {}
+profilestack = []
+
+def profiled(parse):
+    """Return parse wrapped so that it adds to profilestats. Parses by
+    the same class within each other, such as a class calling the
+    parse of its base class, count as one."""
+    def profiled_parse(self, data):
+        name = self.__class__.__name__
+        stats = profilestats.get(name)
+        if None == stats:
+            # active, calls, cumulative time, own time, bytes
+            stats = profilestats[name] = [0, 0, 0.0, 0.0, 0]
+        if stats[0]:
+            return parse(self, data)
+        stats[0] = 1
+        profilestack.append(0.0)
+        start = time.perf_counter()
+        try:
+            rest = parse(self, data)
+        finally:
+            elapsed = time.perf_counter()-start
+            children = profilestack.pop()
+            if 0 < len(profilestack):
+                profilestack[-1]+=elapsed
+            stats[0] = 0
+        stats[1]+=1
+        stats[2]+=elapsed
+        stats[3]+=elapsed-children
+        if None != rest:
+            stats[4]+=len(data)-len(rest)
+        return rest
+    return profiled_parse
+
+def enable_profiling(cls=PacketPart):
+    """Make every parse method of cls and its subclasses keep
+    profilestats. Nothing is measured unless this is called. Integers
+    in the fixed runs of a Layout are not parsed one by one, their
+    time goes to the part owning the layout."""
+    if 'parse' in cls.__dict__:
+        cls.parse = profiled(cls.__dict__['parse'])
+    for subclass in cls.__subclasses__():
+        enable_profiling(subclass)
+
+def print_profile(outfile, total):
+    """Print profilestats, the most time consuming classes first."""
+    print("%-28s %9s %11s %11s %10s" % ("Parser class", "calls",
+                                        "cumulative", "own", "bytes"),
+          file=outfile)
+    entries = list(profilestats.items())
+    entries.sort(key=lambda entry: entry[1][2], reverse=True)
+    for (name, (active, calls, cumulative, own, consumed)) in entries:
+        print("%-28s %9d %11.4f %11.4f %10d" % (name, calls, cumulative,
+                                                own, consumed),
+              file=outfile)
+    print("Total processing time: %.2f seconds" % total, file=outfile)
+
+def parse_packet(pkttype, origin, data):
+    """Parse one packet. Returns the tree and the data left over."""
+    if "TPKT" == pkttype:
+        p = TPKT("from %s" % origin)
+    else:
+        p = RDP5Packet("from %s" % origin)
+    return (p, p.parse(data))
+
+def write_packet(writer, record, tree=None):
+    (headerline, origin, totpacketno, partpacketno, pkttype,
+     columns, timestamp, session) = record
+    if None == tree:
+        tree = parse_packet(pkttype, origin,
+                            PacketData(packet_bytes(columns)))
+    (p, remaining) = tree
+    writer.writepacket(p, headerline, origin, totpacketno, partpacketno)
+    if 0 < len(remaining):
+        rempkt = PacketPart("Remaining data")
+        rempkt.parse(remaining)
+        writer.write(rempkt)
+
+class Parser:
+    """Parses captures, with state of its own: a ParserContext for
+    each session seen so far. Nothing is shared between parsers, so
+    there can be one in each thread. The keymap named keymapname in
+    keymappath is read the first time a scancode is printed. lazy
+    decodes parts only when they are looked at. fullunicode prints
+    Unicode strings with the characters outside Latin-1 too."""
+
+    def __init__(self, keymapname='sv', keymappath="keymaps", lazy=0,
+                 fullunicode=0):
+        self.keymapname = keymapname
+        self.keymappath = keymappath
+        self.lazy = lazy
+        self.fullunicode = fullunicode
+        self.keys = LazyKeymap(keymappath, keymapname)
+        self.reset()
+
+    def reset(self):
+        """Forget all sessions, as if nothing had been parsed."""
+        self.contexts = {}
+
+    def context(self, session=None):
+        """Return the ParserContext of session, a new one for sessions
+        not seen before."""
+        sessioncontext = self.contexts.get(session)
+        if None == sessioncontext:
+            sessioncontext = ParserContext(self.keys, self.lazy,
+                                           self.fullunicode)
+            self.contexts[session] = sessioncontext
+        return sessioncontext
+
+    def parse(self, record):
+        """Parse the packet of record in the context of its session.
+        Returns the tree and the data left over."""
+        (headerline, origin, totpacketno, partpacketno, pkttype,
+         columns, timestamp, session) = record
+        sessioncontext = self.context(session)
+        use_context(sessioncontext)
+        try:
+            return parse_packet(pkttype, origin,
+                                PacketData(packet_bytes(columns)))
+        finally:
+            sessioncontext.currentchannel = 0
+
+    def write(self, writer, record, tree=None):
+        """Parse record in the context of its session, unless tree is
+        given, and write it with writer."""
+        sessioncontext = self.context(record[7])
+        use_context(sessioncontext)
+        try:
+            write_packet(writer, record, tree)
+        finally:
+            sessioncontext.currentchannel = 0
+
+    def select(self, records, wantedchannels, parseconnect=0,
+               parsechannels=0):
+        """Run the channel filter over the records from read_rdpproxy,
+        in order, and yield (record, tree) for the ones to print. tree
+        is (p, remaining) for packets that had to be parsed to decide
+        and None for the rest. The context of the session of a packet
+        is the current one when it is yielded. currentchannel is kept
+        up to date just like when parsing every packet. With
+        parseconnect, MCS connect packets are always parsed here, so
+        that rdp_channels is too. With parsechannels, so are packets on
+        virtual channels, as their chunks are collected in order."""
+        for record in records:
+            if 1 == len(record):
+                yield (record, None)
+                continue
 
-        outfile.flush()
-        line = infile.readline()
+            (headerline, origin, totpacketno, partpacketno, pkttype,
+             columns, timestamp, session) = record
+            sessioncontext = self.context(session)
+            use_context(sessioncontext)
+            tree = None
+            if 0 < len(wantedchannels) or parseconnect:
+                # Skip unwanted packets before decoding more than the
+                # first line of them.
+                channel = header_channel(pkttype, packet_bytes(columns, 1),
+                                         sessioncontext.currentchannel)
+                if None == channel or \
+                   (parsechannels and is_virtual_channel(channel)):
+                    tree = parse_packet(pkttype, origin,
+                                        PacketData(packet_bytes(columns)))
+                    channel = sessioncontext.currentchannel
+                if 0 < len(wantedchannels) and channel not in wantedchannels:
+                    sessioncontext.currentchannel = channel
+                    continue
+
+            yield (record, tree)
+            sessioncontext.currentchannel = 0
+
+    def pooljob(self, writer, record, tree):
+        """Return the job for render_record for record from select. A
+        packet select has parsed already is written here with writer,
+        and the job is only its output."""
+        if None == tree:
+            return (record, active.context.rdp_channels.copy(), None)
+        writer.outfile = io.StringIO()
+        write_packet(writer, record, tree)
+        return (None, None, (record[7], writer.outfile.getvalue()))
+
+    def run(self, infile, outfile, outputformat, location, classnames,
+            infilename, wantedchannels, quiet, jobs=1, records=None,
+            flushinterval=0, splitname=None, connectrecords=None):
+        """Parse the capture in infile, or records, and write it to
+        outfile. See parse_rdpproxy."""
+        writerargs = (outputformat, location, classnames, infilename, quiet,
+                      output_encoding(self.fullunicode))
+        if None == records:
+            records = read_capture(infile)
+        if None != connectrecords:
+            for record in connectrecords:
+                self.parse(record)
+        writers = SessionWriters(make_writer(outfile, *writerargs),
+                                 writerargs, splitname)
+
+        if 1 < jobs and not location:
+            # The workers each get the channel table of the session as
+            # it was when the packet was read, everything else about a
+            # packet is decoded from the packet alone. Packets that
+            # depend on the ones before them, MCS connect and virtual
+            # channel chunks, are parsed and written here, and only
+            # passed through the pool. imap hands back the output in
+            # order.
+            pool = multiprocessing.Pool(jobs, init_pool_worker,
+                                        ((self.keymapname, self.keymappath,
+                                          self.lazy, self.fullunicode),
+                                         writerargs))
+            writer = make_writer(None, *writerargs)
+            work = (self.pooljob(writer, record, tree)
+                    for (record, tree) in
+                    self.select(records, wantedchannels, parseconnect=1,
+                                parsechannels=1))
+            for (session, output) in pool.imap(render_record, work, 16):
+                writers.get(session).outfile.write(output)
+            pool.close()
+            pool.join()
+            writers.flush()
+            writers.close()
+            return
+
+        # With a flushinterval, output is flushed at most that often.
+        lastflush = time.time()
+        for (record, tree) in self.select(records, wantedchannels):
+            if 1 == len(record):
+                writers.writer.writeunknown(record[0])
+            else:
+                write_packet(writers.get(record[7]), record, tree)
+            if flushinterval <= time.time()-lastflush:
+                writers.flush()
+                lastflush = time.time()
+        writers.flush()
+        writers.close()
+
+def make_writer(outfile, outputformat, location, classnames, infilename,
+                quiet, encoding='latin-1'):
+    if "TBL" == outputformat:
+        return TblWriter(outfile, location, classnames, infilename,
+                         encoding)
+    elif "LATEX" == outputformat:
+        return LatexWriter(outfile, location, classnames, infilename,
+                           encoding)
+    else:
+        return TxtWriter(outfile, quiet)
+
+# The Parser and writer of a pool worker process.
+poolworker = None
+
+def init_pool_worker(parserargs, writerargs):
+    global poolworker
+    poolworker = (Parser(*parserargs), make_writer(None, *writerargs))
+
+def render_record(job):
+    """Parse and write one record in a pool worker, returning its
+    session and the output as a string. Jobs for records written by
+    Parser.pooljob already are just that."""
+    (record, channels, output) = job
+    if None != output:
+        return output
+    (parser, writer) = poolworker
+    writer.outfile = io.StringIO()
+    if 1 == len(record):
+        writer.writeunknown(record[0])
+        return (None, writer.outfile.getvalue())
+    parser.context(record[7]).rdp_channels = channels
+    parser.write(writer, record)
+    return (record[7], writer.outfile.getvalue())
+
+class SessionWriters:
+    """The writer for each session. With a splitname, the packets of
+    each session are written to a file of their own,
+    splitname.<session>. The files of each session made with location
+    go to a directory of their own under it, with or without a
+    splitname, as the packet numbers they are named after start over
+    in each session. Everything else goes to writer."""
+
+    def __init__(self, writer, writerargs, splitname=None):
+        self.writer = writer
+        self.writerargs = writerargs
+        self.splitname = splitname
+        self.writers = {}
+
+    def get(self, session):
+        (outputformat, location, classnames, infilename, quiet,
+         encoding) = self.writerargs
+        if None == session or (None == self.splitname and not location):
+            return self.writer
+        writer = self.writers.get(session)
+        if None == writer:
+            if location:
+                location = os.path.join(location, "session%d" % session)
+                if not os.path.isdir(location):
+                    os.makedirs(location)
+            outfile = self.writer.outfile
+            if None != self.splitname:
+                outfile = open("%s.%d" % (self.splitname, session), 'w',
+                               encoding=encoding)
+            writer = make_writer(outfile, outputformat, location,
+                                 classnames, "%s-session%d" % (infilename,
+                                                               session),
+                                 quiet, encoding)
+            self.writers[session] = writer
+        return writer
+
+    def flush(self):
+        self.writer.outfile.flush()
+        for writer in self.writers.values():
+            writer.outfile.flush()
+
+    def close(self):
+        if None == self.splitname:
+            return
+        for writer in self.writers.values():
+            writer.outfile.close()
+
+def text_input(infile):
+    """Return infile, a binary file, as text for read_rdpproxy."""
+    if isinstance(infile, io.TextIOBase):
+        return infile
+    return io.TextIOWrapper(infile, encoding='latin-1', newline='')
+
+def read_capture(infile):
+    """Return the records of infile, whether it is a text, binary or
+    pcap capture. Only text captures can be read from a pipe."""
+    buf = map_capture(infile)
+    if None == buf:
+        return read_rdpproxy(text_input(infile))
+    if is_pcap(buf[:4]):
+        return read_pcap(infile)
+    return read_mapped(buf)
 
+def parse_rdpproxy(infile, outfile, outputformat, location,
+                   classnames, infilename, wantedchannels, quiet, lazy=0,
+                   jobs=1, records=None, flushinterval=0, splitname=None,
+                   fullunicode=0, connectrecords=None):
+    """Parse the capture in infile, or records, with a Parser of its
+    own and write it to outfile. connectrecords are MCS connect packets
+    left out of records, parsed first without being written so that
+    the channels of their sessions are known by name."""
+    Parser(lazy=lazy, fullunicode=fullunicode).run(infile, outfile,
+                                                   outputformat, location,
+                                                   classnames, infilename,
+                                                   wantedchannels, quiet,
+                                                   jobs, records,
+                                                   flushinterval, splitname,
+                                                   connectrecords)
 
-    
 def print_usage(progname):
-    print "%s <infile> <outfile>" % progname
-    print "<infile> and <outfile> may be '-' to use stdin/stdout"
-    print
-    print "OPTIONS is zero or more of the following:"
-    print "-f <outputformat> specifies that another format than text is wanted."
-    print "                  Possible formats are TXT (default), TBL and LATEX"
-    print "-l                Specifies where the files produced by the TBL and LATEX formats should be written."
-    print "                  When this flag is used, outfile can be left out"
-    print "-n                Use the names of the classes when printing out TBL and LATEX"
-    print "-c <channels>     Print only output from specific channels."
-    print "-q                Be quiet."
-    print "--help            Print this not very helpful message :-)"
-    print
+    print("%s <infile> <outfile>" % progname)
+    print("<infile> and <outfile> may be '-' to use stdin/stdout")
+    print("<infile> may also be a binary capture, written by rdpproxy -w,")
+    print("         but not on stdin")
+    print()
+    print("OPTIONS is zero or more of the following:")
+    print("-f <outputformat> specifies that another format than text is wanted.")
+    print("                  Possible formats are TXT (default), TBL and LATEX")
+    print("-l                Specifies where the files produced by the TBL and LATEX formats should be written.")
+    print("                  When this flag is used, outfile can be left out. The files")
+    print("                  of each session of a capture from rdprelay.py -w go to")
+    print("                  <location>/session<session>.")
+    print("-n                Use the names of the classes when printing out TBL and LATEX")
+    print("-c <channels>     Print only output from specific channels.")
+    print("-q                Be quiet.")
+    print("-z                Decode packet contents only when they are printed.")
+    print("                  Implied by -c.")
+    print("-j <jobs>         Parse using this many processes. Not used together with -l.")
+    print("-u                Print Unicode strings in full, not only their Latin-1")
+    print("                  characters, and write the output as UTF-8.")
+    print("--follow          Print packets as soon as rdpproxy has written them, for")
+    print("                  ./rdpproxy | ./pparser.py --follow - -. A file is followed")
+    print("                  past its end until interrupted. Parses in one process.")
+    print("--sessions        Write the packets of each session (in a capture from")
+    print("                  rdprelay.py -w, or each connection in a pcap file) to")
+    print("                  <outfile>.<session>.")
+    print("--profile         Print time spent and bytes consumed by each parser class.")
+    print("                  Parses in one process, whatever -j says.")
+    print("--pcap <file>     Write the packets to <file> as pcap, each session as a")
+    print("                  made up TCP connection of its own, instead of printing")
+    print("                  them. <infile> may itself be a pcap or pcapng file of")
+    print("                  decrypted traffic.")
+    print("--index           Write an index of <infile> to <infile>.idx. It is")
+    print("                  used to go straight to the packets asked for by")
+    print("                  --packets, --direction and -c, and is made when")
+    print("                  needed by the first two.")
+    print("--packets <first>-<last>[,...]")
+    print("                  Print only these packets (by total packet number).")
+    print("                  Only packets are printed with --packets and --direction.")
+    print("--direction <Server|Client>")
+    print("                  Print only packets from the server or the client.")
+    print("--help            Print this not very helpful message :-)")
+    print()
     
 if '__main__' == __name__:
-    now = time.time()
-    optlist, args = getopt.getopt(sys.argv[1:], 'f:l:ni:c:q')
+    now = time.perf_counter()
+    optlist, args = getopt.getopt(sys.argv[1:], 'f:l:ni:c:qzj:u',
+                                  ['help', 'index', 'packets=',
+                                   'direction=', 'pcap=', 'profile',
+                                   'follow', 'sessions'])
 
     outputformat = "TXT"
     location = None
@@ -2991,6 +4993,16 @@ if '__main__' == __name__:
     ltxindex_out = None
     channels = []
     quiet = 0
+    lazy = 0
+    fullunicode = 0
+    jobs = 1
+    makeindex = 0
+    packets = None
+    direction = None
+    pcapname = None
+    profile = 0
+    follow = 0
+    splitsessions = 0
     for arg, opt in optlist:
         if '-f' == arg:
             outputformat = opt
@@ -2999,34 +5011,134 @@ if '__main__' == __name__:
         if '-n' == arg:
             classnames = 1
         if '-c' == arg:
-            channels = map(int, opt.split(','))
+            channels = list(map(int, opt.split(',')))
+            lazy = 1
         if '-q' == arg:
             quiet = 1
+        if '-z' == arg:
+            lazy = 1
+        if '-j' == arg:
+            jobs = int(opt)
+        if '-u' == arg:
+            fullunicode = 1
+        if '--index' == arg:
+            makeindex = 1
+        if '--packets' == arg:
+            packets = []
+            for r in opt.split(','):
+                r = list(map(int, r.split('-')))
+                packets.append((r[0], r[-1]))
+        if '--direction' == arg:
+            direction = opt
+        if '--pcap' == arg:
+            pcapname = opt
+        if '--profile' == arg:
+            profile = 1
+            enable_profiling()
+        if '--follow' == arg:
+            follow = 1
+        if '--sessions' == arg:
+            splitsessions = 1
         if '--help' == arg:
             print_usage(sys.argv[0])
             sys.exit(0)            
 
-    if len(args) < 2 and not location:
+    if len(args) < 2 and not location and not makeindex and not pcapname:
         print_usage(sys.argv[0])
         sys.exit(0)
 
-    infile = sys.stdin
+    infile = sys.stdin.buffer
+    sys.stdout.reconfigure(encoding=output_encoding(fullunicode))
     outfile = sys.stdout
 
     infilename = "stdin"
 
     if '-' != args[0]:
         infilename = os.path.basename(args[0])
-        infile = open(args[0], 'r')
-    if not location and '-' != args[1]:
-        outfile = open(args[1], 'w')
-
-    parse_rdpproxy(infile, outfile, outputformat, location,
-                   classnames, infilename, channels, quiet)
-
-    print "Total processing time: %.2f seconds" % (time.time() - now)
+        infile = open(args[0], 'rb')
+
+    if '-' == args[0] and (makeindex or packets or direction):
+        print("--index, --packets and --direction need a file to read from", file=sys.stderr)
+        sys.exit(1)
+
+    splitname = None
+    if splitsessions:
+        if len(args) < 2 or '-' == args[1]:
+            print("--sessions needs an <outfile> to name the files of the sessions after", file=sys.stderr)
+            sys.exit(1)
+        splitname = args[1]
+
+    if follow and (makeindex or packets or direction):
+        print("--follow does not go together with --index, --packets and --direction", file=sys.stderr)
+        sys.exit(1)
+
+    if '-' != args[0] and (makeindex or packets or direction):
+        if is_pcap(infile.read(4)):
+            print("--index, --packets and --direction do not work on pcap files", file=sys.stderr)
+            sys.exit(1)
+        infile.seek(0)
+
+    records = None
+    connectrecords = None
+    if '-' != args[0] and (makeindex or packets or direction or channels):
+        index = load_index(args[0])
+        if makeindex or (None == index and (packets or direction)):
+            save_index(args[0], build_index(infile))
+            index = load_index(args[0])
+        if makeindex:
+            sys.exit(0)
+        # Without channel 0, the packets -c lets through are exactly
+        # the ones carrying one of the channels in their header. Lines
+        # that are not packets are lost, so only use the index for -c
+        # when those are not printed anyway.
+        if None != index and 0 not in channels and \
+           (packets or direction or quiet or "TXT" != outputformat):
+            selected = select_index(index, packets, direction, channels)
+            records = read_indexed(infile, selected)
+            # The channel table of a session comes from its MCS
+            # connect packets, wherever they are.
+            offsets = set([entry[0] for entry in selected])
+            connectrecords = read_indexed(infile,
+                                          [entry for entry in
+                                           index.connectentries()
+                                           if entry[0] not in offsets])
+
+    if None != pcapname:
+        if None == records:
+            records = read_capture(infile)
+        if 0 < len(channels):
+            records = (record for (record, tree) in
+                       Parser(lazy=lazy).select(records, channels))
+        pcapfile = open(pcapname, 'wb')
+        write_pcap(pcapfile, records)
+        pcapfile.close()
+    else:
+        if not location and '-' != args[1]:
+            outfile = open(args[1], 'w',
+                           encoding=output_encoding(fullunicode))
+
+        flushinterval = 0
+        if follow:
+            records = follow_rdpproxy(infile, outfile.flush)
+            flushinterval = 0.2
+        if profile or follow:
+            jobs = 1
+        try:
+            parse_rdpproxy(infile, outfile, outputformat, location,
+                           classnames, infilename, channels, quiet, lazy,
+                           jobs, records, flushinterval, splitname,
+                           fullunicode, connectrecords)
+        except KeyboardInterrupt:
+            if not follow: # Interrupting is how following ends.
+                raise
+            outfile.flush()
+
+    if profile:
+        print_profile(sys.stdout, time.perf_counter() - now)
+    else:
+        print("Total processing time: %.2f seconds" % (time.perf_counter() - now))
 
-    if sys.stdin != outfile: 
+    if sys.stdin.buffer != infile:
         infile.close()
     if sys.stdout != outfile:
         outfile.close()
@@ -6,7 +6,8 @@
 #define _GNU_SOURCE
 #include <stdio.h>		/* perror */
 #include <string.h>
-#include <unistd.h>		/* select read write close */
+#include <unistd.h>		/* select read write close getopt */
+#include <sys/time.h>		/* gettimeofday */
 #include <fcntl.h>		/* open */
 #include <sys/socket.h>		/* socket bind listen accept connect */
 #include <netinet/in.h>		/* htons htonl */
@@ -68,6 +69,18 @@ static int client_key_subst_done;
 static int compression_substs_done;
 static int faked_packet;
 
+/* Binary capture (rdpproxy -w file), read by pparser.py. The file
+   starts with capture_magic, followed by one record per PDU: seven
+   32-bit big endian words (record length including these words,
+   seconds, microseconds, total packet number, packet number in its
+   direction, direction CLIENT/SERVER, type 0 TPKT/1 RDP5) and the
+   decrypted PDU bytes. Faked packets have packet numbers 0. */
+static const unsigned char capture_magic[] = { 'R', 'D', 'P', 'C', 'A', 'P', 0x00, 0x01 };
+static FILE *capture_file;
+static int capture_part;
+static unsigned int capture_total_packetnr;
+static unsigned int capture_part_packetnr;
+
 void sec_decrypt(uint8 * data, int length);
 void sec_encrypt(uint8 * data, int length);
 
@@ -108,6 +121,46 @@ hexdump(unsigned char *p, int len)
 	fflush(stdout);
 }
 
+/* write a PDU as a record to the binary capture */
+static void
+write_record(unsigned char *p, int len)
+{
+	struct timeval tv;
+	uint32 header[7];
+
+	gettimeofday(&tv, NULL);
+	header[0] = htonl(sizeof(header) + len);
+	header[1] = htonl(tv.tv_sec);
+	header[2] = htonl(tv.tv_usec);
+	if (faked_packet)
+	{
+		header[3] = header[4] = 0;
+		header[5] = htonl(SERVER);
+		faked_packet = 0;
+	}
+	else
+	{
+		header[3] = htonl(capture_total_packetnr);
+		header[4] = htonl(capture_part_packetnr);
+		header[5] = htonl(capture_part);
+	}
+	header[6] = htonl(p[0] == 3 ? 0 : 1);
+
+	fwrite(header, sizeof(header), 1, capture_file);
+	fwrite(p, len, 1, capture_file);
+	fflush(capture_file);
+}
+
+/* dump a relayed PDU, to the binary capture if there is one */
+static void
+dump_pdu(unsigned char *p, int len)
+{
+	if (capture_file)
+		write_record(p, len);
+	else
+		hexdump(p, len);
+}
+
 /* reverse an array in situ */
 static void
 reverse(unsigned char *p, unsigned int len)
@@ -450,7 +503,7 @@ decrypt(unsigned char *buffer, unsigned int len, void (*fn) (unsigned char *buff
 	}
 
 	if (server_key_subst_done)
-		hexdump(buffer, len);
+		dump_pdu(buffer, len);
 }
 
 static void
@@ -537,14 +590,14 @@ decrypt_client(unsigned char *buffer, unsigned int len, int server)
 		sec_sign_buf(signature, 8, buffer + skip, len - skip);
 		printf("Signature should be ");
 		hexdump(signature, 8);
-		hexdump(buffer, len);
+		dump_pdu(buffer, len);
 		memcpy(buffer + skip - 8, signature, 8);
 		sec_encrypt2(buffer + skip, len - skip);
 	}
 	else
 	{
 		printf("Can't decrypt, haven't seen client random!\n");
-		hexdump(buffer, len);
+		dump_pdu(buffer, len);
 	}
 
 	send(server, buffer, len, 0);
@@ -566,20 +619,27 @@ recv_pdu(int fd, unsigned char *buffer, unsigned int len, int part)
 	if (res <= 0)
 		return res;
 
+	capture_part = part;
+	capture_total_packetnr = ++total_packetnr;
 	if (CLIENT == part)
 	{
-		printf("#%d, #%d from Client, ", ++total_packetnr, ++clnt_packetnr);
+		capture_part_packetnr = ++clnt_packetnr;
+		if (!capture_file)
+			printf("#%d, #%d from Client, ", total_packetnr, clnt_packetnr);
 	}
 	else
 	{
-		printf("#%d, #%d from Server, ", ++total_packetnr, ++srvr_packetnr);
+		capture_part_packetnr = ++srvr_packetnr;
+		if (!capture_file)
+			printf("#%d, #%d from Server, ", total_packetnr, srvr_packetnr);
 	}
 
 
 	if (buffer[0] == 3)	/* ISO over TCP */
 	{
 		pdulen = ((unsigned int) buffer[2] << 8) | buffer[3];
-		printf("type TPKT, l: %d, ", pdulen);
+		if (!capture_file)
+			printf("type TPKT, l: %d, ", pdulen);
 
 	}
 	else			/* assume RDP5 style packet */
@@ -588,7 +648,8 @@ recv_pdu(int fd, unsigned char *buffer, unsigned int len, int part)
 
 		if (pdulen & 0x80)
 			pdulen = ((pdulen & 0x7f) << 8) | buffer[2];
-		printf("type RDP5, l: %d, ", pdulen);
+		if (!capture_file)
+			printf("type RDP5, l: %d, ", pdulen);
 	}
 
 	if (pdulen > len)
@@ -601,7 +662,8 @@ recv_pdu(int fd, unsigned char *buffer, unsigned int len, int part)
 	if (res <= 0)
 		return res;
 
-	printf("read %d bytes\n", res + 4);
+	if (!capture_file)
+		printf("read %d bytes\n", res + 4);
 
 	return (res + 4);
 }
@@ -656,7 +718,7 @@ relay(int client, int server)
 			}
 			if (!server_key_subst_done)
 			{
-				hexdump(buffer, len);
+				dump_pdu(buffer, len);
 			}
 			len = substitute_server(buffer, len);
 			send(client, buffer, len, 0);
@@ -675,12 +737,34 @@ main(int argc, char *argv[])
 	unsigned char privkey_buffer[1024];
 	unsigned char *privkey = privkey_buffer;
 	int true = 1;
-	int n;
+	int n, c;
+
+	while ((c = getopt(argc, argv, "w:")) != -1)
+	{
+		switch (c)
+		{
+			case 'w':
+				if (NULL == (capture_file = fopen(optarg, "wb")))
+				{
+					perror(optarg);
+					return 1;
+				}
+				fwrite(capture_magic, sizeof(capture_magic), 1, capture_file);
+				break;
+
+			default:
+				printf("Usage: rdpproxy [-w capturefile] <server ip>\n");
+				return 1;
+		}
+	}
+	/* leave the server address in argv[1] */
+	argc -= optind - 1;
+	argv += optind - 1;
 
 #ifndef LINUX_NETFILTER
 	if (argc < 2)
 	{
-		printf("Usage: rdpproxy <server ip>\n");
+		printf("Usage: rdpproxy [-w capturefile] <server ip>\n");
 		return 1;
 	}
 #endif
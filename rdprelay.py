@@ -0,0 +1,188 @@
+#!/usr/bin/python3
+
+# Relay for many RDP connections at once, decoding the PDUs with
+# pparser.py as they pass. Unlike rdpproxy it does not substitute any
+# keys, so only what the client and server send in the clear (the
+# connection sequence, or whole sessions without encryption) decodes
+# to more than raw data.
+
+import asyncio
+import getopt
+import sys
+import time
+import traceback
+
+import pparser
+
+CLIENT = 0
+SERVER = 1
+
+class Session:
+    """A relayed connection. PDUs in both directions are numbered the
+    way rdpproxy numbers them and decoded with a pparser.Parser of the
+    session's own."""
+
+    def __init__(self, relay, sessionid):
+        self.relay = relay
+        self.sessionid = sessionid
+        self.streams = [pparser.PDUStream(), pparser.PDUStream()]
+        self.totpacketno = 0
+        self.partpacketnos = [0, 0]
+        self.parser = pparser.Parser()
+
+    async def run(self, clientreader, clientwriter):
+        try:
+            (serverreader, serverwriter) = \
+                await asyncio.open_connection(*self.relay.server)
+        except OSError as e:
+            self.error(e)
+            clientwriter.close()
+            return
+        await asyncio.gather(self.pipe(CLIENT, clientreader, serverwriter),
+                             self.pipe(SERVER, serverreader, clientwriter))
+
+    async def pipe(self, part, reader, writer):
+        """Send what is read from one end on to the other, then hand it
+        to the session. Reading waits while the other end has more
+        than maxbuffered bytes left to send. When either end closes,
+        the other is closed once everything has been sent to it."""
+        writer.transport.set_write_buffer_limits(self.relay.maxbuffered)
+        try:
+            while 1:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                writer.write(data)
+                self.received(part, data)
+                await writer.drain()
+        except OSError as e:
+            self.error(e)
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+    def error(self, e):
+        print("Session %d: %s" % (self.sessionid, e), file=sys.stderr)
+
+    def received(self, part, data):
+        stream = self.streams[part]
+        stream.feed(data)
+        for pdu in stream.pdus():
+            self.totpacketno+=1
+            self.partpacketnos[part]+=1
+            self.relay.record(self, pparser.pdu_record(self.totpacketno,
+                                                       self.partpacketnos[part],
+                                                       part, 3 != pdu[0], pdu,
+                                                       time.time(),
+                                                       self.sessionid))
+
+class Relay:
+    """Relays each client accepted to server in a Session of its own.
+    Records are written to outfile with writer, and to capfile as a
+    text capture. Both are flushed every flushinterval seconds, as
+    with pparser.py --follow, instead of after each PDU."""
+
+    maxbuffered = 1 << 20
+    flushinterval = 0.2
+
+    def __init__(self, server, outfile, writer, capfile=None):
+        self.server = server
+        self.outfile = outfile
+        self.writer = writer
+        self.capfile = capfile
+        self.sessions = 0
+        self.flushing = None
+
+    async def listen(self, port, host=None):
+        """Start accepting clients on port, and return the
+        asyncio.Server doing it."""
+        if None == self.flushing:
+            self.flushing = asyncio.ensure_future(self.flushoutput())
+        return await asyncio.start_server(self.accept, host, port,
+                                          backlog=16, reuse_address=True)
+
+    async def flushoutput(self):
+        while 1:
+            await asyncio.sleep(self.flushinterval)
+            self.flush()
+
+    def flush(self):
+        if None != self.capfile:
+            self.capfile.flush()
+        self.outfile.flush()
+
+    async def accept(self, reader, writer):
+        self.sessions+=1
+        session = Session(self, self.sessions)
+        address = writer.get_extra_info('peername')
+        print("Session %d from %s:%d" % (session.sessionid, address[0],
+                                         address[1]), file=sys.stderr)
+        await session.run(reader, writer)
+        self.flush()
+
+    def record(self, session, record):
+        if None != self.capfile:
+            self.capfile.write(record[0])
+            self.capfile.write(pparser.format_hexdump(record[5]))
+        if None == self.writer:
+            return
+        try:
+            session.parser.write(self.writer, record)
+        except Exception:
+            print("Session %d: could not parse packet #%d" % \
+                  (session.sessionid, record[2]), file=sys.stderr)
+            traceback.print_exc()
+
+async def serve(relay, port):
+    server = await relay.listen(port)
+    async with server:
+        await server.serve_forever()
+
+def print_usage(progname):
+    print("%s [OPTIONS] <server> [port]" % progname)
+    print("Relay RDP connections to <server>, printing the PDUs of each of")
+    print("them as pparser.py does, tagged with a session number.")
+    print()
+    print("-p <port>      Port to listen on, default 3389")
+    print("-o <outfile>   Write the decoded packets to <outfile> instead of stdout")
+    print("-w <capfile>   Also write the PDUs to <capfile> as an rdpproxy capture")
+    print("-q             Do not decode, only relay (and write <capfile>)")
+
+if '__main__' == __name__:
+    optlist, args = getopt.getopt(sys.argv[1:], 'p:o:w:qh')
+    port = pparser.rdpport
+    # Decoded strings are Latin-1, as in the captures.
+    sys.stdout.reconfigure(encoding='latin-1')
+    outfile = sys.stdout
+    capfile = None
+    decode = 1
+    for opt, arg in optlist:
+        if '-p' == opt:
+            port = int(arg)
+        if '-o' == opt:
+            outfile = open(arg, 'w', encoding='latin-1')
+        if '-w' == opt:
+            capfile = open(arg, 'w', encoding='latin-1')
+        if '-q' == opt:
+            decode = 0
+        if '-h' == opt:
+            print_usage(sys.argv[0])
+            sys.exit(0)
+
+    if len(args) < 1:
+        print_usage(sys.argv[0])
+        sys.exit(1)
+
+    server = (args[0], pparser.rdpport)
+    if 1 < len(args):
+        server = (args[0], int(args[1]))
+
+    writer = None
+    if decode:
+        writer = pparser.TxtWriter(outfile)
+    try:
+        asyncio.run(serve(Relay(server, outfile, writer, capfile), port))
+    except KeyboardInterrupt:
+        pass
@@ -1,2 +1,2 @@
 #!/bin/sh
-./rdpproxy | ./pparser.py - -  | grep Key
+./rdpproxy | ./pparser.py --follow - - | grep Key
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+# Tests of how pparser.py puts virtual channel PDUs sent in several
+# chunks back together, and what it shows of chunks that do not add up
+# to a PDU.
+
+import os
+import struct
+import sys
+import unittest
+
+testdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(testdir))
+
+import pparser
+
+FIRST = pparser.CHANNEL_FLAG_FIRST
+LAST = pparser.CHANNEL_FLAG_LAST
+MIDDLE = 0
+
+class ChannelChunkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.context = pparser.ParserContext()
+        # Channels without a decoder, so that PDUs show as raw data.
+        self.context.rdp_channels = {0:("testchan", 0), 1:("otherchan", 0)}
+        pparser.use_context(self.context)
+
+    def chunk(self, length, flags, data, channelid=1004):
+        """Parse a chunk of a PDU of length bytes from the client, and
+        return the descriptions of what it is shown as, and the text."""
+        part = pparser.VirtualChannelData(channelid, "Client")
+        part.parse(pparser.PacketData(struct.pack("<II", length, flags)+
+                                      data))
+        return ([p.description for p in part.value[2:]], str(part))
+
+    def test_reassembled(self):
+        self.assertEqual(["testchan data, first of several"],
+                         self.chunk(10, FIRST, b"abcd")[0])
+        self.assertEqual(["testchan data, middle of several"],
+                         self.chunk(10, MIDDLE, b"efg")[0])
+        (descriptions, text) = self.chunk(10, LAST, b"hij")
+        self.assertEqual(["testchan data, last of several",
+                          "testchan data (reassembled)"], descriptions)
+        self.assertIn("abcdefghij", text)
+        self.assertEqual({}, self.context.channelchunks)
+
+    def test_missing_middle(self):
+        self.chunk(10, FIRST, b"abcd")
+        (descriptions, text) = self.chunk(10, LAST, b"hij")
+        self.assertEqual(["testchan data, incomplete (4 of 10 bytes)",
+                          "testchan data, last chunk of several"],
+                         descriptions)
+        self.assertIn("abcd", text)
+        self.assertIn("hij", text)
+        self.assertEqual({}, self.context.channelchunks)
+
+    def test_last_too_long(self):
+        self.chunk(10, FIRST, b"abcd")
+        self.assertEqual(["testchan data, incomplete (4 of 10 bytes)",
+                          "testchan data, last chunk of several"],
+                         self.chunk(10, LAST, b"efghijk")[0])
+        self.assertEqual({}, self.context.channelchunks)
+
+    def test_first_while_pending(self):
+        self.chunk(10, FIRST, b"abcd")
+        self.assertEqual(["testchan data, incomplete (4 of 10 bytes)",
+                          "testchan data, first of several"],
+                         self.chunk(6, FIRST, b"xyz")[0])
+        (descriptions, text) = self.chunk(6, LAST, b"uvw")
+        self.assertEqual(["testchan data, last of several",
+                          "testchan data (reassembled)"], descriptions)
+        self.assertIn("xyzuvw", text)
+
+    def test_length_mismatch(self):
+        self.chunk(10, FIRST, b"abcd")
+        self.assertEqual(["testchan data, incomplete (4 of 10 bytes)",
+                          "testchan data, middle chunk of several"],
+                         self.chunk(12, MIDDLE, b"efg")[0])
+        # The rest of the PDU is shown as it is too.
+        self.assertEqual(["testchan data, last chunk of several"],
+                         self.chunk(10, LAST, b"hij")[0])
+
+    def test_over_maxlength(self):
+        length = pparser.ChannelAssembly.maxlength+1
+        self.assertEqual(["testchan data, first chunk of several"],
+                         self.chunk(length, FIRST, b"abcd")[0])
+        self.assertEqual({}, self.context.channelchunks)
+        self.assertEqual(["testchan data, last chunk of several"],
+                         self.chunk(length, LAST, b"efgh")[0])
+
+    def test_over_maxtotal(self):
+        maxtotal = pparser.ChannelAssembly.maxtotal
+        pparser.ChannelAssembly.maxtotal = 10
+        try:
+            self.chunk(20, FIRST, b"abcdef", 1004)
+            # Together with the PDU pending on 1004, this would take
+            # more than maxtotal.
+            self.assertEqual(["otherchan data, first chunk of several"],
+                             self.chunk(20, FIRST, b"ghijk", 1005)[0])
+            self.assertEqual([(1004, "Client")],
+                             list(self.context.channelchunks))
+            self.assertEqual(["testchan data, middle of several"],
+                             self.chunk(20, MIDDLE, b"lmn", 1004)[0])
+        finally:
+            pparser.ChannelAssembly.maxtotal = maxtotal
+
+    def test_channels_apart(self):
+        self.chunk(6, FIRST, b"abc", 1004)
+        self.chunk(6, FIRST, b"xyz", 1005)
+        self.assertIn("abcdef", self.chunk(6, LAST, b"def", 1004)[1])
+        self.assertIn("xyzuvw", self.chunk(6, LAST, b"uvw", 1005)[1])
+
+if '__main__' == __name__:
+    unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# Golden corpus tests for pparser.py. Each variant runs pparser.py with
+# some options on one of the captures in tests/captures, and the exit
+# status and the SHA-1 of every file it writes must match
+# tests/golden/<variant>.sha1. After an intended change of the
+# output, rewrite them with
+#
+#   python3 tests/test_golden.py --update
+
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+testdir = os.path.dirname(os.path.abspath(__file__))
+pparser = os.path.join(os.path.dirname(testdir), "pparser.py")
+
+# (variant, capture, options). OUT stands for the directory the output
+# goes to; unless it is among the options, pparser.py writes to
+# OUT/output.
+variants = [("txt", "session.txt", []),
+            ("quiet", "session.txt", ["-q"]),
+            ("lazy", "session.txt", ["-z"]),
+            ("channel", "session.txt", ["-c", "1005"]),
+            ("channels-quiet", "session.txt", ["-q", "-c", "1003,1006"]),
+            ("packets", "session.txt", ["--packets", "1-10,30-40"]),
+            ("direction", "session.txt", ["--direction", "Server"]),
+            ("packets-channels", "session.txt", ["--packets", "40-56"]),
+            ("jobs", "session.txt", ["-j", "2"]),
+            ("unicode", "session.txt", ["-u"]),
+            ("tbl", "session.txt", ["-f", "TBL"]),
+            ("tbl-files", "session.txt", ["-f", "TBL", "-l", "OUT"]),
+            ("latex-names", "session.txt", ["-f", "LATEX", "-n", "-l", "OUT"]),
+            ("sessions-tbl-files", "sessions.txt", ["-f", "TBL", "-l", "OUT"]),
+            ("sessions", "sessions.txt", ["--sessions"]),
+            ("sessions-jobs", "sessions.txt", ["--sessions", "-j", "2"]),
+            ("pcap-export", "session.txt", ["--pcap", "OUT/session.pcap"]),
+            ("binary", "session.bin", []),
+            ("binary-channel", "session.bin", ["-c", "1005"]),
+            ("pcap", "session.pcap", []),
+            ("pcap-gap", "gap.pcap", []),
+            ("pcap-midstream", "midstream.pcap", []),
+            ("pcap-reuse", "reuse.pcap", [])]
+
+def run_variant(python, capture, options, workdir):
+    """Run pparser.py with python on a copy of capture in workdir, and
+    return its exit status and the manifest of what it wrote."""
+    outdir = os.path.join(workdir, "out")
+    os.mkdir(outdir)
+    infile = os.path.join(workdir, capture)
+    shutil.copy(os.path.join(testdir, "captures", capture), infile)
+    args = [arg.replace("OUT", outdir) for arg in options]+[infile]
+    if "--pcap" in options:
+        args.append(os.devnull)
+    elif "OUT" not in options:
+        args.append(os.path.join(outdir, "output"))
+    # Run in tests, for tests/keymaps.
+    status = subprocess.call([python, pparser]+args, cwd=testdir,
+                             stdout=subprocess.DEVNULL)
+    return "exit %d\n%s" % (status, manifest(outdir))
+
+def manifest(outdir):
+    lines = []
+    for (dirpath, dirnames, filenames) in os.walk(outdir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            f = open(path, 'rb')
+            lines.append("%s  %s\n" % (hashlib.sha1(f.read()).hexdigest(),
+                                       os.path.relpath(path, outdir)))
+            f.close()
+    lines.sort(key=lambda line: line[42:])
+    return "".join(lines)
+
+def golden_filename(variant):
+    return os.path.join(testdir, "golden", variant+".sha1")
+
+class GoldenTest(unittest.TestCase):
+
+    def check(self, variant, capture, options):
+        workdir = tempfile.mkdtemp()
+        try:
+            result = run_variant(sys.executable, capture, options, workdir)
+        finally:
+            shutil.rmtree(workdir)
+        f = open(golden_filename(variant))
+        expected = f.read()
+        f.close()
+        self.assertEqual(expected, result)
+
+for (variant, capture, options) in variants:
+    setattr(GoldenTest, "test_"+variant.replace("-", "_"),
+            lambda self, v=(variant, capture, options): self.check(*v))
+
+def update(python=sys.executable):
+    for (variant, capture, options) in variants:
+        workdir = tempfile.mkdtemp()
+        try:
+            result = run_variant(python, capture, options, workdir)
+        finally:
+            shutil.rmtree(workdir)
+        f = open(golden_filename(variant), 'w')
+        f.write(result)
+        f.close()
+
+if '__main__' == __name__:
+    if "--update" in sys.argv:
+        update()
+    else:
+        unittest.main()
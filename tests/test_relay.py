@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+# Loopback test for rdprelay.py. Several clients at once play the
+# client side of tests/captures/session.txt through the relay to a
+# stand-in server playing the server side, each end sending its PDUs
+# only once it has all the PDUs before them from the other. Both ends
+# must get exactly what the other sent, and the relay must decode each
+# session as pparser.py decodes its PDUs on their own.
+
+import asyncio
+import io
+import os
+import re
+import sys
+import unittest
+
+testdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(testdir))
+
+import pparser
+import rdprelay
+
+clients = 4
+
+def capture_pdus(capture):
+    """Return the (part, PDU) of each packet in capture, leaving out
+    the one rdpproxy fakes."""
+    f = open(os.path.join(testdir, "captures", capture), 'rb')
+    pdus = [(("Client", "Server").index(record[1]),
+             bytes(pparser.packet_bytes(record[5])))
+            for record in pparser.read_capture(f)
+            if 1 < len(record) and 0 != record[2]]
+    f.close()
+    return pdus
+
+def decode(pdus, sessionid):
+    """Return what the relay should print for session sessionid."""
+    outfile = io.StringIO()
+    writer = pparser.TxtWriter(outfile)
+    parser = pparser.Parser()
+    partpacketnos = [0, 0]
+    for (totpacketno, (part, pdu)) in enumerate(pdus):
+        partpacketnos[part]+=1
+        parser.write(writer, pparser.pdu_record(totpacketno+1,
+                                                partpacketnos[part], part,
+                                                3 != pdu[0], pdu, 0,
+                                                sessionid))
+    return outfile.getvalue()
+
+def split_sessions(output):
+    """Split the output of the relay by the session tag of the header
+    lines."""
+    sessions = {}
+    lines = None
+    for line in output.splitlines(True):
+        match = re.match(r"#\d+, #\d+ from .*, session (\d+)$", line)
+        if None != match:
+            lines = sessions.setdefault(int(match.group(1)), [])
+        lines.append(line)
+    return dict((sessionid, "".join(lines))
+                for (sessionid, lines) in sessions.items())
+
+async def play(part, pdus, reader, writer):
+    """Play part of pdus on a connection: send the PDUs of part, a few
+    bytes at a time, and wait for those of the other part. Returns
+    what was read."""
+    received = bytearray()
+    for (pdupart, pdu) in pdus:
+        if part == pdupart:
+            for offset in range(0, len(pdu), 7):
+                writer.write(pdu[offset:offset+7])
+                await writer.drain()
+        else:
+            received+=await reader.readexactly(len(pdu))
+    return received
+
+class RelayTest(unittest.TestCase):
+
+    def setUp(self):
+        # Run in tests, for tests/keymaps.
+        self.cwd = os.getcwd()
+        os.chdir(testdir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+
+    def test_concurrent_sessions(self):
+        pdus = capture_pdus("session.txt")
+        # Each client stops a few PDUs earlier than the one before, so
+        # that no two sessions print the same.
+        played = [pdus[:len(pdus)-3*i] for i in range(clients)]
+        outfile = io.StringIO()
+        (toclients, toserver) = asyncio.run(asyncio.wait_for(
+            self.relay(played, outfile), 60))
+        for i in range(clients):
+            client = b"".join([pdu for (part, pdu) in played[i]
+                               if rdprelay.CLIENT == part])
+            server = b"".join([pdu for (part, pdu) in played[i]
+                               if rdprelay.SERVER == part])
+            self.assertEqual(server, toclients[i])
+            self.assertEqual(client, toserver[i])
+        output = split_sessions(outfile.getvalue())
+        self.assertEqual(list(range(1, clients+1)), sorted(output))
+        for i in range(clients):
+            self.assertEqual(decode(played[i], i+1), output[i+1])
+
+    async def relay(self, played, outfile):
+        """Relay the played PDUs of each client at once. Returns what
+        the clients got from the server, and what the server got from
+        each of them, in the order of the sessions."""
+        serverconnections = []
+        serverdone = [asyncio.get_running_loop().create_future()
+                      for i in range(clients)]
+
+        async def serve(reader, writer):
+            # Clients connect one at a time, so the connections to the
+            # server come in the order of the sessions.
+            i = len(serverconnections)
+            serverconnections.append(writer)
+            received = await play(rdprelay.SERVER, played[i], reader, writer)
+            # Nothing more is to come.
+            received+=await reader.read()
+            writer.close()
+            serverdone[i].set_result(received)
+
+        server = await asyncio.start_server(serve, "127.0.0.1", 0)
+        serverport = server.sockets[0].getsockname()[1]
+        relay = rdprelay.Relay(("127.0.0.1", serverport), outfile,
+                               pparser.TxtWriter(outfile))
+        listener = await relay.listen(0, "127.0.0.1")
+        port = listener.sockets[0].getsockname()[1]
+        connections = []
+        for i in range(clients):
+            connections.append(await asyncio.open_connection("127.0.0.1",
+                                                             port))
+            while len(serverconnections) <= i:
+                await asyncio.sleep(0.01)
+        toclients = await asyncio.gather(*[play(rdprelay.CLIENT, played[i],
+                                                *connections[i])
+                                           for i in range(clients)])
+        for (reader, writer) in connections:
+            writer.close()
+        toserver = await asyncio.gather(*serverdone)
+        listener.close()
+        server.close()
+        return (toclients, toserver)
+
+if '__main__' == __name__:
+    unittest.main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+# Tests of how pparser.py prints Unicode strings: as Latin-1, with a
+# placeholder for everything else, or with -u (fullunicode) in full.
+
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+testdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(testdir))
+
+import pparser
+
+# What UnicodeString prints for each UTF-16 unit it cannot print.
+PLACEHOLDER = "\xa7"
+
+def utf16(s):
+    return s.encode('utf-16-le', 'surrogatepass')
+
+class UnicodeStringTest(unittest.TestCase):
+
+    def parse(self, data, fullunicode=0, rest=b"rest"):
+        pparser.use_context(pparser.ParserContext(fullunicode=fullunicode))
+        part = pparser.UnicodeString("Test", (len(data)+1)//2)
+        left = part.parse(pparser.PacketData(data+rest))
+        self.assertEqual(rest, bytes(left))
+        return part.value
+
+    def test_latin1(self):
+        for fullunicode in (0, 1):
+            self.assertEqual("Ab\xe9.",
+                             self.parse(utf16("Ab\xe9\0"), fullunicode))
+
+    def test_odd_length(self):
+        # A string cut short by the end of the packet, with an odd byte
+        # last. It counts as a character with a zero high byte.
+        self.assertEqual("AB", self.parse(utf16("A")+b"B", rest=b""))
+        self.assertEqual("€B", self.parse(utf16("€")+b"B", 1, b""))
+
+    def test_beyond_latin1(self):
+        # The euro sign, a character outside the BMP (a surrogate pair)
+        # and a lone surrogate, among Latin-1 and a NUL.
+        data = utf16("A€\xe9\U0001f600\ud800Z\0")
+        self.assertEqual("A"+PLACEHOLDER+"\xe9"+2*PLACEHOLDER+
+                         PLACEHOLDER+"Z.", self.parse(data))
+        self.assertEqual("A€\xe9\U0001f600"+PLACEHOLDER+"Z.",
+                         self.parse(data, 1))
+
+    def test_lone_low_surrogate(self):
+        data = utf16("\udc00x")
+        self.assertEqual(PLACEHOLDER+"x", self.parse(data))
+        self.assertEqual(PLACEHOLDER+"x", self.parse(data, 1))
+
+class UnicodeOutputTest(unittest.TestCase):
+    """Files written in a location are in the encoding of the parser."""
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def connect_initial(self, hostname):
+        """The MCS connect initial of captures/session.txt, with the
+        client's host name replaced."""
+        f = open(os.path.join(testdir, "captures", "session.txt"), 'rb')
+        record = [record for record in pparser.read_capture(f)
+                  if 1 < len(record)][2]
+        f.close()
+        data = bytes(pparser.packet_bytes(record[5]))
+        self.assertIn(utf16("TESTHOST"), data)
+        data = data.replace(utf16("TESTHOST"), utf16(hostname))
+        return pparser.pdu_record(1, 1, 0, 0, data, 0)
+
+    def written(self, fullunicode):
+        """Write the tables of a connect initial with a euro sign in the
+        host name, and return them all as bytes."""
+        pparser.parse_rdpproxy(None, io.StringIO(), "TBL", self.location,
+                               0, "test", [], 0,
+                               records=[self.connect_initial("TEST€OST")],
+                               fullunicode=fullunicode)
+        tables = b""
+        for filename in sorted(os.listdir(self.location)):
+            f = open(os.path.join(self.location, filename), 'rb')
+            tables+=f.read()
+            f.close()
+        return tables
+
+    def test_latin1(self):
+        tables = self.written(0)
+        self.assertIn(("TEST"+PLACEHOLDER+"OST").encode('latin-1'), tables)
+
+    def test_fullunicode(self):
+        tables = self.written(1)
+        self.assertIn("TEST€OST".encode('utf-8'), tables)
+
+if '__main__' == __name__:
+    unittest.main()
@@ -1,25 +1,24 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 
 import getopt
 import sys
-import string
 import struct
 
 def txt2bin(infn, outfn, offset=0):
     infile = sys.stdin
-    outfile = sys.stdout
+    outfile = sys.stdout.buffer
 
     if '-' != infn:
         infile = open(infn, 'r')
 
     if '-' != outfn:
-        outfile = open(outfn, 'w')
+        outfile = open(outfn, 'wb')
 
-    bytes = infile.read().replace("\n", ' ').strip().split(' ')
-    for t in bytes[offset:]:
+    tokens = infile.read().replace("\n", ' ').strip().split(' ')
+    for t in tokens[offset:]:
         if '' == t:
             continue
-        outfile.write(struct.pack("B", string.atoi(t, 16)))
+        outfile.write(struct.pack("B", int(t, 16)))
 
     infile.close()
     outfile.close()
@@ -29,14 +28,14 @@ if '__main__' == __name__:
     offset = 0
     optlist, args = getopt.getopt(sys.argv[1:], 'o:')
     if len(args) < 2:
-        print "Usage: %s [-t offset] <infile> <outfile>" % sys.argv[0]
+        print("Usage: %s [-t offset] <infile> <outfile>" % sys.argv[0])
         sys.exit(1)
     
     for opt, arg in optlist:
         if '-o' == opt:
             offset = int(arg)
         else:
-            print "Unrecognized option %s" % opt
+            print("Unrecognized option %s" % opt)
             sys.exit(1)
 
     txt2bin(args[0], args[1], offset=offset)